@@ -0,0 +1,463 @@
+"""asyncio-native database communication module. It requires the optional `aiohttp` dependency."""
+
+import asyncio
+import base64
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+from typing import Union
+
+import aiohttp
+
+from . import protocol
+from .config import load_config
+from .design import DESIGN_DOCUMENT
+from .design import READINGS_DESIGN_DOCUMENT
+from .jsonstream import aiter_array
+from .jsonstream import dumps
+from .models import BulkResult
+from .models import EnergyData
+from .protocol import AdapterState
+from .protocol import Backoff
+from .protocol import Fetch
+from .protocol import FetchMany
+from .protocol import Flow
+from .protocol import Install
+from .protocol import NewUuid
+from .protocol import Request
+from .rollups import DEFAULT_MIN_POINTS
+from .rollups import Rollup
+from .rollups import rollup_span
+
+# Mirrors the retry policy of the blocking transport
+_RETRY_STATUSES = (500, 502, 503, 504)
+_RETRY_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+
+class AsyncCouchDBAdapter(AdapterState):
+    """asyncio counterpart of CouchDBAdapter. Every public method of CouchDBAdapter is available as a coroutine.
+
+    All requests go through a single pooled aiohttp session, and at most `max_in_flight` of them are sent at the same
+    time. The session is created on first use, so the adapter can be instantiated outside of a running event loop, but
+    it should only be used from a single one.
+    """
+
+    def __init__(self, config_file: str):
+
+        # Load configuration file
+        section = load_config(config_file)["DB"]
+
+        AdapterState.__init__(self, section)
+        self.base_url = self.endpoint.rstrip("/")
+
+        self.pool_maxsize = section.getint("pool_maxsize", fallback=10)
+        self.keep_alive = section.getboolean("keep_alive", fallback=True)
+        self.connect_timeout = section.getfloat("connect_timeout", fallback=3.05)
+        self.read_timeout = section.getfloat("read_timeout", fallback=30)
+        self.retries = section.getint("retries", fallback=3)
+        self.backoff_factor = section.getfloat("backoff_factor", fallback=0.3)
+        self.max_in_flight = section.getint("max_in_flight", fallback=16)
+
+        self._session = None
+        self._semaphore = None
+        self._uuids = []
+        self._uuids_lock = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize, force_close=not self.keep_alive)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            credentials = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout,
+                                                  headers={"Authorization": f"Basic {credentials}"},
+                                                  raise_for_status=False)
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._uuids_lock = asyncio.Lock()
+
+        return self._session
+
+    async def close(self):
+        """Releases every connection held by the adapter."""
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _send(self, request: Request) -> Tuple[int, Any]:
+        """Sends a request built by the protocol module and reads its whole response. Failed requests are retried as
+        the blocking transport does, except for POST, which may have been applied before the connection failed.
+        Returns the status code along with the decoded json body (or None, if the body is not json).
+        """
+
+        session = await self._get_session()
+        data = None if request.body is None else dumps(request.body)
+        headers = {"Content-Type": "application/json"} if request.body is not None else None
+        retried = request.method in _RETRY_METHODS
+
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    async with session.request(request.method, f"{self.base_url}{request.path}",
+                                               params=request.params, data=data, headers=headers) as res:
+                        status = res.status
+                        payload = await res.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if not retried or attempt >= self.retries:
+                    raise
+            else:
+                if status not in _RETRY_STATUSES or not retried or attempt >= self.retries:
+                    break
+
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+        return status, protocol.decode(payload)
+
+    async def _stream_array(self, request: Request, key: str) -> AsyncIterator:
+        """Sends a GET request and yields the items of the array under `key` of its response, as they arrive. Nothing
+        is yielded if the request fails.
+        """
+
+        session = await self._get_session()
+
+        async with self._semaphore:
+            async with session.request(request.method, f"{self.base_url}{request.path}",
+                                       params=request.params) as res:
+                if protocol.ok(res.status):
+                    async for item in aiter_array(res.content.iter_chunked(self.stream_chunk_size), key):
+                        yield item
+
+    async def _run(self, flow: Flow) -> Any:
+        """Carries out a flow of the protocol module, performing each of its steps in turn, exactly as the synchronous
+        adapter does.
+        Returns the result of the flow.
+        """
+
+        result = None
+        while True:
+            try:
+                step = flow.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            result = await self._perform(step)
+
+    async def _perform(self, step) -> Any:
+        """Performs a single step of a flow (see the protocol module). The documents of a FetchMany step are fetched
+        concurrently.
+        Returns its result.
+        """
+
+        if isinstance(step, Request):
+            return await self._send(step)
+
+        if isinstance(step, Fetch):
+            return await self._fetch_document(document=step.document)
+
+        if isinstance(step, FetchMany):
+            docs = await asyncio.gather(*(self._fetch_document(document=doc) for doc in step.documents))
+            return [doc for doc in docs if doc]
+
+        if isinstance(step, Backoff):
+            return await asyncio.sleep(step.seconds)
+
+        if isinstance(step, Install):
+            if step.document == READINGS_DESIGN_DOCUMENT:
+                return await self.install_readings_design()
+            return await self.install_design()
+
+        if isinstance(step, NewUuid):
+            return await self._next_uuid()
+
+        raise TypeError(f"Unknown step: {step!r}")
+
+    async def _fetch_document(self, *, document: str = None) -> dict:
+        """Fetches the default document.
+        Returns its content in json-format. If operation is unsuccessful, an
+        empty dict is being returned.
+
+        Throws:
+        AssertionError -- If no document can be found.
+        """
+
+        return protocol.parse_document(*await self._send(protocol.get_document(self.db, self._resolve(document))))
+
+    async def _update_document(self, data: dict, *, document=None) -> bool:
+        """Updates the default document with the given data. This is equivalent
+        to overwriting the stored data. Use with caution!
+        Returns True if the document was updated successfully.
+
+        Throws:
+        AssertionError -- If no document can be found.
+        """
+
+        return await self._run(protocol.update_document(self, data, document))
+
+    async def _next_uuid(self) -> str:
+        """Returns a server-generated UUID. They are fetched in blocks of `uuid_block_size`."""
+
+        await self._get_session()
+
+        # Concurrent callers wait for a single refill, instead of each one requesting its own block
+        async with self._uuids_lock:
+            if not self._uuids:
+                _, data = await self._send(protocol.uuids(self.uuid_block_size))
+                self._uuids = protocol.parse_uuids(data)
+
+            return self._uuids.pop()
+
+    async def create_document(self, name: str = None, *, initial_data: EnergyData = None) -> str:
+        """Creates a new document named `name`, initialized with `initial_data`.
+        Returns the name of the document if creation was successful, and an empty
+        string otherwise.
+        """
+
+        return await self._run(protocol.create_document(self, name, initial_data))
+
+    async def delete_document(self, name: str) -> bool:
+        return await self._run(protocol.delete_document(self, name))
+
+    async def create_database(self, name: str) -> str:
+        """Creates a new database named `name`
+        Returns the name of the database if creation was successful, and an empty string otherwise.
+        """
+
+        if name:
+            status, _ = await self._send(protocol.put_database(name))
+            if not protocol.ok(status):
+                name = ""
+        else:
+            name = ""
+
+        return name
+
+    async def delete_database(self, name: str) -> bool:
+        """Deletes the database named `name`
+        Returns True if deletion was successful.
+        """
+
+        if name:
+            status, _ = await self._send(protocol.delete_database(name))
+            return protocol.ok(status)
+
+        return False
+
+    async def fetch_energy_data(self, *, document: str = None) -> EnergyData:
+        """Fetches the default document.
+        Returns its content as a valid EnergyData object. If operation is unsuccessful, an empty EnergyData object will
+        be returned. The readings of a document that was rolled over are merged from all of its chunks.
+        """
+
+        return await self._run(protocol.fetch_energy_data(self, document))
+
+    async def iter_energy_data(self, *, document: str = None, batch_size: int = None, fields: List[str] = None,
+                               start=None, end=None) -> AsyncIterator:
+        """Streams the readings of the default document, as the synchronous adapter does. Readings are yielded one by
+        one (or in lists of `batch_size`) as they arrive, filtered server-side by the `window` show function whenever
+        possible.
+
+        Throws:
+        AssertionError -- If no document can be found.
+        """
+
+        document = self._resolve(document)
+
+        batch = []
+        async for reading in self._iter_readings(document, fields, start, end):
+            if not batch_size:
+                yield reading
+                continue
+
+            batch.append(reading)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    async def _iter_readings(self, document: str, fields: List[str], start, end) -> AsyncIterator[dict]:
+        """Yields the (filtered) readings of `document` and its chunks, in order, as they arrive."""
+
+        windows = await self._run(protocol.windows(self, document, fields, start, end))
+        if windows is None:
+            # Packed readings can only be unpacked as a whole
+            readings = (await self.fetch_energy_data(document=document)).energy_data
+            for reading in protocol.filter_readings(readings, fields, start, end):
+                yield reading
+            return
+
+        for window in windows:
+            async for reading in self._stream_array(window, "energy_data"):
+                # Re-applying the filter is a no-op on the output of the window show function
+                for kept in protocol.filter_readings([reading], fields, start, end):
+                    yield kept
+
+    async def install_design(self) -> bool:
+        """Makes sure that every design function the adapter relies on is installed, merging them into the existing
+        design document as the synchronous adapter does.
+        Returns True if the design document is up-to-date.
+        """
+
+        self._design_installed = await self._install_design(DESIGN_DOCUMENT)
+        return self._design_installed
+
+    async def install_readings_design(self) -> bool:
+        """Makes sure that the views of READINGS_DESIGN_DOCUMENT are installed. It is called by the first
+        `fetch_readings` or `fetch_rollups`.
+        Returns True if the design document is up-to-date.
+        """
+
+        self._readings_design_installed = await self._install_design(READINGS_DESIGN_DOCUMENT)
+        return self._readings_design_installed
+
+    async def _install_design(self, document: str) -> bool:
+        return await self._run(protocol.install_design(self, document, protocol.design_functions(document)))
+
+    async def append_energy_data(self, *energy_data_list: EnergyData, document=None, batch_id: str = None) -> bool:
+        """Accepts one or more EnergyData objects and appends their contents to the specified document, keeping its
+        readings sorted by timestamp and unique per timestamp. Appending again with the same `batch_id` is a no-op.
+        """
+
+        rows = []
+        for energy_data in energy_data_list:
+            rows.extend(energy_data.energy_data)
+
+        return await self._run(protocol.append_energy_data(self, rows, document, batch_id))
+
+    async def load_date_index(self) -> int:
+        """Reads the whole get_dates view once and (re)builds the local date index out of it.
+        Returns the number of indexed dates.
+        """
+
+        return await self._run(protocol.load_date_index(self))
+
+    async def get_document_id_for_date(self, date: str) -> str:
+        """Returns the id of the document that matches the given date, or an empty string if there is no such date."""
+
+        return await self._run(protocol.document_id_for_date(self, date))
+
+    async def get_document_ids_for_dates(self, dates: Iterable[str]) -> Dict[str, str]:
+        """Returns a mapping from each of the given dates to the id of its document. Dates that have no document are
+        omitted."""
+
+        return await self._run(protocol.document_ids_for_dates(self, dates))
+
+    async def fetch_energy_data_by_date(self, date: str) -> EnergyData:
+        energy_data = EnergyData()
+        doc = await self.get_document_id_for_date(date)
+        if doc:
+            energy_data = await self.fetch_energy_data(document=doc)
+        return energy_data
+
+    async def _fetch_concurrently(self, document_ids: Iterable[str]) -> List[EnergyData]:
+        """Fetches the given documents concurrently (up to `max_in_flight` at a time), preserving their order.
+        Documents that cannot be fetched are omitted."""
+
+        docs = await self._perform(FetchMany(list(document_ids)))
+
+        return await asyncio.gather(*(self._run(protocol.energy_data_of(self, doc)) for doc in docs))
+
+    async def fetch_many(self, dates: Iterable[str]) -> List[EnergyData]:
+        """Fetches the data of many dates at once. All document ids are resolved by a single view query (if not already
+        known), and the documents are then fetched concurrently.
+        Returns an EnergyData object per date that has a document, in the given order.
+        """
+
+        ids = await self.get_document_ids_for_dates(dates)
+
+        return await self._fetch_concurrently(ids.values())
+
+    async def fetch_energy_data_range(self, start: str, end: str) -> List[EnergyData]:
+        """Fetches the data of every date between `start` and `end` (both inclusive), using a single view query and
+        concurrent document fetches.
+        Returns an EnergyData object per stored date, in chronological order.
+        """
+
+        return await self._fetch_concurrently(await self._run(protocol.document_ids_between(self, start, end)))
+
+    async def fetch_readings(self, start_ts, end_ts, *, fields: List[str] = None) -> List[dict]:
+        """Fetches the readings whose timestamp lies in [start_ts, end_ts), no matter which (date) documents they are
+        stored in, off the by_timestamp view, along with those of the packed documents that the view skips. If the views
+        cannot be installed, every document is scanned instead.
+        Returns the readings in chronological order.
+
+        fields -- If given, only these fields (and the timestamp) of each reading are kept
+        """
+
+        return await self._run(protocol.fetch_readings(self, start_ts, end_ts, fields))
+
+    async def fetch_rollups(self, start_ts, end_ts, fields: List[str], *, resolution: int = None,
+                            min_points: int = DEFAULT_MIN_POINTS) -> Dict[str, List[Rollup]]:
+        """Returns the pre-aggregated count, sum, min and max of the given fields, per bucket of `resolution` seconds,
+        for every bucket that overlaps [start_ts, end_ts), as kept by the rollups view. The fields are queried
+        concurrently.
+        Returns a list of Rollup objects per field, in chronological order.
+
+        resolution -- One of MINUTE, HOUR or DAY. If omitted, the coarsest resolution that splits the span in at least
+        `min_points` buckets is used.
+        """
+
+        resolution, start, end = rollup_span(start_ts, end_ts, resolution, min_points)
+
+        rollups = await asyncio.gather(*(self._fetch_rollups(field, start, end, resolution) for field in fields))
+        return dict(zip(fields, rollups))
+
+    async def _fetch_rollups(self, field: str, start: int, end: int, resolution: int) -> List[Rollup]:
+        rollups = await self._run(protocol.view_rollups(self, field, start, end, resolution))
+        if rollups is None:
+            rollups = protocol.aggregate_rollups(await self.fetch_readings(start, end, fields=[field]), resolution)
+
+        return rollups
+
+    async def create_documents(self, items: Iterable[Union[EnergyData, Dict]], *,
+                               chunk_size: int = None) -> List[BulkResult]:
+        """Creates many documents at once, sending them to the database in chunks of `chunk_size` documents per
+        request. Chunks are sent concurrently.
+        Returns the outcome of every document, in the given order.
+        """
+
+        chunks = [[protocol.new_document(self, item) for item in chunk]
+                  for chunk in protocol.batched(items, chunk_size or self.bulk_chunk_size)]
+
+        results = await asyncio.gather(*(self._run(protocol.bulk_write(self, docs)) for docs in chunks))
+
+        return [result for chunk in results for result in chunk]
+
+    async def update_energy_data_by_dates(self, items: Iterable[EnergyData], *,
+                                          chunk_size: int = None) -> List[BulkResult]:
+        """Stores the data of many dates at once, replacing the data of already stored dates.
+        Returns the outcome of every document, in the given order.
+        """
+
+        results = []
+
+        for chunk in protocol.batched(items, chunk_size or self.bulk_chunk_size):
+            results.extend(await self._run(protocol.replace_dates(self, chunk)))
+
+        return results
+
+    async def update_energy_data_by_date(self, date: str, data: EnergyData) -> bool:
+        return await self._run(protocol.update_energy_data_by_date(self, date, data))
+
+    async def create_raw_document(self, name: str, *, initial_data: Dict = None) -> str:
+        """Creates a new document with arbitrary data named `name`, initialized with `initial_data`.
+        Returns the name of the document if creation was successful, and an empty
+        string otherwise.
+        """
+
+        return await self._run(protocol.create_raw_document(self, name, initial_data))
+
+    async def fetch_meta(self):
+        return await self._run(protocol.fetch_meta(self))
@@ -1,30 +1,165 @@
 """Database-related communication module"""
 
-import configparser
-import json
+import threading
+import time
+from typing import TYPE_CHECKING
+from typing import Any
 from typing import Dict
-
-import requests
-
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Tuple
+from typing import Union
+
+from . import protocol
+from .cache import DocumentCache
+from .config import load_config
+from .design import DESIGN_DOCUMENT
+from .design import READINGS_DESIGN_DOCUMENT
+from .jsonstream import dumps
+from .jsonstream import iter_array
+from .jsonstream import iter_dumps
+from .jsonstream import loads
+from .metrics import Metrics
+from .metrics import instrumented
+from .models import BulkResult
 from .models import EnergyData
-
-
-class CouchDBAdapter:
+from .protocol import AdapterState
+from .protocol import Backoff
+from .protocol import Fetch
+from .protocol import FetchMany
+from .protocol import Flow
+from .protocol import Install
+from .protocol import NewUuid
+from .protocol import Request
+from .rollups import Rollup
+from .storage import StorageBackend
+from .transport import HTTPTransport
+from .transport import on_primary
+
+if TYPE_CHECKING:
+    import requests
+
+
+class CouchDBAdapter(AdapterState, StorageBackend):
     """ChouchDB Adapter class used to exchange data using REST API."""
 
     def __init__(self, config_file: str):
 
         # Load configuration file
-        cfg = configparser.ConfigParser(interpolation=None)
-        cfg.read(config_file)
-
-        self.endpoint = cfg["DB"]["endpoint"]
-        self.db = cfg["DB"]["db_name"]
-        self.document = cfg["DB"]["document_name"]  # Todo: deprecate
-        self.username = cfg["DB"]["username"]
-        self.password = cfg["DB"]["password"]
+        cfg = load_config(config_file)
+
+        AdapterState.__init__(self, cfg["DB"])
         self.base_url = f"{self.endpoint}"
 
+        # A single pooled transport is shared by every call (and every thread) of this adapter
+        self.transport = HTTPTransport.from_config(cfg["DB"], auth=(self.username, self.password))
+
+        # Optional metrics of every request, tagged by the operation that sent it. They are disabled unless `metrics`
+        # is set, though any other hook can be added to the transport at any time.
+        self.metrics = None
+        if cfg["DB"].getboolean("metrics", fallback=False):
+            self.metrics = Metrics()
+            self.transport.add_hook(self.metrics)
+
+        self.stream_uploads = cfg["DB"].getboolean("stream_uploads", fallback=False)
+
+        # UUIDs are requested from the server in blocks and handed out one by one
+        self._uuids = []
+        self._uuids_lock = threading.Lock()
+
+        # Optional read-through cache of fetched documents. It is disabled unless `cache_entries` is set.
+        self.cache = None
+        cache_entries = cfg["DB"].getint("cache_entries", fallback=0)
+        if cache_entries > 0:
+            self.cache = DocumentCache(cache_entries, cfg["DB"].getint("cache_bytes", fallback=64 * 1024 * 1024))
+
+    def close(self):
+        """Releases every connection held by the adapter."""
+
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _encode(self, obj):
+        """Serializes a (potentially large) request body. Depending on `stream_uploads`, the body is either encoded
+        at once to bytes, or lazily in chunks, which are sent using chunked transfer-encoding.
+        """
+
+        if self.stream_uploads:
+            return iter_dumps(obj, self.stream_chunk_size)
+        return dumps(obj)
+
+    def _send(self, request: Request, **kwargs) -> "requests.Response":
+        """Sends a request built by the protocol module. Any keyword argument (e.g. `stream` or `headers`) is passed on
+        to the transport. Every document the request may have altered is dropped from the cache.
+        """
+
+        if request.body is not None:
+            kwargs["data"] = self._encode(request.body) if request.document else dumps(request.body)
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"Content-Type": "application/json"})
+
+        try:
+            return self.transport.request(request.method, request.path, params=request.params, read=request.read,
+                                          **kwargs)
+        finally:
+            for document in request.changes:
+                self._invalidate(document)
+
+    def _call(self, request: Request) -> Tuple[int, Any]:
+        """Sends a request and reads its whole response.
+        Returns the status code along with the decoded json body (or None, if the body is not json).
+        """
+
+        res = self._send(request)
+        return res.status_code, protocol.decode(res.content)
+
+    def _run(self, flow: Flow) -> Any:
+        """Carries out a flow of the protocol module, performing each of its steps in turn.
+        Returns the result of the flow.
+        """
+
+        result = None
+        while True:
+            try:
+                step = flow.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            result = self._perform(step)
+
+    def _perform(self, step) -> Any:
+        """Performs a single step of a flow (see the protocol module).
+        Returns its result.
+        """
+
+        if isinstance(step, Request):
+            return self._call(step)
+
+        if isinstance(step, Fetch):
+            return self._fetch_document(document=step.document)
+
+        if isinstance(step, FetchMany):
+            return self._iter_documents(step.documents)
+
+        if isinstance(step, Backoff):
+            return time.sleep(step.seconds)
+
+        if isinstance(step, Install):
+            # The public methods are called, so that the installation is tagged and sent to the primary
+            if step.document == READINGS_DESIGN_DOCUMENT:
+                return self.install_readings_design()
+            return self.install_design()
+
+        if isinstance(step, NewUuid):
+            return self._next_uuid()
+
+        raise TypeError(f"Unknown step: {step!r}")
+
     def _fetch_document(self, *, document: str = None) -> dict:
         """Fetches the default document.
         Returns its content in json-format. If operation is unsuccessful, an
@@ -38,20 +173,49 @@ class CouchDBAdapter:
         AssertionError -- If no document can be found.
         """
 
-        if not document:
-            document = self.document
+        document = self._resolve(document)
+
+        if self.cache is not None:
+            return self._fetch_cached_document(document)
 
-        assert document, "No document was supplied!"
+        return protocol.parse_document(*self._call(protocol.get_document(self.db, document)))
+
+    def _fetch_cached_document(self, document: str) -> dict:
+        """Fetches a document through the cache. Cached documents are revalidated with their ETag, so an unchanged
+        document costs a bodiless 304 response. Documents of past dates are considered closed, and are served without
+        any round trip at all.
+        Returns a copy of the document, which is safe to be altered by the caller.
+        """
 
-        res = requests.get(f"{self.base_url}/{self.db}/{document}",
-                           auth=(self.username, self.password))
+        entry = self.cache.get(document)
 
-        data = {}
+        if entry is None or not entry.immutable:
+            headers = {"If-None-Match": entry.etag} if entry is not None and entry.etag else {}
+            res = self._send(protocol.get_document(self.db, document), headers=headers)
 
-        if res.ok:
-            data = res.json()
+            if res.status_code == 304 and entry is not None:
+                self.cache.revalidations += 1
+            elif res.ok:
+                doc = loads(res.content)
+                entry = self.cache.put(document, doc, res.headers.get("ETag", ""), len(res.content),
+                                       immutable=protocol.closed(doc))
+                if entry is None:
+                    return doc
+            else:
+                self.cache.invalidate(document)
+                return {}
 
-        return data
+        doc = dict(entry.doc)
+        if "energy_data" in doc:
+            doc["energy_data"] = list(doc["energy_data"])
+
+        return doc
+
+    def _invalidate(self, document: str):
+        """Drops `document` from the cache, after it was (or might have been) altered."""
+
+        if self.cache is not None:
+            self.cache.invalidate(document)
 
     def _update_document(self, data: dict, *, document=None) -> bool:
         """Updates the default document with the given data. This is equivalent
@@ -68,24 +232,10 @@ class CouchDBAdapter:
         AssertionError -- If no document can be found.
         """
 
-        if not document:
-            document = self.document
-
-        assert document, "No document was supplied!"
-
-        contents = self._fetch_document(document=document)
-
-        if not data:
-            data = EnergyData()
-
-        contents.update(data)
-
-        res = requests.put(f"{self.base_url}/{self.db}/{document}",
-                           data=json.dumps(contents),
-                           auth=(self.username, self.password))
-
-        return res.ok
+        return self._run(protocol.update_document(self, data, document))
 
+    @instrumented("create_document")
+    @on_primary
     def create_document(self, name: str = None, *, initial_data: EnergyData = None) -> str:
         """Creates a new document named `name`, initialized with `initial_data`.
         Returns the name of the document if creation was successful, and an empty
@@ -97,36 +247,26 @@ class CouchDBAdapter:
         of-type EnergyData. If omitted, an empty EnergyData object will be used.
         """
 
-        # If no name is provided, generate a new UUID on the fly
-        if not name:
-            res = requests.get(f"{self.base_url}/_uuids")
-            name = res.json()["uuids"][0]
-
-        # Empty bodied requests cannot create new CouchDB Documents.
-        # Make sure no empty data are sent.
-        if not initial_data:
-            initial_data = EnergyData()
+        return self._run(protocol.create_document(self, name, initial_data))
 
-        res = requests.put(f"{self.base_url}/{self.db}/{name}",
-                           auth=(self.username, self.password),
-                           data=initial_data.as_json(string=True))
+    def _next_uuid(self) -> str:
+        """Returns a server-generated UUID. They are fetched in blocks of `uuid_block_size`, so that most calls need no
+        round trip at all."""
 
-        if not res.ok:
-            name = ""
+        with self._uuids_lock:
+            if not self._uuids:
+                _, data = self._call(protocol.uuids(self.uuid_block_size))
+                self._uuids = protocol.parse_uuids(data)
 
-        return name
+            return self._uuids.pop()
 
+    @instrumented("delete_document")
+    @on_primary
     def delete_document(self, name: str) -> bool:
-        data = self._fetch_document(document=name)
-        if "_rev" in data:
-            rev = data["_rev"]
-            res = requests.delete(f"{self.base_url}/{self.db}/{name}",
-                                  auth=(self.username, self.password),
-                                  params={"rev": rev})
-            return res.ok
-
-        return False
+        return self._run(protocol.delete_document(self, name))
 
+    @instrumented("create_database")
+    @on_primary
     def create_database(self, name: str) -> str:
         """Creates a new database named `name`
         Returns the name of the database if creation was successful, and an empty string otherwise.
@@ -139,14 +279,15 @@ class CouchDBAdapter:
             name = ""
 
         else:
-            res = requests.put(f"{self.base_url}/{name}",
-                               auth=(self.username, self.password))
+            status, _ = self._call(protocol.put_database(name))
 
-            if not res.ok:
+            if not protocol.ok(status):
                 name = ""
 
         return name
 
+    @instrumented("delete_database")
+    @on_primary
     def delete_database(self, name: str) -> bool:
         """Deletes the database named `name`
         Returns the name of the database if deletion was successful, and an empty string otherwise.
@@ -155,16 +296,65 @@ class CouchDBAdapter:
         will be deleted.
         """
         if name:
-            res = requests.delete(f"{self.base_url}/{name}",
-                                  auth=(self.username, self.password))
-            return res.ok
+            status, _ = self._call(protocol.delete_database(name))
+            if name == self.db and self.cache is not None:
+                self.cache.clear()
+            return protocol.ok(status)
 
         return False
 
+    @instrumented("iter_energy_data")
+    def iter_energy_data(self, *, document: str = None, batch_size: int = None, fields: List[str] = None,
+                         start=None, end=None) -> Iterator:
+        """Streams the readings of the default document, without ever holding the whole document in memory. Readings
+        are yielded one by one (or in lists of `batch_size`) as they arrive. If any filter is given, it is applied
+        server-side by the `window` show function, so the filtered-out readings are never downloaded; if the function
+        cannot be installed, filtering takes place client-side instead. If rollover is enabled, the chunks of the
+        document are streamed after it, in order. Packed documents are fetched at once and filtered client-side.
+
+        document -- The document to be fetched. It is usually omitted as the
+                    default document is being implied, but an arbitrary document
+                    can be specified as well.
+        batch_size -- If given, readings are yielded in lists of (at most) `batch_size` readings
+        fields -- If given, only these fields (and the timestamp) of each reading are kept
+        start -- If given, only readings with a timestamp greater or equal to `start` are kept
+        end -- If given, only readings with a timestamp less than `end` are kept
+
+        Throws:
+        AssertionError -- If no document can be found.
+        """
+
+        document = self._resolve(document)
+
+        windows = self._run(protocol.windows(self, document, fields, start, end))
+        if windows is None:
+            # Packed readings can only be unpacked as a whole
+            readings = iter(self.fetch_energy_data(document=document).energy_data)
+        else:
+            readings = (reading for window in windows for reading in self._stream_array(window, "energy_data"))
+
+        readings = protocol.filter_readings(readings, fields, start, end)
+
+        if batch_size:
+            yield from protocol.batched(readings, batch_size)
+        else:
+            yield from readings
+
+    def _stream_array(self, request: Request, key: str) -> Iterator:
+        """Sends a request and yields the items of the array under `key` of its response, as they arrive. Nothing is
+        yielded if the request fails."""
+
+        res = self._send(request, stream=True)
+
+        with res:
+            if res.ok:
+                yield from iter_array(res.iter_content(self.stream_chunk_size), key)
+
+    @instrumented("fetch_energy_data")
     def fetch_energy_data(self, *, document: str = None) -> EnergyData:
         """Fetches the default document.
         Returns its content as a valid EnergyData object. If operation is unsuccessful, an empty EnergyData object will
-         be returned.
+         be returned. The readings of a document that was rolled over are merged from all of its chunks.
 
         document -- The document to be fetched. It is usually omitted as the
                     default document is being implied, but an arbitrary document
@@ -174,55 +364,88 @@ class CouchDBAdapter:
         AssertionError -- If no document can be found.
         """
 
-        energy_data = EnergyData()
-        data = self._fetch_document(document=document)
+        return self._run(protocol.fetch_energy_data(self, document))
 
-        if data:
-            if "date" in data:
-                energy_data.date = data["date"]
-            if "energy_data" in data:
-                energy_data.energy_data = data["energy_data"]
+    @instrumented("install_design")
+    @on_primary
+    def install_design(self) -> bool:
+        """Makes sure that every design function the adapter relies on is installed, as defined in DESIGN_FUNCTIONS.
+        They are merged into the existing design document: missing functions are added, and the ones installed by the
+        adapters are upgraded if they differ. Every other function is left untouched. If a function of the same name
+        that the adapters did not install differs (see `design.design_conflicts`), nothing is written at all.
+        Returns True if the design document is up-to-date.
+        """
 
-        return energy_data
+        self._design_installed = self._install_design(DESIGN_DOCUMENT)
+        return self._design_installed
 
-    def append_energy_data(self, *energy_data_list: EnergyData, document=None) -> bool:
-        """Accepts one or more EnergyData objects and appends their contents to the specified document.
+    @instrumented("install_readings_design")
+    @on_primary
+    def install_readings_design(self) -> bool:
+        """Makes sure that the views of READINGS_DESIGN_DOCUMENT are installed, merging them into the existing design
+        document as `install_design` does. It is called by the first `fetch_readings` or `fetch_rollups`, so databases
+        that are never queried by time never index their readings.
+        Returns True if the design document is up-to-date.
         """
 
-        old_energy_data = self.fetch_energy_data(document=document)
+        self._readings_design_installed = self._install_design(READINGS_DESIGN_DOCUMENT)
+        return self._readings_design_installed
+
+    def _install_design(self, document: str) -> bool:
+        return self._run(protocol.install_design(self, document, protocol.design_functions(document)))
 
+    @instrumented("append_energy_data")
+    @on_primary
+    def append_energy_data(self, *energy_data_list: EnergyData, document=None, batch_id: str = None) -> bool:
+        """Accepts one or more EnergyData objects and appends their contents to the specified document.
+        Unless `server_side_append` is disabled, only the new rows are sent to the database, where they are appended
+        by an update handler. If the handler cannot be installed, the whole document is fetched, extended and stored
+        back instead. In both cases, conflicting writes are retried.
+        Either way, the new rows are merged into the stored ones (see `models.merge_readings`), so the readings of the
+        document stay sorted by timestamp, and a re-sent reading replaces the stored one of the same timestamp. If the
+        document was rolled over, this holds across all of its chunks, as each of them only takes the readings newer
+        than those of the chunk before it.
+
+        batch_id -- An optional unique id of this append. Appending again with the same id is a no-op, which makes
+        re-sending a batch of unknown outcome safe.
+        """
+
+        rows = []
         for energy_data in energy_data_list:
-            new_data = energy_data.energy_data
+            rows.extend(energy_data.energy_data)
 
-            old_energy_data.energy_data.extend(new_data)
+        return self._run(protocol.append_energy_data(self, rows, document, batch_id))
 
-        return self._update_document(old_energy_data.as_json(string=False), document=document)
+    @instrumented("load_date_index")
+    def load_date_index(self) -> int:
+        """Reads the whole get_dates view once and (re)builds the local date index out of it, so that subsequent
+        lookups need no round trip at all.
+        Returns the number of indexed dates.
+        """
 
+        return self._run(protocol.load_date_index(self))
+
+    @instrumented("get_document_id_for_date")
     def get_document_id_for_date(self, date: str) -> str:
         """Returns the id of the document that matches the given date. If there
         is no such information available on the database, there are no
         appropriate views defined, or there is just no such matching date, an
-        empty string will be returned.
-        """
+        empty string will be returned. If the document was rolled over, this is
+        the id of its first chunk, which lists all the others.
 
-        res = requests.get(f"{self.base_url}/{self.db}/_design/api/_view/get_dates",
-                           auth=(self.username, self.password))
+        Known dates are served by the local index. Unknown ones are looked up
+        with a keyed view query, which transfers a single row.
+        """
 
-        data = {}
-        if res.ok:
-            data = res.json()
+        return self._run(protocol.document_id_for_date(self, date))
 
-        rows = []
-        if "rows" in data:
-            rows = data["rows"]
-
-        document_id = ""
-        for row in rows:
-            if row["key"] == date:
-                document_id = row["value"]
-                break
+    @instrumented("get_document_ids_for_dates")
+    def get_document_ids_for_dates(self, dates: Iterable[str]) -> Dict[str, str]:
+        """Returns a mapping from each of the given dates to the id of its document. Dates that have no document are
+        omitted. Every date missing from the local index is resolved by a single keyed view query.
+        """
 
-        return document_id
+        return self._run(protocol.document_ids_for_dates(self, dates))
 
     def fetch_energy_data_by_date(self, date: str) -> EnergyData:
         energy_data = EnergyData()
@@ -231,18 +454,143 @@ class CouchDBAdapter:
             energy_data = self.fetch_energy_data(document=doc)
         return energy_data
 
-    def update_energy_data_by_date(self, date: str, data: EnergyData) -> bool:
-        if not data:
-            data = EnergyData()
+    def _iter_documents(self, document_ids: List[str]) -> Iterator[dict]:
+        """Fetches all the given documents with a single request and yields them one by one, in the given order, as
+        soon as each of them has been received. Missing and deleted documents are skipped.
+        """
 
-        doc = self.get_document_id_for_date(date)
-        if doc:
-            contents = self._fetch_document(document=doc)
-            contents["energy_data"] = data.energy_data
-            return self._update_document(contents, document=doc)
-        else:
-            return bool(self.create_document(initial_data=data))
+        if not document_ids:
+            return
+
+        for row in self._stream_array(protocol.all_docs(self.db, document_ids, include_docs=True), "rows"):
+            doc = row.get("doc")
+            if doc:
+                yield doc
+
+    @instrumented("fetch_many")
+    def fetch_many(self, dates: Iterable[str]) -> Iterator[EnergyData]:
+        """Fetches the data of many dates at once. All document ids are resolved by a single view query (if not already
+        known), and all documents are then fetched by a single request.
+        Yields an EnergyData object per date that has a document, in the given order, as soon as it has been parsed.
+
+        dates -- The requested dates, in YYYY-MM-DD format
+        """
+
+        ids = self.get_document_ids_for_dates(dates)
+
+        for doc in self._iter_documents(list(ids.values())):
+            yield self._run(protocol.energy_data_of(self, doc))
+
+    @instrumented("fetch_energy_data_range")
+    def fetch_energy_data_range(self, start: str, end: str) -> Iterator[EnergyData]:
+        """Fetches the data of every date between `start` and `end` (both inclusive) at once, using a single view query
+        and a single bulk fetch.
+        Yields an EnergyData object per stored date, in chronological order, as soon as it has been parsed.
+
+        start -- The first date of the range, in YYYY-MM-DD format
+        end -- The last date of the range, in YYYY-MM-DD format
+        """
+
+        ids = self._run(protocol.document_ids_between(self, start, end))
 
+        for doc in self._iter_documents(ids):
+            yield self._run(protocol.energy_data_of(self, doc))
+
+    @instrumented("fetch_readings")
+    def fetch_readings(self, start_ts, end_ts, *, fields: List[str] = None) -> Iterator[dict]:
+        """Fetches the readings whose timestamp lies in [start_ts, end_ts), no matter which (date) documents they are
+        stored in. They are read off the by_timestamp view, so only the matching readings are transferred, and the cost
+        depends on the size of the result rather than on the size of the documents.
+        Yields the readings in chronological order, as soon as each of them has been received. The view skips packed
+        documents, so those that overlap the range are fetched and unpacked, and their readings are merged in. If the
+        views cannot be installed, every document is scanned instead.
+
+        start_ts -- The first timestamp to include
+        end_ts -- The first timestamp to exclude
+        fields -- If given, only these fields (and the timestamp) of each reading are kept
+        """
+
+        packed = None
+        if self._run(protocol.readings_design_ready(self)):
+            packed = self._run(protocol.packed_documents(self, start_ts, end_ts))
+
+        if packed is not None:
+            res = self._send(protocol.readings_view(self.db, start_ts, end_ts), stream=True)
+
+            with res:
+                if res.ok:
+                    rows = iter_array(res.iter_content(self.stream_chunk_size), "rows")
+                    readings = protocol.filter_readings((row["value"] for row in rows), fields)
+                    unpacked = protocol.unpacked_readings(packed, start_ts, end_ts, fields)
+                    yield from protocol.merge_by_timestamp(readings, unpacked)
+                    return
+
+                protocol.view_failed(self, res.status_code)
+
+        yield from self._run(protocol.scan_readings(self, start_ts, end_ts, fields))
+
+    @instrumented("fetch_rollups")
+    def _fetch_rollups(self, field: str, start: int, end: int, resolution: int) -> List[Rollup]:
+        """Reads the rollups off the (reduced) rollups view, grouped at the level of the resolution, merging in those
+        of the packed documents. If the views cannot be used, the readings of the span are aggregated client-side
+        instead.
+        """
+
+        rollups = self._run(protocol.view_rollups(self, field, start, end, resolution))
+        if rollups is None:
+            rollups = protocol.aggregate_rollups(self.fetch_readings(start, end, fields=[field]), resolution)
+
+        return rollups
+
+    @instrumented("create_documents")
+    @on_primary
+    def create_documents(self, items: Iterable[Union[EnergyData, Dict]], *, chunk_size: int = None) -> List[BulkResult]:
+        """Creates many documents at once, sending them to the database in chunks of `chunk_size` documents per
+        request. It is the bulk equivalent of `create_document` and `create_raw_document`.
+        Returns the outcome of every document, in the given order. Documents that already exist are reported with a
+        "conflict" error.
+
+        items -- EnergyData objects and/or raw json-serializable dicts. A dict may define its own `_id`; every other
+        document is named after a new UUID.
+        chunk_size -- The maximum number of documents per request. If omitted, `bulk_chunk_size` is used.
+        """
+
+        results = []
+
+        for chunk in protocol.batched(items, chunk_size or self.bulk_chunk_size):
+            docs = [protocol.new_document(self, item) for item in chunk]
+            results.extend(self._run(protocol.bulk_write(self, docs)))
+
+        return results
+
+    @instrumented("update_energy_data_by_dates")
+    @on_primary
+    def update_energy_data_by_dates(self, items: Iterable[EnergyData], *,
+                                    chunk_size: int = None) -> List[BulkResult]:
+        """Stores the data of many dates at once, sending them to the database in chunks of `chunk_size` documents per
+        request. It is the bulk equivalent of `update_energy_data_by_date`: the data of dates that are already stored
+        replace the existing ones, while new dates get a new document.
+        Returns the outcome of every document, in the given order. Documents that were concurrently modified are
+        reported with a "conflict" error.
+
+        items -- EnergyData objects, each one carrying its own date
+        chunk_size -- The maximum number of documents per request. If omitted, `bulk_chunk_size` is used.
+        """
+
+        results = []
+
+        for chunk in protocol.batched(items, chunk_size or self.bulk_chunk_size):
+            results.extend(self._run(protocol.replace_dates(self, chunk)))
+
+        return results
+
+    @instrumented("update_energy_data_by_date")
+    @on_primary
+    def update_energy_data_by_date(self, date: str, data: EnergyData) -> bool:
+        return self._run(protocol.update_energy_data_by_date(self, date, data))
+
+    @instrumented("create_raw_document")
+    @on_primary
     def create_raw_document(self, name: str, *, initial_data: Dict = None) -> str:
         """Creates a new document with arbitrary data named `name`, initialized with `initial_data`.
         Returns the name of the document if creation was successful, and an empty
@@ -253,25 +601,8 @@ class CouchDBAdapter:
         initial_data -- The initial data that will be contained in the created document, which MUST be json-serializable
         """
 
-        # If no name is provided, generate a new UUID on the fly
-        if name:
-
-            # Empty bodied requests cannot create new CouchDB Documents.
-            # Make sure no empty data are sent.
-            if not initial_data:
-                initial_data = {}
-
-            res = requests.put(f"{self.base_url}/{self.db}/{name}",
-                               auth=(self.username, self.password),
-                               data=json.dumps(initial_data))
-
-            if not res.ok:
-                name = ""
-
-        return name
+        return self._run(protocol.create_raw_document(self, name, initial_data))
 
+    @instrumented("fetch_meta")
     def fetch_meta(self):
-        meta = self._fetch_document(document="meta")
-        meta.pop("_id", None)
-        meta.pop("_rev", None)
-        return meta
+        return self._run(protocol.fetch_meta(self))
@@ -1,4 +1,15 @@
 from .events import Observable
 from .events import Observer
+from .dispatch import Dispatcher
+from .dispatch import INLINE
+from .dispatch import THREAD
+from .dispatch import PROCESS
+from .dispatch import ASYNCIO
+from .dispatch import DROP_OLDEST
+from .dispatch import COALESCE
+from .dispatch import BLOCK
 
+from .scheduler import Scheduler
 from .builtins import Timer
+from .builtins import DateChange
+from .changes import ChangesFeed
@@ -1,55 +1,159 @@
 """A set of predefined observable events"""
 
 import time
+from abc import ABC
+from abc import abstractmethod
 from datetime import date
+from datetime import datetime
+from datetime import timedelta
 
-from . import Observer
 from . import Observable
+from . import Observer
+from .scheduler import Scheduler
+
+# Margin (in seconds) added to the midnight deadline, so that the date has surely changed once it is reached
+_MIDNIGHT_MARGIN = 0.001
+
+# Drift (in seconds) between the wall and the monotonic clock, past which the wall clock is considered adjusted. Smaller
+# drifts (e.g. NTP slewing) only make the deadline fire slightly early or late, which _check() copes with.
+_CLOCK_DRIFT_TOLERANCE = 1.0
+
+
+class _ScheduledEvent(Observable, ABC):
+    """Base class for events driven by a Scheduler. If no scheduler is given, a private one is created, which is run
+    by run() or run_async(). If a shared scheduler is given, the event is armed on it right away, and the scheduler is
+    run by its owner, along with any other events and jobs."""
+
+    def __init__(self, scheduler: Scheduler = None):
+        super().__init__()
+        self.scheduler = scheduler
+        self.job = None
+        self._owns_scheduler = scheduler is None
+        self._stopped = False
+
+        if not self._owns_scheduler:
+            self._arm()
+
+    @abstractmethod
+    def _arm(self):
+        """Schedules the next occurrence of the event on `self.scheduler`, keeping its job in `self.job`."""
+
+    def _prepare(self):
+        self._stopped = False
+        if self.scheduler is None:
+            self.scheduler = Scheduler()
+        if self.job is None or self.job.cancelled:
+            self._arm()
+
+    def run(self):
+        """Blocks, notifying the observers whenever the event occurs, until stop() is called."""
+
+        self._prepare()
+        self.scheduler.run()
+
+    async def run_async(self):
+        """Like run(), but waits on the running asyncio loop instead of blocking a thread."""
+
+        self._prepare()
+        await self.scheduler.run_async()
+
+    def stop(self):
+        """Stops notifying the observers. A private scheduler is stopped as well, making run() return."""
 
+        self._stopped = True
+        if self.job is not None:
+            self.job.cancel()
+        if self._owns_scheduler and self.scheduler is not None:
+            self.scheduler.stop()
 
-class Timer(Observable):
+
+class Timer(_ScheduledEvent):
     """A Timer object notifies all interested clients periodically, in the specified intervals."""
 
-    def __init__(self, interval):
+    def __init__(self, interval, scheduler: Scheduler = None):
         """Args:
-            - interval: int :: Defines the period of busy-waiting in seconds. After `interval` seconds
-                               the observers get notified.
+            - interval: int :: Defines the period in seconds. Every `interval` seconds the observers get notified.
+            - scheduler: Scheduler :: A scheduler shared with other events. If omitted, the timer runs on its own.
         """
-        super().__init__()
         self.interval = interval
+        super().__init__(scheduler)
 
-    def run(self):
-        """Repeatedly, busy-waits for the desired amount of time and then notifies the observers"""
+    def _arm(self):
+        # Deadlines are absolute, so the time spent on each notify() does not push the next one later. If a notify()
+        # takes longer than the interval, the next one takes place immediately.
+        self.job = self.scheduler.call_every(self.interval, self._tick)
 
-        last_call = time.time()
-        while True:
+    def _tick(self):
+        self.notify(time=time.time())
 
-            # busy_time denotes the amount of time spent on the last notify()
-            # If that time is greater than the defined interval, there is no need to wait any longer: notify immediately
-            # Otherwise, wait for as long as needed until the defined interval has actually passed
-            busy_time = time.time() - last_call
-            if busy_time < self.interval:
-                time.sleep(self.interval - busy_time)
-            last_call = time.time()
-            self.notify(time=time.time())
 
+class DateChange(_ScheduledEvent, Observer):
+    """A DateChange object notifies all interested clients when the date has changed. Instead of polling, it sleeps
+    until the next midnight, as computed from the wall clock.
 
-class DateChange(Observable, Observer):
-    """A DateChange object notifies all interested clients periodically when the date has changed. In order to achieve
-    this, DateChange observes a Timer that defines when the checks will take place."""
+    The scheduler waits on the monotonic clock, so an adjustment of the wall clock (or a suspend) would move midnight
+    away from the deadline. To catch that, a Timer (`self.timer`) compares the two clocks every `check_interval`
+    seconds, and the deadline is re-computed whenever they have drifted apart. The date itself is only checked at the
+    deadline, or right after such an adjustment.
+    """
 
-    def __init__(self, check_interval: int = 60, initial_date: date = None):
-        self.timer = Timer(check_interval)
+    def __init__(self, check_interval: int = 60, initial_date: date = None, scheduler: Scheduler = None):
+        """check_interval -- How often (in seconds) the wall clock is compared against the monotonic one. If it is None,
+                             adjustments of the wall clock are not looked for.
+        initial_date -- The date considered current. If it is not today's date, observers are notified right away.
+        scheduler -- A scheduler shared with other events. If omitted, the event runs on its own.
+        """
+        self.check_interval = check_interval
         self.current_date = initial_date
-        Observable.__init__(self)
-        Observer.__init__(self, self.timer)
+        self.timer = None
+        self._clock_offset = None
+        super().__init__(scheduler)
 
-    def on_notify(self, *args, **kwargs):
+    def _seconds_to_midnight(self) -> float:
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return (midnight - now).total_seconds() + _MIDNIGHT_MARGIN
+
+    def _arm(self):
+        self._schedule(0 if date.today() != self.current_date else self._seconds_to_midnight())
+
+        if self.check_interval and (self.timer is None or self.timer.job.cancelled):
+            self.timer = Timer(self.check_interval, scheduler=self.scheduler)
+            self.timer.register(self)
+
+    def _schedule(self, delay: float):
+        self._clock_offset = _clock_offset()
+        self.job = self.scheduler.call_later(delay, self._check)
+
+    def _check(self):
         today = date.today()
-        if today != self.current_date:
-            yesterday = self.current_date
-            self.current_date = today
-            self.notify(date=yesterday)
+        try:
+            if today != self.current_date:
+                yesterday = self.current_date
+                self.current_date = today
+                self.notify(date=yesterday)
+        finally:
+            # The next midnight is waited for even if an observer fails
+            if not self._stopped:
+                self._schedule(self._seconds_to_midnight())
 
-    def run(self):
-        self.timer.run()
+    def on_notify(self, *args, **kwargs):
+        """Called by `self.timer`. If the wall clock was adjusted since the deadline was computed, the date is checked
+        right away and the deadline is re-computed."""
+
+        if self._stopped or abs(_clock_offset() - self._clock_offset) <= _CLOCK_DRIFT_TOLERANCE:
+            return
+
+        self.job.cancel()
+        self._check()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+        super().stop()
+
+
+def _clock_offset() -> float:
+    """Returns the offset of the wall clock from the monotonic one. It only changes if the wall clock is adjusted."""
+
+    return time.time() - time.monotonic()
@@ -0,0 +1,173 @@
+"""An observable event driven by the `_changes` feed of the database"""
+
+import os
+import threading
+
+from . import Observable
+from .. import dotfiles
+from ..jsonstream import dumps
+from ..jsonstream import loads
+
+_FEEDS = ("continuous", "longpoll")
+
+
+class ChangesFeed(Observable):
+    """A ChangesFeed object notifies all interested clients whenever a document of the database is created, updated or
+    deleted, as reported by the `_changes` feed of CouchDB. Unlike polling with a Timer, a single long-lived request is
+    kept open and observers are notified as soon as a change is committed.
+
+    The sequence of the last processed change is persisted (as a checkpoint) after the observers have been notified, so
+    that a restarted feed resumes right after it, without reprocessing any change.
+
+    Depending on `feed`, observers are notified in one of two ways:
+        - "continuous": once per change, as `on_notify(change=...)`
+        - "longpoll": once per batch of changes, as `on_notify(changes=[...], last_seq=...)`
+    Each change is the raw row of the feed, e.g. {"seq": ..., "id": ..., "changes": [{"rev": ...}], "deleted": True}.
+    Design documents are never reported.
+    """
+
+    def __init__(self, adapter, *, feed: str = "continuous", since="now", include_docs: bool = False,
+                 checkpoint: str = None, heartbeat: float = 10, timeout: float = 60, retry_interval: float = 5):
+        """adapter -- The CouchDBAdapter whose database should be followed
+        feed -- Either "continuous" or "longpoll"
+        since -- The sequence to start from if there is no checkpoint yet: "now", 0 or an actual sequence
+        include_docs -- If set, every change carries the whole changed document under "doc"
+        checkpoint -- The file the last processed sequence is persisted to. If omitted, a file in the dot-dir is used.
+        heartbeat -- Seconds between the keep-alive newlines the server sends on an idle continuous feed
+        timeout -- Seconds after which the server ends an idle request. A new one is made right away.
+        retry_interval -- Seconds to wait before reconnecting after a failed request
+        """
+
+        super().__init__()
+
+        if feed not in _FEEDS:
+            raise ValueError(f"Unknown feed: {feed}")
+
+        if not checkpoint:
+            dotfiles.init_dot_dir()
+            checkpoint = os.path.join(dotfiles.DOT_DIR_PATH, f"changes-{adapter.db}.seq")
+
+        self.adapter = adapter
+        self.feed = feed
+        self.include_docs = include_docs
+        self.checkpoint = checkpoint
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+
+        self.since = self._load_checkpoint()
+        if self.since is None:
+            self.since = since
+
+        self.last_error = None
+        self._stop = threading.Event()
+        self._response = None
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint, "rb") as f_in:
+                return loads(f_in.read())["since"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_checkpoint(self, since):
+        """Atomically replaces the checkpoint, so that a crash never leaves a half-written file behind."""
+
+        self.since = since
+
+        tmp_path = f"{self.checkpoint}.tmp"
+        with open(tmp_path, "wb") as f_out:
+            f_out.write(dumps({"since": since}))
+        os.replace(tmp_path, self.checkpoint)
+
+    def _params(self) -> dict:
+        params = {"feed": self.feed,
+                  "since": self.since,
+                  "timeout": int(self.timeout * 1000)}
+        if self.feed == "continuous":
+            params["heartbeat"] = int(self.heartbeat * 1000)
+        if self.include_docs:
+            params["include_docs"] = "true"
+        return params
+
+    @staticmethod
+    def _is_design(change: dict) -> bool:
+        return change.get("id", "").startswith("_design/")
+
+    def _follow_continuous(self, res):
+        for line in res.iter_lines():
+            if self._stop.is_set():
+                return
+            if not line:  # Heartbeat
+                continue
+
+            change = loads(line)
+            if "last_seq" in change:  # The server ended the feed after `timeout`
+                self._save_checkpoint(change["last_seq"])
+                return
+
+            if not self._is_design(change):
+                self.notify(change=change)
+            self._save_checkpoint(change["seq"])
+
+    def _follow_longpoll(self, res):
+        data = loads(res.content)
+        changes = [change for change in data.get("results", []) if not self._is_design(change)]
+
+        if changes:
+            self.notify(changes=changes, last_seq=data["last_seq"])
+        self._save_checkpoint(data["last_seq"])
+
+    def poll(self) -> bool:
+        """Makes a single request to the feed and notifies the observers about every change it reports. A continuous
+        feed is followed until the server ends it or the feed is stopped.
+        Returns True if the request succeeded.
+        """
+
+        transport = self.adapter.transport
+        connect_timeout, read_timeout = transport.timeout
+        wait = self.heartbeat if self.feed == "continuous" else self.timeout
+
+        try:
+            # Sequences are only meaningful to the server that issued them, so the feed is always read off the primary
+            res = transport.get(f"/{self.adapter.db}/_changes", params=self._params(), stream=True, read=False,
+                                timeout=(connect_timeout, wait + read_timeout))
+            self._response = res
+            with res:
+                if not res.ok:
+                    self.last_error = RuntimeError(f"_changes request failed with status {res.status_code}")
+                    return False
+
+                if self.feed == "continuous":
+                    self._follow_continuous(res)
+                else:
+                    self._follow_longpoll(res)
+        except Exception as e:  # The feed must outlive any failure of the network or the database
+            if self._stop.is_set():
+                return True
+            self.last_error = e
+            return False
+        finally:
+            self._response = None
+
+        return True
+
+    def run(self):
+        """Follows the feed until stop() is called, reconnecting after any failure."""
+
+        self._stop.clear()
+        while not self._stop.is_set():
+            if not self.poll():
+                self._stop.wait(self.retry_interval)
+
+    def stop(self):
+        """Makes run() return as soon as possible. It may be called from any thread, including from an observer."""
+
+        self._stop.set()
+
+        res = self._response
+        if res is not None:
+            try:
+                res.close()
+            except Exception:  # Closing a response that is being read from another thread may fail in many ways
+                pass
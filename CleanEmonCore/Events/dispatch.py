@@ -0,0 +1,310 @@
+"""Delivery of notifications from an Observable to its observers, either inline or concurrently"""
+
+import inspect
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from typing import Dict
+
+if TYPE_CHECKING:
+    import asyncio
+
+# Dispatch modes
+INLINE = "inline"  # Observers are called one after the other, on the thread that calls notify()
+THREAD = "thread"  # Observers are called on a pool of threads
+PROCESS = "process"  # Observers are called on a pool of processes. Observers and arguments must be picklable.
+ASYNCIO = "asyncio"  # Observers are called on an asyncio loop. Coroutine on_notify methods are awaited.
+
+# Overflow policies, applied when the queue of an observer is full
+DROP_OLDEST = "drop_oldest"  # The oldest pending notification is discarded
+COALESCE = "coalesce"  # Every pending notification is discarded in favor of the newest one
+BLOCK = "block"  # notify() waits until there is room in the queue (but drops the oldest on the asyncio loop itself)
+
+_MODES = (INLINE, THREAD, PROCESS, ASYNCIO)
+_POLICIES = (DROP_OLDEST, COALESCE, BLOCK)
+
+
+def _call(observer, args, kwargs):
+    """Calls the observer. It lives at module level, so that it can be sent to a process pool."""
+
+    return observer.on_notify(*args, **kwargs)
+
+
+class _Channel:
+    """The queue of pending notifications of a single observer, along with its accounting. Notifications of the same
+    observer are always delivered one at a time and in order, even if different observers are served concurrently.
+    """
+
+    def __init__(self, observer, dispatcher: "Dispatcher"):
+        self.observer = observer
+        self.dispatcher = dispatcher
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.scheduled = False
+
+        self.delivered = 0
+        self.errors = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_error = None
+
+    def put(self, args: tuple, kwargs: dict):
+        """Enqueues a notification, applying the overflow policy if the queue is full, and schedules the observer."""
+
+        dispatcher = self.dispatcher
+
+        overflow = dispatcher.overflow
+        if overflow == BLOCK and dispatcher.on_loop_thread():
+            # Blocking would deadlock, since the loop that drains the queue is the one that waits
+            overflow = DROP_OLDEST
+
+        with self.cond:
+            if len(self.queue) >= dispatcher.queue_size:
+                if overflow == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif overflow == COALESCE:
+                    self.coalesced += len(self.queue)
+                    self.queue.clear()
+                else:
+                    while len(self.queue) >= dispatcher.queue_size and not dispatcher.closed:
+                        self.cond.wait()
+
+            self.queue.append((time.perf_counter(), args, kwargs))
+
+            schedule = not self.scheduled
+            self.scheduled = True
+
+        if schedule:
+            dispatcher.schedule(self)
+
+    def _next(self):
+        """Pops the next pending notification, or returns None (and unschedules the observer) if there is none."""
+
+        with self.cond:
+            self.cond.notify_all()
+            if not self.queue:
+                self.scheduled = False
+                return None
+            return self.queue.popleft()
+
+    def record(self, enqueued: float, error: Exception = None):
+        latency = time.perf_counter() - enqueued
+
+        with self.cond:
+            self.delivered += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if error is not None:
+                self.errors += 1
+                self.last_error = error
+
+    def drain(self):
+        """Delivers pending notifications until the queue is empty. Runs on a worker thread."""
+
+        while True:
+            item = self._next()
+            if item is None:
+                return
+
+            enqueued, args, kwargs = item
+            error = None
+            try:
+                self.dispatcher.invoke(self.observer, args, kwargs)
+            except Exception as e:  # An observer must never break the delivery to the rest
+                error = e
+            self.record(enqueued, error)
+
+    async def drain_async(self):
+        """Delivers pending notifications until the queue is empty. Runs on the asyncio loop."""
+
+        while True:
+            item = self._next()
+            if item is None:
+                return
+
+            enqueued, args, kwargs = item
+            error = None
+            try:
+                result = self.observer.on_notify(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:  # An observer must never break the delivery to the rest
+                error = e
+            self.record(enqueued, error)
+
+    def wait_idle(self, deadline: float = None) -> bool:
+        with self.cond:
+            while self.scheduled or self.queue:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, object]:
+        with self.cond:
+            return {"pending": len(self.queue),
+                    "delivered": self.delivered,
+                    "errors": self.errors,
+                    "dropped": self.dropped,
+                    "coalesced": self.coalesced,
+                    "mean_latency": self.total_latency / self.delivered if self.delivered else 0.0,
+                    "max_latency": self.max_latency,
+                    "last_error": self.last_error}
+
+
+class Dispatcher:
+    """Delivers the notifications of an Observable according to a dispatch mode. Apart from the inline mode, every
+    observer gets its own bounded queue, so that a slow observer delays neither the others nor the caller of notify().
+    """
+
+    def __init__(self, mode: str = INLINE, *, queue_size: int = 64, overflow: str = BLOCK, workers: int = None,
+                 loop: "asyncio.AbstractEventLoop" = None, isolate: bool = False):
+        """mode -- One of INLINE, THREAD, PROCESS or ASYNCIO
+        queue_size -- The maximum number of pending notifications per observer. Unused in the inline mode.
+        overflow -- What to do when the queue of an observer is full: DROP_OLDEST, COALESCE or BLOCK. In the asyncio
+        mode, BLOCK falls back to DROP_OLDEST whenever notify() is called from the loop itself.
+        workers -- The size of the thread or process pool. If omitted, the defaults of concurrent.futures are used.
+        loop -- The asyncio loop to deliver on, in the asyncio mode. If omitted, a new loop is run on its own thread.
+        isolate -- In the inline mode, whether exceptions raised by observers are recorded and swallowed, rather than
+        propagated to the caller of notify(). In any other mode, exceptions are always recorded and swallowed.
+        """
+
+        if mode not in _MODES:
+            raise ValueError(f"Unknown dispatch mode: {mode}")
+        if overflow not in _POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        if queue_size < 1:
+            raise ValueError("queue_size must be positive")
+
+        self.mode = mode
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.isolate = isolate
+        self.closed = False
+
+        self._channels = {}
+        self._channels_lock = threading.Lock()
+
+        self._drainers = None
+        self._processes = None
+        self._loop = loop
+        self._loop_thread = None
+
+        if mode in (THREAD, PROCESS):
+            # In the process mode, each observer is still drained by a thread, which waits for the pool to run it
+            self._drainers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Observable")
+        if mode == PROCESS:
+            from concurrent.futures import ProcessPoolExecutor
+
+            self._processes = ProcessPoolExecutor(max_workers=workers)
+        if mode == ASYNCIO and loop is None:
+            import asyncio
+
+            self._loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(target=self._loop.run_forever, name="Observable", daemon=True)
+            self._loop_thread.start()
+
+    def _channel(self, observer) -> _Channel:
+        with self._channels_lock:
+            channel = self._channels.get(id(observer))
+            if channel is None or channel.observer is not observer:
+                channel = self._channels[id(observer)] = _Channel(observer, self)
+            return channel
+
+    def deliver(self, observers: list, args: tuple, kwargs: dict):
+        """Delivers a notification to each of the given observers."""
+
+        if self.closed:
+            raise RuntimeError("Cannot notify through a closed dispatcher")
+
+        if self.mode != INLINE:
+            for observer in observers:
+                self._channel(observer).put(args, kwargs)
+            return
+
+        for observer in observers:
+            channel = self._channel(observer)
+            enqueued = time.perf_counter()
+            try:
+                observer.on_notify(*args, **kwargs)
+            except Exception as e:
+                channel.record(enqueued, e)
+                if not self.isolate:
+                    raise
+            else:
+                channel.record(enqueued)
+
+    def on_loop_thread(self) -> bool:
+        """Returns True if the caller runs on the loop that delivers the notifications, in the asyncio mode."""
+
+        if self.mode != ASYNCIO:
+            return False
+        if self._loop_thread is not None:
+            return threading.current_thread() is self._loop_thread
+
+        import asyncio
+
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:  # No loop runs on this thread
+            return False
+
+    def schedule(self, channel: _Channel):
+        if self.mode == ASYNCIO:
+            import asyncio
+
+            asyncio.run_coroutine_threadsafe(channel.drain_async(), self._loop)
+        else:
+            self._drainers.submit(channel.drain)
+
+    def invoke(self, observer, args: tuple, kwargs: dict):
+        if self._processes is not None:
+            return self._processes.submit(_call, observer, args, kwargs).result()
+        return _call(observer, args, kwargs)
+
+    def join(self, timeout: float = None) -> bool:
+        """Waits until every pending notification has been delivered.
+        Returns False if `timeout` seconds passed first.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._channels_lock:
+            channels = list(self._channels.values())
+
+        return all(channel.wait_idle(deadline) for channel in channels)
+
+    def stats(self) -> Dict[object, Dict[str, object]]:
+        with self._channels_lock:
+            channels = list(self._channels.values())
+
+        return {channel.observer: channel.stats() for channel in channels}
+
+    def close(self, *, wait: bool = True):
+        """Stops accepting notifications and releases the pools. Pending notifications are delivered first, if `wait`
+        is set."""
+
+        if wait:
+            self.join()
+        self.closed = True
+
+        with self._channels_lock:
+            channels = list(self._channels.values())
+        for channel in channels:
+            with channel.cond:
+                channel.cond.notify_all()
+
+        if self._drainers is not None:
+            self._drainers.shutdown(wait=wait)
+        if self._processes is not None:
+            self._processes.shutdown(wait=wait)
+        if self._loop_thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
@@ -3,12 +3,29 @@
 from abc import ABC
 from abc import abstractmethod
 
+from .dispatch import Dispatcher
+from .dispatch import INLINE
+
 
 class Observable:
     """Base class for any event generator that would like to massively notify interested observers"""
 
     def __init__(self):
         self.observers = []
+        self.dispatcher = Dispatcher()
+
+    def set_dispatch(self, mode: str = INLINE, **kwargs):
+        """Changes the way observers are notified. By default, they are called inline, one after the other. See
+        Dispatcher for the available modes and options, e.g.:
+
+            timer.set_dispatch(THREAD, queue_size=16, overflow=DROP_OLDEST)
+
+        Pending notifications of the previous dispatcher are delivered before it is replaced.
+        """
+
+        previous = self.dispatcher
+        self.dispatcher = Dispatcher(mode, **kwargs)
+        previous.close()
 
     def register(self, observer):
         """Register an observer to the current observable object
@@ -22,8 +39,24 @@ class Observable:
     def notify(self, *args, **kwargs):
         """Notify all interested (registered) observers"""
 
-        for observer in self.observers:
-            observer.on_notify(*args, **kwargs)
+        self.dispatcher.deliver(self.observers, args, kwargs)
+
+    def observer_stats(self) -> dict:
+        """Returns the delivery counters and latencies (in seconds) of each observer, keyed by observer."""
+
+        return self.dispatcher.stats()
+
+    def join(self, timeout: float = None) -> bool:
+        """Waits until every pending notification has been delivered.
+        Returns False if `timeout` seconds passed first.
+        """
+
+        return self.dispatcher.join(timeout)
+
+    def close(self):
+        """Delivers any pending notification and releases the resources of the dispatcher."""
+
+        self.dispatcher.close()
 
 
 class Observer(ABC):
@@ -0,0 +1,219 @@
+"""A single-threaded scheduler that multiplexes any number of timed jobs"""
+
+import heapq
+import inspect
+import itertools
+import logging
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """A call scheduled on a Scheduler. Periodic jobs are re-armed after each run, one `interval` after their previous
+    deadline, so that they never drift, no matter how long each run takes."""
+
+    def __init__(self, scheduler: "Scheduler", fn: Callable, deadline: float, interval: float = None):
+        self.scheduler = scheduler
+        self.fn = fn
+        self.deadline = deadline
+        self.interval = interval
+        self.cancelled = False
+        self.runs = 0
+        self.errors = 0
+        self.last_error = None
+        self.max_lateness = 0.0  # The longest a run started after its deadline, in seconds
+
+    def cancel(self):
+        """Prevents any further run of the job."""
+
+        self.cancelled = True
+        self.scheduler.wake()
+
+
+class Scheduler:
+    """Runs jobs at their deadlines, on a single thread (or asyncio task). The deadlines are kept in a heap and are
+    measured with the monotonic clock, so adjustments of the wall clock affect neither the waits nor the periods.
+
+    Jobs run one at a time, on the thread that calls run(). An exception raised by a job is logged and recorded on the
+    job (see Job.errors), and the job is re-armed as usual, so that a single failing job does not stop the rest of the
+    jobs multiplexed on the same thread.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()  # Breaks ties between equal deadlines, in scheduling order
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self._loop = None
+        self._async_wakeup = None
+
+    def __len__(self):
+        with self._cond:
+            return sum(1 for _, _, job in self._heap if not job.cancelled)
+
+    def call_at(self, deadline: float, fn: Callable, *, interval: float = None) -> Job:
+        """Schedules `fn` to be called (with no arguments) at `deadline`, as measured by time.monotonic().
+        If `interval` is given, `fn` is called again every `interval` seconds thereafter.
+        Returns the scheduled Job, which can be cancelled.
+        """
+
+        job = Job(self, fn, deadline, interval)
+        self._push(job)
+        return job
+
+    def call_later(self, delay: float, fn: Callable) -> Job:
+        """Schedules `fn` to be called once, `delay` seconds from now."""
+
+        return self.call_at(time.monotonic() + delay, fn)
+
+    def call_every(self, interval: float, fn: Callable, *, first: float = None) -> Job:
+        """Schedules `fn` to be called every `interval` seconds.
+
+        first -- Seconds until the first call. If omitted, the first call takes place one `interval` from now.
+        """
+
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+
+        first = interval if first is None else first
+        return self.call_at(time.monotonic() + first, fn, interval=interval)
+
+    def _push(self, job: Job):
+        with self._cond:
+            heapq.heappush(self._heap, (job.deadline, next(self._counter), job))
+        self.wake()
+
+    def wake(self):
+        """Makes the scheduler re-examine its deadlines. Needed only after a job is altered externally."""
+
+        with self._cond:
+            self._cond.notify_all()
+
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._async_wakeup.set)
+            except RuntimeError:  # The loop has already been closed
+                pass
+
+    def _next_due(self):
+        """Pops the next due job. Returns (job, None), or (None, seconds until the next deadline) if no job is due yet.
+        The wait is None if there are no jobs at all."""
+
+        while self._heap:
+            deadline, _, job = self._heap[0]
+            if job.cancelled:
+                heapq.heappop(self._heap)
+                continue
+
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                return None, wait
+
+            heapq.heappop(self._heap)
+            return job, None
+
+        return None, None
+
+    @staticmethod
+    def _failed(job: Job, error: Exception):
+        job.errors += 1
+        job.last_error = error
+        logger.exception("Scheduled job %r failed", job.fn)
+
+    def _rearm(self, job: Job, started: float):
+        job.runs += 1
+        job.max_lateness = max(job.max_lateness, started - job.deadline)
+
+        if job.interval is None or job.cancelled:
+            return
+
+        # If the job overran its period, it runs again right away, without trying to catch up on the missed runs
+        job.deadline = max(job.deadline + job.interval, time.monotonic())
+        self._push(job)
+
+    def run(self):
+        """Runs jobs as they become due, until stop() is called."""
+
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        if self._stopping:
+                            return
+                        job, wait = self._next_due()
+                        if job is not None:
+                            break
+                        self._cond.wait(wait)
+
+                started = time.monotonic()
+                try:
+                    job.fn()
+                except Exception as e:  # A job must never stop the rest
+                    self._failed(job, e)
+                self._rearm(job, started)
+        finally:
+            with self._cond:
+                self._stopping = False
+
+    async def run_async(self):
+        """Runs jobs as they become due on the running asyncio loop, until stop() is called. Jobs may be coroutine
+        functions, in which case they are awaited."""
+
+        import asyncio
+
+        self._loop = asyncio.get_running_loop()
+        self._async_wakeup = asyncio.Event()
+
+        try:
+            while True:
+                with self._cond:
+                    if self._stopping:
+                        return
+                    job, wait = self._next_due()
+
+                if job is None:
+                    self._async_wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._async_wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                started = time.monotonic()
+                try:
+                    result = job.fn()
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:  # A job must never stop the rest
+                    self._failed(job, e)
+                self._rearm(job, started)
+        finally:
+            self._loop = None
+            self._async_wakeup = None
+            with self._cond:
+                self._stopping = False
+
+    def start(self) -> "Scheduler":
+        """Runs the scheduler on a background (daemon) thread."""
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, name="Scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Makes run() return as soon as the running job (if any) completes, or right away if it is called before run().
+        It may be called from any thread, including from a job."""
+
+        with self._cond:
+            self._stopping = True
+        self.wake()
+
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+            self._thread = None
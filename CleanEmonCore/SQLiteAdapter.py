@@ -0,0 +1,413 @@
+"""Embedded storage module, backed by a local SQLite file"""
+
+import configparser
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+
+from . import dotfiles
+from .config import load_config
+from .jsonstream import dumps
+from .jsonstream import loads
+from .models import EnergyData
+from .models import TIMESTAMP_FIELD
+from .models import _timestamp_of
+from .models import merge_readings
+from .rollups import DAY
+from .rollups import Rollup
+from .rollups import aggregate
+from .rollups import bucket_of
+from .storage import StorageBackend
+
+_DB_FILENAME = "CleanEmon.sqlite"
+
+_SCHEMA = (
+    # Every field of a document but its readings is kept in `body`. The date is copied out, to be indexed.
+    "CREATE TABLE IF NOT EXISTS documents ("
+    "id TEXT PRIMARY KEY, "
+    "date TEXT NOT NULL DEFAULT '', "
+    "body BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS documents_date ON documents (date, id)",
+
+    # One row per reading. Rows are kept in insertion order, which is the order readings are returned in.
+    "CREATE TABLE IF NOT EXISTS readings ("
+    "id INTEGER PRIMARY KEY, "
+    "document TEXT NOT NULL, "
+    "date TEXT NOT NULL, "
+    "timestamp, "
+    "reading BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS readings_date_timestamp ON readings (date, timestamp)",
+    "CREATE INDEX IF NOT EXISTS readings_document ON readings (document, id)",
+    "CREATE INDEX IF NOT EXISTS readings_timestamp ON readings (timestamp)",
+
+    # The ids of the batches appended to each document, so that re-sent batches are ignored
+    "CREATE TABLE IF NOT EXISTS applied_batches ("
+    "document TEXT NOT NULL, "
+    "batch TEXT NOT NULL, "
+    "PRIMARY KEY (document, batch))",
+
+    # Companion rollups of the readings, per resolution, field and bucket. They are kept up to date by every write.
+    "CREATE TABLE IF NOT EXISTS rollups ("
+    "resolution INTEGER NOT NULL, "
+    "field TEXT NOT NULL, "
+    "bucket INTEGER NOT NULL, "
+    "count INTEGER NOT NULL, "
+    "sum REAL NOT NULL, "
+    "min REAL NOT NULL, "
+    "max REAL NOT NULL, "
+    "PRIMARY KEY (resolution, field, bucket))",
+    "CREATE INDEX IF NOT EXISTS rollups_bucket ON rollups (bucket)",
+)
+
+
+class SQLiteAdapter(StorageBackend):
+    """Embedded storage backend, for gateways that cannot reach (or run) a CouchDB server.
+
+    Documents live in a single SQLite file (in WAL mode). Unlike in CouchDB, the readings of a document are stored as
+    rows of their own, indexed by (date, timestamp): appending costs a single insert per reading, no matter how large
+    the document already is, and time ranges are read through the index.
+    """
+
+    def __init__(self, config_file: str = None, *, path: str = None):
+        """config_file -- A config file whose [DB] section may define `sqlite_path` and `document_name`
+        path -- The SQLite file to use. It overrides the config file. If neither defines one, a file in the dot-dir is
+        used.
+        """
+
+        cfg = load_config(config_file) if config_file else configparser.ConfigParser(interpolation=None)
+
+        self.document = cfg.get("DB", "document_name", fallback="")
+        self.path = path or cfg.get("DB", "sqlite_path", fallback="")
+        if not self.path:
+            dotfiles.init_dot_dir()
+            self.path = os.path.join(dotfiles.DOT_DIR_PATH, _DB_FILENAME)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            missing_rollups = self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                                 "AND name = 'rollups'").fetchone() is None
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+
+            # Files created before rollups existed get theirs built once
+            if missing_rollups:
+                self._rebuild_rollups()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Primitives, to be called while holding the lock ---
+
+    def _exists(self, name: str) -> bool:
+        return self._conn.execute("SELECT 1 FROM documents WHERE id = ?", (name,)).fetchone() is not None
+
+    def _insert_document(self, name: str, body: dict, readings: List[dict]):
+        body = {key: value for key, value in body.items() if key != "energy_data"}
+        date = body.get("date") or ""
+
+        self._conn.execute("INSERT INTO documents (id, date, body) VALUES (?, ?, ?)", (name, date, dumps(body)))
+        self._insert_readings(name, date, readings)
+
+    def _insert_readings(self, name: str, date: str, readings: List[dict], *, add_to_rollups: bool = True):
+        self._conn.executemany("INSERT INTO readings (document, date, timestamp, reading) VALUES (?, ?, ?, ?)",
+                               [(name, date, reading.get(TIMESTAMP_FIELD), dumps(reading)) for reading in readings])
+        if add_to_rollups:
+            self._add_to_rollups(readings)
+
+    def _merge_readings(self, name: str, date: str, readings: List[dict]):
+        """Adds readings to a document, keeping them sorted by timestamp and unique per timestamp, as
+        `models.merge_readings` does. A batch that starts after the last stored reading is simply inserted. Otherwise,
+        only the stored readings from the first incoming timestamp onwards are merged with it and written anew, along
+        with any stored reading without a timestamp, so that those stay last.
+        """
+
+        incoming = merge_readings([], readings)
+        first = _timestamp_of(incoming[0]) if incoming else None
+
+        tail = []
+        if first is not None:
+            # Everything but the readings with a finite timestamp before the batch (9e999 is infinity to SQLite)
+            tail = self._conn.execute("SELECT id, reading FROM readings WHERE document = ? "
+                                      "AND NOT (typeof(timestamp) IN ('integer', 'real') "
+                                      "AND timestamp < ? AND timestamp > -9e999) ORDER BY id",
+                                      (name, first)).fetchall()
+        if not tail:
+            self._insert_readings(name, date, incoming)
+            return
+
+        self._conn.executemany("DELETE FROM readings WHERE id = ?", [(row_id,) for row_id, _ in tail])
+        merged = merge_readings([loads(reading) for _, reading in tail], incoming)
+        self._insert_readings(name, date, merged, add_to_rollups=False)
+
+        # Replaced readings cannot be subtracted from the rollups, so their days are recomputed
+        self._rebuild_rollups(reading.get(TIMESTAMP_FIELD) for reading in merged)
+
+    def _add_to_rollups(self, readings: Iterable[dict]):
+        """Merges the aggregates of the given (new) readings into the stored rollups."""
+
+        self._conn.executemany("INSERT INTO rollups (resolution, field, bucket, count, sum, min, max) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                               "ON CONFLICT (resolution, field, bucket) DO UPDATE SET "
+                               "count = count + excluded.count, "
+                               "sum = sum + excluded.sum, "
+                               "min = MIN(min, excluded.min), "
+                               "max = MAX(max, excluded.max)",
+                               [(resolution, field, bucket, rollup.count, rollup.sum, rollup.min, rollup.max)
+                                for (resolution, field, bucket), rollup in aggregate(readings).items()])
+
+    def _timestamps_of(self, name: str) -> List:
+        return [timestamp for (timestamp,) in
+                self._conn.execute("SELECT timestamp FROM readings WHERE document = ?", (name,))]
+
+    def _rebuild_rollups(self, timestamps: Iterable = None):
+        """Recomputes the rollups of the days of the given timestamps out of the stored readings, or every rollup if no
+        timestamps are given. Removed readings cannot be subtracted from a minimum or a maximum, so this is how the
+        rollups follow deletions. Finer buckets always nest in the buckets of a day, so whole days are recomputed.
+        """
+
+        if timestamps is None:
+            self._conn.execute("DELETE FROM rollups")
+            self._add_to_rollups(loads(reading) for (reading,) in self._conn.execute("SELECT reading FROM readings"))
+            return
+
+        days = {bucket_of(timestamp, DAY) for timestamp in timestamps if type(timestamp) in (int, float)}
+        for day in sorted(days):
+            self._conn.execute("DELETE FROM rollups WHERE bucket >= ? AND bucket < ?", (day, day + DAY))
+            self._add_to_rollups(loads(reading) for (reading,) in
+                                 self._conn.execute("SELECT reading FROM readings WHERE timestamp >= ? "
+                                                    "AND timestamp < ?", (day, day + DAY)).fetchall())
+
+    def _document(self, name: str) -> dict:
+        """Returns the whole document `name`, or an empty dict if there is no such document."""
+
+        row = self._conn.execute("SELECT body FROM documents WHERE id = ?", (name,)).fetchone()
+        if row is None:
+            return {}
+
+        doc = loads(row[0])
+        doc["_id"] = name
+        doc["energy_data"] = [loads(reading) for (reading,) in
+                              self._conn.execute("SELECT reading FROM readings WHERE document = ? ORDER BY id",
+                                                 (name,))]
+        return doc
+
+    def _document_for_date(self, date: str) -> str:
+        # Just like the get_dates view, the lowest id wins if a date is stored in many documents
+        row = self._conn.execute("SELECT id FROM documents WHERE date = ? ORDER BY id LIMIT 1", (date,)).fetchone()
+        return row[0] if row else ""
+
+    @staticmethod
+    def _project(readings: Iterable[dict], fields: List[str] = None) -> Iterator[dict]:
+        """Strips the readings down to the given fields (and the timestamp), if any."""
+
+        if fields is None:
+            yield from readings
+            return
+
+        for reading in readings:
+            yield {field: reading[field] for field in [TIMESTAMP_FIELD, *fields] if field in reading}
+
+    # --- Documents ---
+
+    def create_document(self, name: str = None, *, initial_data: EnergyData = None) -> str:
+        if not name:
+            name = uuid.uuid4().hex
+
+        if not initial_data:
+            initial_data = EnergyData()
+
+        with self._lock, self._conn:
+            if self._exists(name):
+                return ""
+            self._insert_document(name, {"date": initial_data.date}, initial_data.energy_data)
+
+        return name
+
+    def create_raw_document(self, name: str, *, initial_data: Dict = None) -> str:
+        if not name:
+            return ""
+
+        initial_data = initial_data or {}
+
+        with self._lock, self._conn:
+            if self._exists(name):
+                return ""
+            self._insert_document(name, initial_data, initial_data.get("energy_data", []))
+
+        return name
+
+    def delete_document(self, name: str) -> bool:
+        with self._lock, self._conn:
+            if not self._exists(name):
+                return False
+            timestamps = self._timestamps_of(name)
+            self._conn.execute("DELETE FROM documents WHERE id = ?", (name,))
+            self._conn.execute("DELETE FROM readings WHERE document = ?", (name,))
+            self._conn.execute("DELETE FROM applied_batches WHERE document = ?", (name,))
+            self._rebuild_rollups(timestamps)
+
+        return True
+
+    # --- Reading ---
+
+    def fetch_energy_data(self, *, document: str = None) -> EnergyData:
+        """Fetches the default document.
+        Returns its content as a valid EnergyData object. If there is no such document, an empty EnergyData object
+        will be returned.
+
+        Throws:
+        AssertionError -- If no document can be found.
+        """
+
+        if not document:
+            document = self.document
+
+        assert document, "No document was supplied!"
+
+        with self._lock:
+            return EnergyData.from_json(self._document(document))
+
+    def iter_energy_data(self, *, document: str = None, batch_size: int = None, fields: List[str] = None,
+                         start=None, end=None) -> Iterator:
+        """Yields the readings of the default document one by one (or in lists of `batch_size`), optionally keeping
+        only the given fields, and only the readings whose timestamp lies in [start, end).
+
+        Throws:
+        AssertionError -- If no document can be found.
+        """
+
+        if not document:
+            document = self.document
+
+        assert document, "No document was supplied!"
+
+        query = "SELECT reading FROM readings WHERE document = ?"
+        params = [document]
+        if start is not None:
+            query += " AND timestamp >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND timestamp < ?"
+            params.append(end)
+
+        with self._lock:
+            readings = [loads(reading) for (reading,) in self._conn.execute(query + " ORDER BY id", params)]
+
+        readings = list(self._project(readings, fields))
+
+        if not batch_size:
+            yield from readings
+            return
+
+        for i in range(0, len(readings), batch_size):
+            yield readings[i:i + batch_size]
+
+    def get_document_id_for_date(self, date: str) -> str:
+        with self._lock:
+            return self._document_for_date(date)
+
+    def fetch_energy_data_by_date(self, date: str) -> EnergyData:
+        with self._lock:
+            document = self._document_for_date(date)
+            return EnergyData.from_json(self._document(document)) if document else EnergyData()
+
+    def fetch_energy_data_range(self, start: str, end: str) -> Iterator[EnergyData]:
+        with self._lock:
+            documents = [document for (document,) in
+                         self._conn.execute("SELECT MIN(id) FROM documents WHERE date BETWEEN ? AND ? AND date != '' "
+                                            "GROUP BY date ORDER BY date", (start, end))]
+
+        for document in documents:
+            yield self.fetch_energy_data(document=document)
+
+    def fetch_readings(self, start_ts, end_ts, *, fields: List[str] = None) -> Iterator[dict]:
+        """Fetches the readings whose timestamp lies in [start_ts, end_ts), no matter which (date) documents they are
+        stored in. They are looked up through the timestamp index, so the cost depends only on the size of the result.
+        Yields the readings in chronological order.
+
+        fields -- If given, only these fields (and the timestamp) of each reading are kept
+        """
+
+        with self._lock:
+            rows = self._conn.execute("SELECT reading FROM readings WHERE timestamp >= ? AND timestamp < ? "
+                                      "ORDER BY timestamp, document, id", (start_ts, end_ts)).fetchall()
+
+        yield from self._project((loads(reading) for (reading,) in rows), fields)
+
+    def _fetch_rollups(self, field: str, start: int, end: int, resolution: int) -> List[Rollup]:
+        with self._lock:
+            return [Rollup(*row) for row in
+                    self._conn.execute("SELECT bucket, count, sum, min, max FROM rollups WHERE resolution = ? "
+                                       "AND field = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+                                       (resolution, field, start, end))]
+
+    def rebuild_rollups(self):
+        """Recomputes every rollup out of the stored readings."""
+
+        with self._lock, self._conn:
+            self._rebuild_rollups()
+
+    def fetch_meta(self) -> dict:
+        with self._lock:
+            meta = self._document("meta")
+        meta.pop("_id", None)
+        if not meta.get("energy_data"):
+            meta.pop("energy_data", None)
+        return meta
+
+    # --- Writing ---
+
+    def append_energy_data(self, *energy_data_list: EnergyData, document=None, batch_id: str = None) -> bool:
+        """Accepts one or more EnergyData objects and merges their readings into the specified document, which is
+        created if missing. The readings of the document are kept sorted by timestamp and unique per timestamp.
+
+        batch_id -- An optional unique id of this append. Appending again with the same id is a no-op.
+        """
+
+        if not document:
+            document = self.document
+
+        assert document, "No document was supplied!"
+
+        rows = []
+        for energy_data in energy_data_list:
+            rows.extend(energy_data.energy_data)
+
+        with self._lock, self._conn:
+            if batch_id:
+                applied = self._conn.execute("INSERT OR IGNORE INTO applied_batches (document, batch) VALUES (?, ?)",
+                                             (document, batch_id))
+                if not applied.rowcount:
+                    return True
+
+            row = self._conn.execute("SELECT date FROM documents WHERE id = ?", (document,)).fetchone()
+            if row is None:
+                self._insert_document(document, {"date": ""}, merge_readings([], rows))
+            else:
+                self._merge_readings(document, row[0], rows)
+
+        return True
+
+    def update_energy_data_by_date(self, date: str, data: EnergyData) -> bool:
+        if not data:
+            data = EnergyData()
+
+        with self._lock, self._conn:
+            document = self._document_for_date(date)
+            if document:
+                timestamps = self._timestamps_of(document)
+                self._conn.execute("DELETE FROM readings WHERE document = ?", (document,))
+                self._insert_readings(document, date, data.energy_data)
+                self._rebuild_rollups(timestamps)
+                return True
+
+        return bool(self.create_document(initial_data=data))
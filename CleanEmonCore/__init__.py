@@ -1,14 +1,14 @@
 import os
 
-from .dotfiles import get_dotfile
-from .dotfiles import _CONFIG_FILENAME
-
 PACKAGE_DIR = os.path.dirname(__file__)
 
-# Check if config-file lies in directory of execution
-# If not, consider working with the global one
-if os.path.exists(_CONFIG_FILENAME):
-    CONFIG_FILE = os.path.abspath(_CONFIG_FILENAME)
-else:
-    # Retrieve the config file from the dot-dir or generate a new one
-    CONFIG_FILE = get_dotfile(_CONFIG_FILENAME)
+
+def __getattr__(name):
+    # CONFIG_FILE is looked up on first access rather than on import, so that importing the package touches no file
+    if name == "CONFIG_FILE":
+        from .config import find_config_file
+
+        config_file = globals()["CONFIG_FILE"] = find_config_file()
+        return config_file
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
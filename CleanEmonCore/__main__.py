@@ -1,4 +1,8 @@
 import argparse
+import datetime
+import json
+import sys
+
 from .dotfiles import store_external_configfile
 
 parser = argparse.ArgumentParser(prog="CleanEmonCore", description="The CLI for CleanEmon-Core")
@@ -9,7 +13,127 @@ register_config_parser = subparsers.add_parser("register-config", help="Register
                                                                        "CleanEmon")
 register_config_parser.add_argument("config_file", help="path to the config file that will be used")
 
+# Benchmark
+bench_parser = subparsers.add_parser("bench", help="Benchmark the CouchDB adapter against a local fake server and "
+                                                   "print the results as json")
+bench_parser.add_argument("--sizes", type=int, nargs="+", help="numbers of readings per document")
+bench_parser.add_argument("--days", type=int, nargs="+", help="numbers of days fetched at once by range fetches")
+bench_parser.add_argument("--repeat", type=int, help="how many times each operation is timed")
+bench_parser.add_argument("--option", action="append", default=[], metavar="NAME=VALUE",
+                          help="extra [DB] option of the adapter, e.g. encoding=packed (may be repeated)")
+bench_parser.add_argument("--output", help="write the results to this file instead of the standard output")
+bench_parser.add_argument("--baseline", help="results of a previous run; exit with status 1 if any operation got "
+                                             "slower")
+bench_parser.add_argument("--tolerance", type=float,
+                          help="how much slower than the baseline (as a fraction) an operation may get")
+
+# Probe
+# A self-benchmark of the configured database: the printed metrics cover only the fetches made by the command itself,
+# not the requests of any other process. Long-running processes export their own metrics with a Metrics hook.
+probe_parser = subparsers.add_parser("probe", help="Self-benchmark: fetch dates from the configured database and print "
+                                                   "the metrics of these fetches alone in the Prometheus text format")
+probe_parser.add_argument("--config", help="path to the config file to be used instead of the registered one")
+probe_parser.add_argument("--date", action="append", default=[],
+                          help="date (YYYY-MM-DD) to be fetched (may be repeated); defaults to today")
+probe_parser.add_argument("--repeat", type=int, default=1, help="how many times each date is fetched")
+probe_parser.add_argument("--json", action="store_true", help="print the metrics as json instead")
+
+# Export / Import
+export_parser = subparsers.add_parser("export", help="Export the readings of a range of dates to an NDJSON or CSV file")
+export_parser.add_argument("start", help="first date (YYYY-MM-DD) to be exported")
+export_parser.add_argument("end", help="last date (YYYY-MM-DD) to be exported")
+export_parser.add_argument("output", help="the file to be written; .csv files are written as CSV, anything else as "
+                                          "NDJSON")
+export_parser.add_argument("--fields", nargs="+", help="CSV columns after the date and the timestamp; defaults to the "
+                                                       "fields of the first exported days")
+
+import_parser = subparsers.add_parser("import", help="Import the readings of an NDJSON or CSV file written by export, "
+                                                     "replacing those of the same dates")
+import_parser.add_argument("input", help="the file to be read")
+
+for transfer_parser in (export_parser, import_parser):
+    transfer_parser.add_argument("--format", choices=["ndjson", "csv"], help="overrides the format implied by the file "
+                                                                             "extension")
+    transfer_parser.add_argument("--workers", type=int, help="how many batches of days are transferred concurrently")
+    transfer_parser.add_argument("--batch-days", type=int, help="how many days are transferred by a single request")
+    transfer_parser.add_argument("--checkpoint", help="save progress to this file, and resume from it if it exists")
+    transfer_parser.add_argument("--config", help="path to the config file to be used instead of the registered one")
+
 args = parser.parse_args()
 
 if args.command == "register-config":
     store_external_configfile(args.config_file)
+
+elif args.command == "bench":
+    from . import benchmark
+
+    parameters = {name: value for name, value in [("sizes", args.sizes), ("days", args.days), ("repeat", args.repeat)]
+                  if value is not None}
+    options = dict(option.split("=", 1) for option in args.option)
+
+    def report(result):
+        print(f"{result['operation']:>14} doc_size={result['doc_size']:<6} days={result['days']:<3} "
+              f"p50={result['latency_ms']['p50']:.2f}ms p99={result['latency_ms']['p99']:.2f}ms", file=sys.stderr)
+
+    results = benchmark.run(options=options, progress=report, **parameters)
+
+    if args.output:
+        benchmark.save(results, args.output)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        tolerance = benchmark.DEFAULT_TOLERANCE if args.tolerance is None else args.tolerance
+        regressions = benchmark.compare(benchmark.load(args.baseline), results, tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+elif args.command == "probe":
+    from .CouchDBAdapter import CouchDBAdapter
+    from .metrics import Metrics
+
+    if args.config:
+        config_file = args.config
+    else:
+        from . import CONFIG_FILE as config_file
+
+    metrics = Metrics()
+    with CouchDBAdapter(config_file) as adapter:
+        adapter.transport.add_hook(metrics)
+        for date in args.date or [datetime.date.today().isoformat()]:
+            for _ in range(args.repeat):
+                adapter.fetch_energy_data_by_date(date)
+
+    if args.json:
+        print(json.dumps(metrics.snapshot(), indent=2))
+    else:
+        print(metrics.to_prometheus(), end="")
+
+elif args.command in ("export", "import"):
+    from . import transfer
+    from .storage import open_storage
+
+    if args.config:
+        config_file = args.config
+    else:
+        from . import CONFIG_FILE as config_file
+
+    options = {name: value for name, value in [("fmt", args.format), ("workers", args.workers),
+                                               ("batch_days", args.batch_days), ("checkpoint", args.checkpoint)]
+               if value is not None}
+
+    def report(progress):
+        print(f"\r{progress.resumed_days + progress.days} days, {progress.readings} readings "
+              f"({progress.throughput:.0f} readings/s)", end="", file=sys.stderr, flush=True)
+
+    with open_storage(config_file) as storage:
+        if args.command == "export":
+            result = transfer.export_range(storage, args.start, args.end, args.output, fields=args.fields,
+                                           progress=report, **options)
+        else:
+            result = transfer.import_file(storage, args.input, progress=report, **options)
+
+    print(f"\n{args.command.capitalize()}ed {result.days} days ({result.readings} readings) in {result.elapsed:.1f}s"
+          + (f", after resuming from {result.resumed_days} days" if result.resumed_days else ""), file=sys.stderr)
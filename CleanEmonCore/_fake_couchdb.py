@@ -0,0 +1,612 @@
+"""An in-process, in-memory stand-in for the subset of the CouchDB REST API used by CleanEmon.
+
+Design documents are stored verbatim, but their JavaScript functions are never executed. Instead, every function the
+library installs is emulated in Python by name, which is enough to exercise the adapters without a real server.
+"""
+
+import itertools
+import json
+import math
+import threading
+import time
+import uuid
+from datetime import datetime
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+from .codec import PACKED_FIELD
+from .models import merge_readings
+from .protocol import last_timestamp
+from .protocol import packed_span
+from .protocol import split_stale
+
+
+class _Database(dict):
+    """The documents of a database, along with its change log: a list of (seq, doc_id, rev, deleted) tuples."""
+
+    def __init__(self):
+        super().__init__()
+        self.changes = []
+
+
+class FakeCouchDB:
+    """Runs the fake server on a background thread. Use it as a context manager, or call start() and stop()."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.databases = {}
+        self.lock = threading.RLock()
+        self.request_log = []
+        self.pending_conflicts = 0  # The next `pending_conflicts` update-handler calls will fail with a 409
+        self.latency = 0  # Seconds to wait before serving each request
+        self.chunked_requests = 0  # How many requests were received with a chunked body
+        self.in_flight = 0
+        self.max_in_flight = 0  # The highest number of concurrently served requests so far
+        self._rev_counter = itertools.count(1)
+        self.changed = threading.Condition(self.lock)  # Notified whenever any database changes
+
+        handler = type("Handler", (_Handler,), {"couch": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeCouchDB":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def write_config(self, path: str, db_name: str = "test"):
+        """Writes a config file pointing to this server and creates its database."""
+
+        with self.lock:
+            self.databases.setdefault(db_name, _Database())
+
+        with open(path, "w", encoding="utf8") as f_out:
+            f_out.write("[DB]\n"
+                        f"endpoint = {self.url}\n"
+                        f"db_name = {db_name}\n"
+                        "document_name = \n"
+                        "username = admin\n"
+                        "password = admin\n")
+        return path
+
+    def count(self, method: str = None, path_contains: str = "") -> int:
+        """Returns how many logged requests match the given method and path fragment."""
+
+        return sum(1 for m, p in self.request_log
+                   if (method is None or m == method) and path_contains in p)
+
+    # --- Storage primitives ---
+
+    def new_rev(self, doc: dict = None) -> str:
+        generation = 1
+        if doc and "_rev" in doc:
+            generation = int(doc["_rev"].split("-")[0]) + 1
+        return f"{generation}-{next(self._rev_counter):032x}"
+
+    def save(self, db: dict, doc_id: str, doc: dict):
+        """Stores `doc` under `doc_id`, checking its revision. Returns (status, body)."""
+
+        current = db.get(doc_id)
+        if current is not None and doc.get("_rev") != current["_rev"]:
+            return 409, {"error": "conflict", "reason": "Document update conflict."}
+        if current is None and doc.get("_rev"):
+            return 409, {"error": "conflict", "reason": "Document update conflict."}
+
+        doc = dict(doc)
+        doc["_id"] = doc_id
+        doc["_rev"] = self.new_rev(current)
+        db[doc_id] = doc
+        self.record_change(db, doc_id, doc["_rev"])
+        return 201, {"ok": True, "id": doc_id, "rev": doc["_rev"]}
+
+    def delete(self, db: dict, doc_id: str) -> str:
+        """Deletes `doc_id`, which must exist. Returns the revision of the deletion."""
+
+        rev = self.new_rev(db.pop(doc_id))
+        self.record_change(db, doc_id, rev, deleted=True)
+        return rev
+
+    def record_change(self, db: dict, doc_id: str, rev: str, deleted: bool = False):
+        with self.changed:
+            changes = getattr(db, "changes", None)
+            if changes is not None:
+                changes.append((len(changes) + 1, doc_id, rev, deleted))
+            self.changed.notify_all()
+
+    @staticmethod
+    def changes_since(db: dict, since: int, include_docs: bool = False):
+        """Returns the rows of the `_changes` feed after sequence `since`. Only the latest change of each document is
+        reported, just like CouchDB does."""
+
+        latest = {}
+        for seq, doc_id, rev, deleted in getattr(db, "changes", []):
+            if seq > since:
+                latest[doc_id] = (seq, rev, deleted)
+
+        rows = []
+        for doc_id, (seq, rev, deleted) in sorted(latest.items(), key=lambda item: item[1][0]):
+            row = {"seq": f"{seq}-fake", "id": doc_id, "changes": [{"rev": rev}]}
+            if deleted:
+                row["deleted"] = True
+            if include_docs:
+                row["doc"] = {"_id": doc_id, "_rev": rev, "_deleted": True} if deleted else db.get(doc_id)
+            rows.append(row)
+        return rows
+
+    # --- Emulated design functions ---
+
+    @staticmethod
+    def view_get_dates(db: dict):
+        rows = [{"id": doc_id, "key": doc["date"], "value": doc_id}
+                for doc_id, doc in db.items()
+                if not doc_id.startswith("_design/") and "date" in doc]
+        return sorted(rows, key=lambda row: (row["key"], row["id"]))
+
+
+def _collate(rows, params, body_keys):
+    """Applies the key-selection parameters of a view request to already sorted rows."""
+
+    if "key" in params:
+        key = json.loads(params["key"])
+        return [row for row in rows if row["key"] == key]
+
+    keys = body_keys
+    if "keys" in params:
+        keys = json.loads(params["keys"])
+    if keys is not None:
+        return [row for key in keys for row in rows if row["key"] == key]
+
+    descending = params.get("descending") == "true"
+    if descending:
+        rows = list(reversed(rows))
+    start = params.get("startkey", params.get("start_key"))
+    end = params.get("endkey", params.get("end_key"))
+    if start is not None:
+        start = json.loads(start)
+        rows = [row for row in rows if (row["key"] <= start if descending else row["key"] >= start)]
+    if end is not None:
+        end = json.loads(end)
+        rows = [row for row in rows if (row["key"] >= end if descending else row["key"] <= end)]
+        if params.get("inclusive_end") == "false":
+            rows = [row for row in rows if row["key"] != end]
+
+    if "limit" in params:
+        rows = rows[:int(params["limit"])]
+    return rows
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are written separately; don't let delayed ACKs stall them
+    couch = None  # type: FakeCouchDB
+
+    def log_message(self, *args):
+        pass
+
+    # --- Plumbing ---
+
+    def _reply(self, status: int, body=None, headers: dict = None):
+        payload = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                data += self.rfile.read(size)
+                self.rfile.readline()
+            self.couch.chunked_requests += 1
+            return json.loads(data) if data else None
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _dispatch(self):
+        split = urlsplit(self.path)
+        parts = [unquote(part) for part in split.path.split("/") if part]
+        params = dict(parse_qsl(split.query, keep_blank_values=True))
+        body = self._body() if self.command in ("PUT", "POST") else None
+        couch = self.couch
+
+        # Feeds may be kept open for long, so they are served without holding the lock
+        if len(parts) == 2 and parts[1] == "_changes" and self.command == "GET":
+            with couch.lock:
+                couch.request_log.append((self.command, split.path))
+            return self._changes(parts[0], params)
+
+        with couch.lock:
+            couch.in_flight += 1
+            couch.max_in_flight = max(couch.max_in_flight, couch.in_flight)
+
+        try:
+            if couch.latency:
+                time.sleep(couch.latency)
+
+            with couch.lock:
+                couch.request_log.append((self.command, split.path))
+                status, payload, headers = self._route(parts, params, body)
+        finally:
+            with couch.lock:
+                couch.in_flight -= 1
+
+        self._reply(status, payload, headers)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _dispatch
+
+    # --- Routing ---
+
+    def _route(self, parts, params, body):
+        couch = self.couch
+        method = self.command
+
+        if not parts:
+            return 200, {"couchdb": "Welcome", "version": "fake"}, None
+
+        if parts == ["_uuids"]:
+            count = int(params.get("count", 1))
+            return 200, {"uuids": [uuid.uuid4().hex for _ in range(count)]}, None
+
+        db_name, rest = parts[0], parts[1:]
+
+        if not rest:
+            if method == "PUT":
+                if db_name in couch.databases:
+                    return 412, {"error": "file_exists"}, None
+                couch.databases[db_name] = _Database()
+                return 201, {"ok": True}, None
+            if method == "DELETE":
+                if couch.databases.pop(db_name, None) is None:
+                    return 404, {"error": "not_found"}, None
+                return 200, {"ok": True}, None
+            if db_name in couch.databases:
+                return 200, {"db_name": db_name, "doc_count": len(couch.databases[db_name])}, None
+            return 404, {"error": "not_found"}, None
+
+        db = couch.databases.get(db_name)
+        if db is None:
+            return 404, {"error": "not_found", "reason": "Database does not exist."}, None
+
+        if rest == ["_all_docs"]:
+            return self._all_docs(db, params, body)
+
+        if rest == ["_bulk_docs"] and self.command == "POST":
+            return self._bulk_docs(db, body)
+
+        if rest[0] == "_design" and len(rest) > 2:
+            return self._design_function(db, rest[1], rest[2:], params, body)
+
+        doc_id = "/".join(rest)
+        return self._document(db, doc_id, params, body)
+
+    def _document(self, db, doc_id, params, body):
+        couch = self.couch
+        method = self.command
+        current = db.get(doc_id)
+
+        if method in ("GET", "HEAD"):
+            if current is None:
+                return 404, {"error": "not_found", "reason": "missing"}, None
+            etag = f'"{current["_rev"]}"'
+            if self.headers.get("If-None-Match") == etag:
+                return 304, None, {"ETag": etag}
+            return 200, current, {"ETag": etag}
+
+        if method == "PUT":
+            if body is None:
+                return 400, {"error": "bad_request"}, None
+            status, payload = couch.save(db, doc_id, body)
+            return status, payload, None
+
+        if method == "DELETE":
+            if current is None:
+                return 404, {"error": "not_found"}, None
+            if params.get("rev") != current["_rev"]:
+                return 409, {"error": "conflict"}, None
+            rev = couch.delete(db, doc_id)
+            return 200, {"ok": True, "id": doc_id, "rev": rev}, None
+
+        return 405, {"error": "method_not_allowed"}, None
+
+    def _changes(self, db_name, params):
+        couch = self.couch
+        db = couch.databases.get(db_name)
+        if db is None:
+            return self._reply(404, {"error": "not_found", "reason": "Database does not exist."})
+
+        feed = params.get("feed", "normal")
+        include_docs = params.get("include_docs") == "true"
+        timeout = int(params.get("timeout", 60000)) / 1000
+        heartbeat = int(params["heartbeat"]) / 1000 if "heartbeat" in params else timeout
+        deadline = time.monotonic() + timeout
+
+        since = params.get("since", "0")
+        with couch.lock:
+            since = len(db.changes) if since == "now" else int(str(since).split("-")[0])
+
+        def wait_for_changes():
+            with couch.changed:
+                rows = couch.changes_since(db, since, include_docs)
+                if not rows and feed != "normal":
+                    couch.changed.wait(max(0.0, min(heartbeat, deadline - time.monotonic())))
+                    rows = couch.changes_since(db, since, include_docs)
+                return rows
+
+        if feed != "continuous":
+            while True:
+                rows = wait_for_changes()
+                if rows or feed == "normal" or time.monotonic() >= deadline:
+                    break
+            last_seq = rows[-1]["seq"] if rows else f"{since}-fake"
+            return self._reply(200, {"results": rows, "last_seq": last_seq, "pending": 0})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(data: bytes):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        try:
+            while True:
+                rows = wait_for_changes()
+                for row in rows:
+                    send(json.dumps(row).encode() + b"\n")
+                    since = int(row["seq"].split("-")[0])
+                if not rows:
+                    if time.monotonic() >= deadline:
+                        send(json.dumps({"last_seq": f"{since}-fake", "pending": 0}).encode() + b"\n")
+                        send(b"")
+                        return
+                    send(b"\n")
+        except OSError:  # The client went away
+            self.close_connection = True
+
+    def _all_docs(self, db, params, body):
+        include_docs = params.get("include_docs") == "true"
+        keys = (body or {}).get("keys")
+        if "keys" in params:
+            keys = json.loads(params["keys"])
+
+        rows = []
+        if keys is None:
+            rows = [{"id": doc_id, "key": doc_id, "value": {"rev": doc["_rev"]}} for doc_id, doc in sorted(db.items())]
+            rows = _collate(rows, params, None)
+        else:
+            for key in keys:
+                doc = db.get(key)
+                if doc is None:
+                    rows.append({"key": key, "error": "not_found"})
+                else:
+                    rows.append({"id": key, "key": key, "value": {"rev": doc["_rev"]}})
+
+        if include_docs:
+            for row in rows:
+                if "id" in row:
+                    row["doc"] = db[row["id"]]
+
+        return 200, {"total_rows": len(db), "offset": 0, "rows": rows}, None
+
+    def _bulk_docs(self, db, body):
+        results = []
+        for doc in body.get("docs", []):
+            doc_id = doc.get("_id") or uuid.uuid4().hex
+            if doc.get("_deleted"):
+                current = db.get(doc_id)
+                if current is None or current["_rev"] != doc.get("_rev"):
+                    results.append({"id": doc_id, "error": "conflict", "reason": "Document update conflict."})
+                else:
+                    results.append({"ok": True, "id": doc_id, "rev": self.couch.delete(db, doc_id)})
+                continue
+
+            status, payload = self.couch.save(db, doc_id, doc)
+            if status == 201:
+                results.append(payload)
+            else:
+                results.append(dict(payload, id=doc_id))
+
+        return 201, results, None
+
+    def _design_function(self, db, ddoc_name, rest, params, body):
+        ddoc = db.get(f"_design/{ddoc_name}")
+        kind, name = rest[0], rest[1]
+        section = {"_view": "views", "_update": "updates", "_show": "shows"}.get(kind)
+
+        if ddoc is None or section is None or name not in ddoc.get(section, {}):
+            return 404, {"error": "not_found", "reason": "missing_named_function"}, None
+
+        handler = getattr(self, f"_{section}_{name}", None)
+        if handler is None:
+            return 501, {"error": "not_emulated"}, None
+
+        return handler(db, rest[2:], params, body)
+
+    def _views_get_dates(self, db, rest, params, body):
+        rows = self.couch.view_get_dates(db)
+        body_keys = body.get("keys") if body else None
+        rows = _collate(rows, params, body_keys)
+        return 200, {"total_rows": len(db), "offset": 0, "rows": rows}, None
+
+    def _views_by_timestamp(self, db, rest, params, body):
+        rows = [{"id": doc_id, "key": reading["timestamp"], "value": reading}
+                for doc_id, doc in db.items() if not doc.get(PACKED_FIELD)
+                for reading in doc.get("energy_data", [])
+                if isinstance(reading.get("timestamp"), (int, float))]
+        rows.sort(key=lambda row: (row["key"], row["id"]))
+        rows = _collate(rows, params, body.get("keys") if body else None)
+        return 200, {"total_rows": len(rows), "offset": 0, "rows": rows}, None
+
+    def _views_rollups(self, db, rest, params, body):
+        rows = []
+        for doc_id, doc in db.items():
+            if doc.get(PACKED_FIELD):
+                continue
+            for reading in doc.get("energy_data", []):
+                timestamp = reading.get("timestamp")
+                if not isinstance(timestamp, (int, float)):
+                    continue
+                moment = datetime.fromtimestamp(timestamp, timezone.utc)
+                when = [moment.year, moment.month, moment.day, moment.hour, moment.minute]
+                for field, value in reading.items():
+                    if field != "timestamp" and type(value) in (int, float) and math.isfinite(value):
+                        rows.append({"id": doc_id, "key": [field, *when], "value": value})
+        rows.sort(key=lambda row: (row["key"], row["id"]))
+        rows = _collate(rows, params, body.get("keys") if body else None)
+
+        # The built-in _stats reduce function, grouped by the first `group_level` items of the keys
+        level = int(params.get("group_level", 0)) or None
+        groups = {}
+        for row in rows:
+            key = tuple(row["key"][:level]) if level else None
+            value = row["value"]
+            stats = groups.get(key)
+            if stats is None:
+                groups[key] = {"sum": value, "count": 1, "min": value, "max": value, "sumsqr": value * value}
+            else:
+                stats["sum"] += value
+                stats["count"] += 1
+                stats["min"] = min(stats["min"], value)
+                stats["max"] = max(stats["max"], value)
+                stats["sumsqr"] += value * value
+
+        return 200, {"rows": [{"key": list(key) if key is not None else None, "value": stats}
+                              for key, stats in groups.items()]}, None
+
+    def _views_packed_spans(self, db, rest, params, body):
+        rows = []
+        for doc_id, doc in db.items():
+            span = packed_span(doc)
+            if span is not None:
+                rows.append({"id": doc_id, "key": span[0], "value": span[1]})
+        rows.sort(key=lambda row: (row["key"], row["id"]))
+        rows = _collate(rows, params, body.get("keys") if body else None)
+        return 200, {"total_rows": len(rows), "offset": 0, "rows": rows}, None
+
+    def _updates_append(self, db, rest, params, body):
+        if not rest:
+            return 400, {"error": "bad_request", "reason": "missing_id"}, None
+
+        couch = self.couch
+        if couch.pending_conflicts:
+            couch.pending_conflicts -= 1
+            return 409, {"error": "conflict"}, None
+
+        doc_id = "/".join(rest)
+        doc = dict(db.get(doc_id) or {"_id": doc_id, "date": "", "energy_data": []})
+        body = body or {}
+
+        batch_id = body.get("batch_id")
+        if batch_id:
+            applied = doc.get("applied_batches", [])
+            if batch_id in applied:
+                return 200, {"ok": True, "duplicate": True, "count": len(doc.get("energy_data", []))}, None
+            doc["applied_batches"] = (applied + [batch_id])[-64:]
+
+        if doc.get("sealed"):
+            return 409, {"error": "sealed", "reason": "Document was rolled over"}, None
+
+        rows = body.get("energy_data") or []
+        if split_stale(rows, doc.get("floor"))[0]:
+            return 409, {"error": "stale", "floor": doc["floor"], "reason": "Readings belong to an older chunk"}, None
+
+        doc["energy_data"] = merge_readings(doc.get("energy_data") or [], rows)
+
+        status, payload = couch.save(db, doc_id, doc)
+        if status != 201:
+            return status, payload, None
+        return 201, {"ok": True, "count": len(doc["energy_data"])}, {"X-Couch-Update-NewRev": payload["rev"]}
+
+    def _updates_seal(self, db, rest, params, body):
+        doc_id = "/".join(rest)
+        doc = db.get(doc_id)
+        if doc is None:
+            return 404, {"error": "not_found", "reason": "missing"}, None
+
+        payload = {"ok": True, "applied_batches": doc.get("applied_batches", []), "last": last_timestamp(doc)}
+        if doc.get("sealed"):
+            return 200, payload, None
+
+        status, saved = self.couch.save(db, doc_id, dict(doc, sealed=True))
+        if status != 201:
+            return status, saved, None
+        return 201, payload, {"X-Couch-Update-NewRev": saved["rev"]}
+
+    def _updates_add_chunk(self, db, rest, params, body):
+        doc_id = "/".join(rest)
+        doc = db.get(doc_id)
+        if doc is None:
+            return 404, {"error": "not_found", "reason": "missing"}, None
+
+        chunks = list(doc.get("chunks", []))
+        if body["chunk"] in chunks:
+            return 200, {"ok": True, "chunks": chunks}, None
+
+        chunks.append(body["chunk"])
+        status, saved = self.couch.save(db, doc_id, dict(doc, chunks=chunks))
+        if status != 201:
+            return status, saved, None
+        return 201, {"ok": True, "chunks": chunks}, {"X-Couch-Update-NewRev": saved["rev"]}
+
+    def _shows_chunks(self, db, rest, params, body):
+        doc = db.get("/".join(rest))
+        if doc is None:
+            return 404, {"error": "not_found", "reason": "missing"}, None
+        return 200, {"chunks": doc.get("chunks", [])}, None
+
+    def _shows_window(self, db, rest, params, body):
+        doc = db.get("/".join(rest))
+        if doc is None:
+            return 404, {"error": "not_found", "reason": "missing"}, None
+
+        start = float(params["start"]) if "start" in params else None
+        end = float(params["end"]) if "end" in params else None
+        fields = params["fields"].split(",") if "fields" in params else None
+
+        rows = []
+        for row in doc.get("energy_data", []):
+            timestamp = row.get("timestamp")
+            if start is not None and (timestamp is None or timestamp < start):
+                continue
+            if end is not None and (timestamp is None or timestamp >= end):
+                continue
+            if fields is not None:
+                # An undefined timestamp is dropped by JSON.stringify
+                picked = {"timestamp": timestamp} if "timestamp" in row else {}
+                picked.update({field: row[field] for field in fields if field in row})
+                row = picked
+            rows.append(row)
+
+        return 200, {"_id": doc["_id"], "date": doc.get("date"), "energy_data": rows}, None
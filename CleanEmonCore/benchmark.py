@@ -0,0 +1,225 @@
+"""Self-contained benchmarks of the CouchDB adapter
+
+Every scenario runs against a fresh in-process fake CouchDB server (see _fake_couchdb.py), so no real server is
+needed and results are comparable between runs on the same machine. Results are plain json-serializable dicts, and
+`compare` reports the operations that got slower than a baseline.
+"""
+
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+
+from .CouchDBAdapter import CouchDBAdapter
+from ._fake_couchdb import FakeCouchDB
+from .models import EnergyData
+
+DEFAULT_SIZES = (100, 1000, 10000)
+DEFAULT_DAYS = (1, 7, 30)
+DEFAULT_REPEAT = 10
+DEFAULT_APPEND_SIZE = 10
+
+# How much slower (as a fraction of the baseline) an operation may get before `compare` reports it
+DEFAULT_TOLERANCE = 0.25
+
+FIRST_DATE = datetime.date(2000, 1, 1)
+
+
+def _readings(count: int, start: int = 0) -> List[dict]:
+    return [{"timestamp": start + 10 * i, "power": 200.0 + i % 50, "temp": 20.5, "kwh": i // 3}
+            for i in range(count)]
+
+
+def _date(day: int) -> str:
+    return (FIRST_DATE + datetime.timedelta(days=day)).isoformat()
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Returns the q-th percentile (0 <= q <= 100) of the samples, interpolating linearly between the closest ranks."""
+
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(operation: str, samples: List[float], **params) -> dict:
+    """Turns the duration (in seconds) of every run of an operation into a result."""
+
+    total = sum(samples)
+    return {"operation": operation,
+            **params,
+            "runs": len(samples),
+            "throughput": len(samples) / total if total else 0.0,
+            "latency_ms": {"mean": 1000 * total / len(samples) if samples else 0.0,
+                           "p50": 1000 * percentile(samples, 50),
+                           "p90": 1000 * percentile(samples, 90),
+                           "p99": 1000 * percentile(samples, 99),
+                           "max": 1000 * max(samples, default=0.0)}}
+
+
+def _time(fn: Callable, repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+class _Session:
+    """A fake server with a fresh database, and an adapter pointed to it."""
+
+    def __init__(self, options: Dict[str, str] = None):
+        self.couch = FakeCouchDB().start()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+
+        config_file = self.couch.write_config(os.path.join(self._tmp_dir.name, "clean.cfg"))
+        with open(config_file, "a", encoding="utf8") as f_out:
+            for name, value in (options or {}).items():
+                f_out.write(f"{name} = {value}\n")
+
+        self.adapter = CouchDBAdapter(config_file)
+        self.adapter.install_design()
+
+    def __enter__(self):
+        return self.adapter
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.adapter.close()
+        self.couch.stop()
+        self._tmp_dir.cleanup()
+
+
+def bench_append(size: int, repeat: int, options: Dict[str, str] = None,
+                 append_size: int = DEFAULT_APPEND_SIZE) -> dict:
+    """Appends `append_size` readings at a time to a document that already holds `size` readings."""
+
+    with _Session(options) as adapter:
+        document = adapter.create_document(initial_data=EnergyData(_date(0), _readings(size)))
+        batch = EnergyData(energy_data=_readings(append_size, start=10 * size))
+
+        samples = _time(lambda: adapter.append_energy_data(batch, document=document), repeat)
+
+    return summarize("append", samples, doc_size=size, days=1)
+
+
+def bench_fetch_by_date(size: int, repeat: int, options: Dict[str, str] = None) -> dict:
+    """Fetches a document of `size` readings by its date."""
+
+    with _Session(options) as adapter:
+        adapter.create_document(initial_data=EnergyData(_date(0), _readings(size)))
+        adapter.get_document_id_for_date(_date(0))
+
+        samples = _time(lambda: adapter.fetch_energy_data_by_date(_date(0)), repeat)
+
+    return summarize("fetch_by_date", samples, doc_size=size, days=1)
+
+
+def bench_range_fetch(size: int, days: int, repeat: int, options: Dict[str, str] = None) -> dict:
+    """Fetches `days` consecutive documents of `size` readings each, as a single range."""
+
+    with _Session(options) as adapter:
+        adapter.create_documents(EnergyData(_date(day), _readings(size)) for day in range(days))
+
+        samples = _time(lambda: list(adapter.fetch_energy_data_range(_date(0), _date(days - 1))), repeat)
+
+    return summarize("range_fetch", samples, doc_size=size, days=days)
+
+
+def bench_create_delete(size: int, repeat: int, options: Dict[str, str] = None) -> dict:
+    """Creates a document of `size` readings and deletes it right away."""
+
+    with _Session(options) as adapter:
+        data = EnergyData(_date(0), _readings(size))
+
+        def create_delete():
+            adapter.delete_document(adapter.create_document(initial_data=data))
+
+        samples = _time(create_delete, repeat)
+
+    return summarize("create_delete", samples, doc_size=size, days=1)
+
+
+def run(sizes: Iterable[int] = DEFAULT_SIZES, days: Iterable[int] = DEFAULT_DAYS, repeat: int = DEFAULT_REPEAT,
+        options: Dict[str, str] = None, progress: Callable[[dict], None] = None) -> dict:
+    """Runs every benchmark for every document size (and, for range fetches, every day count).
+    Returns the environment along with a result per operation and parameter set.
+
+    sizes -- The numbers of readings per document
+    days -- The numbers of days fetched at once by range fetches
+    repeat -- How many times each operation is timed
+    options -- Extra [DB] options of the adapter, e.g. {"encoding": "packed"}
+    progress -- Called with every result, as soon as it is available
+    """
+
+    sizes = list(sizes)
+    days = list(days)
+
+    scenarios = []
+    for size in sizes:
+        scenarios.append(lambda size=size: bench_append(size, repeat, options))
+        scenarios.append(lambda size=size: bench_fetch_by_date(size, repeat, options))
+        scenarios.append(lambda size=size: bench_create_delete(size, repeat, options))
+        for count in days:
+            scenarios.append(lambda size=size, count=count: bench_range_fetch(size, count, repeat, options))
+
+    results = []
+    for scenario in scenarios:
+        result = scenario()
+        results.append(result)
+        if progress:
+            progress(result)
+
+    return {"environment": {"python": platform.python_version(),
+                            "implementation": platform.python_implementation(),
+                            "platform": platform.platform(),
+                            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+            "parameters": {"sizes": sizes, "days": days, "repeat": repeat, "options": options or {}},
+            "results": results}
+
+
+def _key(result: dict) -> tuple:
+    return result["operation"], result["doc_size"], result["days"]
+
+
+def compare(baseline: dict, current: dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """Compares the median latency of every operation of `current` against `baseline`.
+    Returns a description of every operation that got slower by more than `tolerance` (a fraction of the baseline).
+    Operations missing from either side are ignored.
+    """
+
+    previous = {_key(result): result for result in baseline.get("results", [])}
+
+    regressions = []
+    for result in current.get("results", []):
+        before = previous.get(_key(result))
+        if before is None:
+            continue
+
+        old, new = before["latency_ms"]["p50"], result["latency_ms"]["p50"]
+        if new > old * (1 + tolerance):
+            operation, size, days = _key(result)
+            regressions.append(f"{operation} (doc_size={size}, days={days}): p50 {old:.2f}ms -> {new:.2f}ms")
+
+    return regressions
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf8") as f_in:
+        return json.load(f_in)
+
+
+def save(results: dict, path: str):
+    with open(path, "w", encoding="utf8") as f_out:
+        json.dump(results, f_out, indent=2)
@@ -0,0 +1,267 @@
+"""Durable, local write-ahead buffer for ingesting energy data"""
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict
+
+from . import dotfiles
+from .jsonstream import dumps
+from .jsonstream import loads
+from .models import EnergyData
+
+_BUFFER_FILENAME = "ingest_buffer.sqlite"
+
+
+class IngestBuffer:
+    """Decouples the production of readings from their upload to the database.
+
+    Readings are enqueued to a local SQLite database (in WAL mode), which takes a fraction of a millisecond and
+    survives crashes. A background thread then coalesces them into large appends, one per document, whenever either
+    `max_batch` readings are pending or the oldest pending reading has waited for `max_latency` seconds.
+
+    Every batch is assigned a unique id before being sent. If the process crashes while a batch is in flight, the batch
+    is re-sent with the same id on the next start, and the database ignores it if it had already been applied. This way,
+    every reading is appended exactly once.
+    """
+
+    def __init__(self, adapter, *, path: str = None, max_batch: int = 1000, max_latency: float = 5.0,
+                 retry_interval: float = 5.0, autostart: bool = True):
+        """adapter -- The adapter the readings are appended through, e.g. a CouchDBAdapter
+        path -- The SQLite file of the buffer. If omitted, a file in the dot-dir is used.
+        max_batch -- The number of pending readings that triggers a flush
+        max_latency -- The maximum time (in seconds) a reading waits before a flush is triggered
+        retry_interval -- Seconds to wait before retrying after a failed flush
+        autostart -- If set, the background flusher is started right away. Otherwise, call start() or flush().
+        """
+
+        if not path:
+            dotfiles.init_dot_dir()
+            path = os.path.join(dotfiles.DOT_DIR_PATH, _BUFFER_FILENAME)
+
+        self.adapter = adapter
+        self.path = path
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.retry_interval = retry_interval
+
+        self._db_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS pending ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "document TEXT, "
+                           "date TEXT NOT NULL, "
+                           "reading BLOB NOT NULL, "
+                           "batch TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pending_batch ON pending (batch)")
+        self._conn.commit()
+
+        # Readings left over by a previous run are replayed by the first flush
+        self._depth = self._conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+        self._first_pending = time.monotonic() if self._depth else None
+
+        self._flushes = 0
+        self._failed_flushes = 0
+        self._flushed_readings = 0
+        self._flush_latencies = []
+        self.last_error = None
+
+        if autostart:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def enqueue(self, *energy_data_list: EnergyData, document: str = None):
+        """Durably stores the readings of one or more EnergyData objects, to be appended later on.
+
+        document -- The document the readings should be appended to. If omitted, each EnergyData object is appended to
+        the document of its own date, which is created if needed.
+        """
+
+        rows = []
+        for energy_data in energy_data_list:
+            if not document and not energy_data.date:
+                raise ValueError("Either a document or a dated EnergyData object must be supplied")
+            for reading in energy_data.energy_data:
+                rows.append((document, energy_data.date, dumps(reading)))
+
+        if not rows:
+            return
+
+        with self._db_lock:
+            self._conn.executemany("INSERT INTO pending (document, date, reading) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+        with self._cond:
+            self._depth += len(rows)
+            if self._first_pending is None:
+                self._first_pending = time.monotonic()
+            self._cond.notify()
+
+    def queue_depth(self) -> int:
+        """Returns the number of readings that have not been appended yet."""
+
+        with self._cond:
+            return self._depth
+
+    def _assign_batches(self):
+        """Groups every pending reading that has no batch yet in batches of up to `max_batch` readings per document,
+        and durably assigns a new id to each batch."""
+
+        with self._db_lock:
+            rows = self._conn.execute("SELECT id, document, date FROM pending WHERE batch IS NULL ORDER BY id")
+
+            groups = {}
+            for row_id, document, date in rows:
+                groups.setdefault((document, date), []).append(row_id)
+
+            updates = []
+            for ids in groups.values():
+                for i in range(0, len(ids), self.max_batch):
+                    batch = uuid.uuid4().hex
+                    updates.extend((batch, row_id) for row_id in ids[i:i + self.max_batch])
+
+            self._conn.executemany("UPDATE pending SET batch = ? WHERE id = ?", updates)
+            self._conn.commit()
+
+    def _resolve(self, document: str, date: str) -> str:
+        if document:
+            return document
+
+        document = self.adapter.get_document_id_for_date(date)
+        if not document:
+            document = self.adapter.create_document(initial_data=EnergyData(date))
+
+        return document
+
+    def flush(self) -> bool:
+        """Appends every pending reading to the database, batch by batch, in the order they were enqueued.
+        Returns True if nothing is left pending.
+        """
+
+        with self._flush_lock:
+            started = time.monotonic()
+            self._assign_batches()
+
+            with self._db_lock:
+                batches = self._conn.execute("SELECT batch, document, date FROM pending WHERE batch IS NOT NULL "
+                                             "GROUP BY batch ORDER BY MIN(id)").fetchall()
+
+            failed = set()
+            flushed = 0
+            for batch, document, date in batches:
+
+                # Later batches of a failed target are held back, so that readings are never reordered
+                if (document, date) in failed:
+                    continue
+
+                with self._db_lock:
+                    readings = [loads(reading) for (reading,) in
+                                self._conn.execute("SELECT reading FROM pending WHERE batch = ? ORDER BY id", (batch,))]
+
+                try:
+                    target = self._resolve(document, date)
+                    appended = bool(target) and self.adapter.append_energy_data(EnergyData(date, readings),
+                                                                                document=target, batch_id=batch)
+                except Exception as e:  # The buffer must outlive any failure of the network or the database
+                    self.last_error = e
+                    appended = False
+
+                if not appended:
+                    failed.add((document, date))
+                    continue
+
+                with self._db_lock:
+                    self._conn.execute("DELETE FROM pending WHERE batch = ?", (batch,))
+                    self._conn.commit()
+
+                flushed += len(readings)
+
+            with self._cond:
+                self._depth -= flushed
+                self._first_pending = time.monotonic() if self._depth else None
+
+            self._flushes += 1
+            self._flushed_readings += flushed
+            self._flush_latencies.append(time.monotonic() - started)
+            del self._flush_latencies[:-1000]
+            if failed:
+                self._failed_flushes += 1
+
+            return not failed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if self._depth >= self.max_batch:
+                        break
+                    if self._first_pending is None:
+                        self._cond.wait()
+                        continue
+                    remaining = self._first_pending + self.max_latency - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                if self._stopping:
+                    return
+
+            if not self.flush():
+                with self._cond:
+                    self._cond.wait_for(lambda: self._stopping, timeout=self.retry_interval)
+
+    def start(self):
+        """Starts the background flusher."""
+
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="IngestBuffer", daemon=True)
+            self._thread.start()
+
+    def close(self, *, flush: bool = True):
+        """Stops the background flusher and closes the buffer. Readings that cannot be flushed stay in the buffer, to
+        be replayed the next time it is opened.
+
+        flush -- If set, a final flush is attempted before closing.
+        """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if flush:
+            self.flush()
+
+        with self._db_lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the current queue depth, along with flush counters and latencies (in seconds)."""
+
+        latencies = list(self._flush_latencies)
+
+        return {"queue_depth": self.queue_depth(),
+                "flushes": self._flushes,
+                "failed_flushes": self._failed_flushes,
+                "flushed_readings": self._flushed_readings,
+                "last_flush_latency": latencies[-1] if latencies else 0.0,
+                "mean_flush_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+                "max_flush_latency": max(latencies) if latencies else 0.0}
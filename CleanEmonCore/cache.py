@@ -0,0 +1,106 @@
+"""Bounded, in-memory cache of fetched documents"""
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict
+from typing import Optional
+
+
+@dataclass
+class CacheEntry:
+    doc: dict
+    etag: str
+    size: int
+    immutable: bool = False
+
+
+class DocumentCache:
+    """A thread-safe LRU cache of documents, bounded both by number of entries and by total size in bytes.
+
+    Entries are kept along with their ETag, so that they can be revalidated cheaply. Immutable entries do not need to
+    be revalidated at all.
+    """
+
+    def __init__(self, max_entries: int = 128, max_bytes: int = 64 * 1024 * 1024):
+        """max_entries -- The maximum number of cached documents
+        max_bytes -- The maximum total size of the cached documents, as measured by their serialized size
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Returns the entry of `key` and marks it as the most recently used one, or None if it is not cached."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, doc: dict, etag: str, size: int, *, immutable: bool = False) -> Optional[CacheEntry]:
+        """Caches `doc` under `key`, evicting the least recently used entries as needed. Documents larger than the
+        whole cache are not cached at all.
+        Returns the new entry, or None if the document was not cached.
+        """
+
+        with self._lock:
+            self._pop(key)
+
+            if size > self.max_bytes or self.max_entries <= 0:
+                return None
+
+            entry = CacheEntry(doc, etag, size, immutable)
+            self._entries[key] = entry
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+
+            return entry
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def invalidate(self, key: str):
+        """Drops the entry of `key`, if any."""
+
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "revalidations": self.revalidations,
+                    "evictions": self.evictions}
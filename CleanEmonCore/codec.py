@@ -0,0 +1,196 @@
+"""Compact encoding of readings: typed columns, delta-encoded integers and compression
+
+A packed set of readings is a json-serializable dict, stored in a document under PACKED_FIELD:
+
+    {"format": 1, "compression": "zlib", "count": <number of readings>, "data": <base64 of the compressed payload>,
+     "first": <the least timestamp of the readings>, "last": <the greatest one>}
+
+The first and last timestamps are only present if any of the readings has one.
+
+The payload is a json header, which describes every column, followed by the columns themselves. Integer columns are
+delta-encoded and, like float columns, stored as little-endian 64-bit values with their bytes shuffled (all the first
+bytes, then all the second bytes and so on), so that the compressor can exploit the slowly changing high-order bytes.
+Any other column is stored as a json list. Readings that lack a field are marked in a presence mask of its column, so
+that unpacking gives back exactly the packed readings.
+"""
+
+import base64
+import json
+import math
+import struct
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+from typing import List
+
+try:
+    import lz4.frame
+except ImportError:  # lz4 is optional; zlib is always available
+    lz4 = None
+
+# The document field that holds the packed readings
+PACKED_FIELD = "packed_energy_data"
+
+# The encodings a storage backend can be configured with
+JSON_ENCODING = "json"
+PACKED_ENCODING = "packed"
+
+ZLIB = "zlib"
+LZ4 = "lz4"
+NO_COMPRESSION = "none"
+
+FORMAT_VERSION = 1
+
+_INT = "q"
+_FLOAT = "d"
+_JSON = "json"
+
+_HEADER_SIZE = struct.Struct("<I")
+_WIDTH = 8  # Bytes per integer or float value
+
+
+def _compress(payload: bytes, compression: str) -> bytes:
+    if compression == ZLIB:
+        return zlib.compress(payload, 6)
+    if compression == LZ4:
+        if lz4 is None:
+            raise ValueError("lz4 compression requires the lz4 package")
+        return lz4.frame.compress(payload)
+    if compression == NO_COMPRESSION:
+        return payload
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == ZLIB:
+        return zlib.decompress(data)
+    if compression == LZ4:
+        if lz4 is None:
+            raise ValueError("lz4 compression requires the lz4 package")
+        return lz4.frame.decompress(data)
+    if compression == NO_COMPRESSION:
+        return data
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def _to_bytes(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    raw = values.tobytes()
+    return b"".join(raw[i::_WIDTH] for i in range(_WIDTH))
+
+
+def _from_bytes(typecode: str, shuffled: bytes) -> array:
+    count = len(shuffled) // _WIDTH
+    raw = bytearray(len(shuffled))
+    for i in range(_WIDTH):
+        raw[i::_WIDTH] = shuffled[i * count:(i + 1) * count]
+
+    values = array(typecode)
+    values.frombytes(bytes(raw))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _encode_column(values: list):
+    """Returns the type of the column along with its encoded bytes."""
+
+    kinds = {type(value) for value in values}
+
+    if kinds == {int}:
+        try:
+            deltas = array(_INT, [values[0]] + [b - a for a, b in zip(values, values[1:])])
+            return _INT, _to_bytes(deltas)
+        except OverflowError:
+            pass
+
+    if kinds == {float}:
+        return _FLOAT, _to_bytes(array(_FLOAT, values))
+
+    return _JSON, json.dumps(values, separators=(",", ":")).encode()
+
+
+def _decode_column(kind: str, raw: bytes) -> list:
+    if kind == _INT:
+        return list(accumulate(_from_bytes(_INT, raw)))
+    if kind == _FLOAT:
+        return _from_bytes(_FLOAT, raw).tolist()
+    return json.loads(raw)
+
+
+def pack(readings: List[dict], compression: str = ZLIB) -> dict:
+    """Packs the given readings into a json-serializable dict.
+
+    compression -- One of "zlib" (the default), "lz4" (if the lz4 package is installed) or "none"
+
+    Throws:
+    ValueError -- If the compression is unknown or unavailable.
+    """
+
+    fields = {}
+    for reading in readings:
+        fields.update(dict.fromkeys(reading))
+
+    columns = []
+    blobs = []
+    for field in fields:
+        present = [field in reading for reading in readings]
+        kind, blob = _encode_column([reading[field] for reading in readings if field in reading])
+        mask = b"" if all(present) else bytes(present)
+
+        columns.append({"name": field, "type": kind, "mask": len(mask), "size": len(blob)})
+        blobs.extend((mask, blob))
+
+    header = json.dumps({"count": len(readings), "columns": columns}, separators=(",", ":")).encode()
+    payload = b"".join([_HEADER_SIZE.pack(len(header)), header, *blobs])
+
+    packed = {"format": FORMAT_VERSION,
+              "compression": compression,
+              "count": len(readings),
+              "data": base64.b64encode(_compress(payload, compression)).decode("ascii")}
+
+    # Kept in the clear, so that the design functions can tell the time span of the readings without unpacking them
+    timestamps = [reading["timestamp"] for reading in readings
+                  if type(reading.get("timestamp")) in (int, float) and math.isfinite(reading["timestamp"])]
+    if timestamps:
+        packed["first"] = min(timestamps)
+        packed["last"] = max(timestamps)
+
+    return packed
+
+
+def unpack(packed: dict) -> List[dict]:
+    """The inverse of pack. Returns the packed readings, in their original order.
+
+    Throws:
+    ValueError -- If the format or the compression is not supported.
+    """
+
+    if packed.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported packed format: {packed.get('format')}")
+
+    payload = _decompress(base64.b64decode(packed["data"]), packed.get("compression", ZLIB))
+
+    (header_size,) = _HEADER_SIZE.unpack_from(payload)
+    offset = _HEADER_SIZE.size
+    header = json.loads(payload[offset:offset + header_size])
+    offset += header_size
+
+    readings = [{} for _ in range(header["count"])]
+
+    for column in header["columns"]:
+        mask = payload[offset:offset + column["mask"]]
+        offset += column["mask"]
+        values = _decode_column(column["type"], payload[offset:offset + column["size"]])
+        offset += column["size"]
+
+        rows = [reading for reading, present in zip(readings, mask) if present] if mask else readings
+        name = column["name"]
+        for reading, value in zip(rows, values):
+            reading[name] = value
+
+    return readings
@@ -0,0 +1,67 @@
+"""Process-wide cache of parsed config files"""
+
+import configparser
+import os
+import threading
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+_cache = {}  # type: Dict[str, Tuple[Optional[tuple], configparser.ConfigParser]]
+_cache_lock = threading.Lock()
+
+
+def _stamp(path: str) -> Optional[tuple]:
+    """Returns what identifies the current contents of a file: its modification time and size, or None if it does not
+    exist."""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_config(config_file: str) -> configparser.ConfigParser:
+    """Returns the parsed contents of `config_file`. Each file is parsed once per process and parsed again only after
+    it changes on disk, so creating many adapters out of the same file costs a single `stat` each. A missing file gives
+    an empty parser, as configparser does.
+    The returned parser is shared by every caller, so it must not be altered.
+    """
+
+    path = os.path.abspath(config_file)
+    stamp = _stamp(path)
+
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+    cfg = configparser.ConfigParser(interpolation=None)
+    cfg.read(path)
+
+    with _cache_lock:
+        _cache[path] = (stamp, cfg)
+
+    return cfg
+
+
+def clear_config_cache():
+    """Forgets every parsed config file."""
+
+    with _cache_lock:
+        _cache.clear()
+
+
+def find_config_file() -> str:
+    """Returns the path of the config file to be used by default: the one in the directory of execution if there is
+    one, or else the one in the dot-dir."""
+
+    from .dotfiles import _CONFIG_FILENAME
+    from .dotfiles import get_dotfile
+
+    if os.path.exists(_CONFIG_FILENAME):
+        return os.path.abspath(_CONFIG_FILENAME)
+
+    # Retrieve the config file from the dot-dir
+    return get_dotfile(_CONFIG_FILENAME)
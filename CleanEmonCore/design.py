@@ -0,0 +1,350 @@
+"""The design document the CouchDB adapters install, and the JavaScript functions it holds"""
+
+from typing import List
+
+from .codec import PACKED_FIELD
+
+DESIGN_DOCUMENT = "_design/api"
+
+# How many of the most recently applied batch ids are remembered per document, to detect re-sent batches
+APPLIED_BATCHES_LIMIT = 64
+
+# Every design function the adapters rely on. They are installed on demand by `install_design`, which merges them
+# into the existing design document.
+DESIGN_FUNCTIONS = {
+    "views": {
+        "get_dates": {
+            "map": "function (doc) {\n"
+                   "    if (doc.date) {\n"
+                   "        emit(doc.date, doc._id);\n"
+                   "    }\n"
+                   "}"
+        }
+    },
+    "updates": {
+        # Merges the posted `energy_data` rows into the stored ones, so that only the new rows travel over the wire.
+        # Readings are kept sorted by timestamp and unique per timestamp, exactly as `models.merge_readings` does.
+        # A missing document is created on the fly, exactly as the client-side append path does. If a `batch_id` is
+        # posted, it is remembered, and any later attempt to append the same batch is acknowledged but ignored.
+        # Sealed (rolled over) documents refuse new rows with a "sealed" conflict, so that writers move on to the
+        # newest chunk. A chunk only holds readings newer than its `floor`, the last timestamp of the chunk before it,
+        # so that no timestamp is ever stored in two chunks. Rows that belong to an older chunk are refused with a
+        # "stale" conflict, which carries the floor, before the batch is recorded; writers merge them into their
+        # chunks and post the rest again.
+        "append": "function (doc, req) {\n"
+                  "    if (!req.id) {\n"
+                  "        return [null, {code: 400, json: {error: 'bad_request', reason: 'missing_id'}}];\n"
+                  "    }\n"
+                  "    if (!doc) {\n"
+                  "        doc = {_id: req.id, date: '', energy_data: []};\n"
+                  "    }\n"
+                  "    if (!doc.energy_data) {\n"
+                  "        doc.energy_data = [];\n"
+                  "    }\n"
+                  "    var body = JSON.parse(req.body);\n"
+                  "    var applied = doc.applied_batches || [];\n"
+                  "    if (body.batch_id && applied.indexOf(body.batch_id) >= 0) {\n"
+                  "        return [null, {json: {ok: true, duplicate: true, count: doc.energy_data.length}}];\n"
+                  "    }\n"
+                  "    if (doc.sealed) {\n"
+                  "        return [null, {code: 409, json: {error: 'sealed', reason: 'Document was rolled over'}}];\n"
+                  "    }\n"
+                  "    var rows = body.energy_data || [];\n"
+                  "    function ts(row) {\n"
+                  "        var t = row ? row.timestamp : undefined;\n"
+                  "        return typeof t === 'number' && isFinite(t) ? t : null;\n"
+                  "    }\n"
+                  "    if (typeof doc.floor === 'number') {\n"
+                  "        for (var s = 0; s < rows.length; s++) {\n"
+                  "            if (ts(rows[s]) !== null && ts(rows[s]) <= doc.floor) {\n"
+                  "                return [null, {code: 409, json: {error: 'stale', floor: doc.floor,\n"
+                  "                                                 reason: 'Readings belong to an older chunk'}}];\n"
+                  "            }\n"
+                  "        }\n"
+                  "    }\n"
+                  "    if (body.batch_id) {\n"
+                  "        applied.push(body.batch_id);\n"
+                  f"        doc.applied_batches = applied.slice(-{APPLIED_BATCHES_LIMIT});\n"
+                  "    }\n"
+                  "    function sortedUnique(list) {\n"
+                  "        var keyed = [];\n"
+                  "        for (var i = 0; i < list.length; i++) {\n"
+                  "            keyed.push([ts(list[i]), i, list[i]]);\n"
+                  "        }\n"
+                  "        keyed.sort(function (a, b) { return a[0] - b[0] || a[1] - b[1]; });\n"
+                  "        var unique = [];\n"
+                  "        for (var k = 0; k < keyed.length; k++) {\n"
+                  "            if (k > 0 && keyed[k][0] === keyed[k - 1][0]) {\n"
+                  "                unique[unique.length - 1] = keyed[k][2];\n"
+                  "            } else {\n"
+                  "                unique.push(keyed[k][2]);\n"
+                  "            }\n"
+                  "        }\n"
+                  "        return unique;\n"
+                  "    }\n"
+                  "    var timed = [], untimed = [], batch = [], ordered = true;\n"
+                  "    for (var i = 0; i < doc.energy_data.length; i++) {\n"
+                  "        var t = ts(doc.energy_data[i]);\n"
+                  "        if (t === null) {\n"
+                  "            untimed.push(doc.energy_data[i]);\n"
+                  "            continue;\n"
+                  "        }\n"
+                  "        if (timed.length && t <= ts(timed[timed.length - 1])) {\n"
+                  "            ordered = false;\n"
+                  "        }\n"
+                  "        timed.push(doc.energy_data[i]);\n"
+                  "    }\n"
+                  "    if (!ordered) {\n"
+                  "        timed = sortedUnique(timed);\n"
+                  "    }\n"
+                  "    for (var j = 0; j < rows.length; j++) {\n"
+                  "        (ts(rows[j]) === null ? untimed : batch).push(rows[j]);\n"
+                  "    }\n"
+                  "    batch = sortedUnique(batch);\n"
+                  "    var merged;\n"
+                  "    if (!timed.length || !batch.length || ts(batch[0]) > ts(timed[timed.length - 1])) {\n"
+                  "        merged = timed.concat(batch);\n"
+                  "    } else {\n"
+                  "        merged = [];\n"
+                  "        var a = 0, b = 0;\n"
+                  "        while (a < timed.length && b < batch.length) {\n"
+                  "            var ta = ts(timed[a]), tb = ts(batch[b]);\n"
+                  "            if (ta < tb) {\n"
+                  "                merged.push(timed[a++]);\n"
+                  "            } else if (ta > tb) {\n"
+                  "                merged.push(batch[b++]);\n"
+                  "            } else {\n"
+                  "                merged.push(batch[b++]);\n"
+                  "                a++;\n"
+                  "            }\n"
+                  "        }\n"
+                  "        merged = merged.concat(timed.slice(a), batch.slice(b));\n"
+                  "    }\n"
+                  "    doc.energy_data = merged.concat(untimed);\n"
+                  "    return [doc, {json: {ok: true, count: doc.energy_data.length}}];\n"
+                  "}",
+        # Marks a full document as sealed, so that no more rows are appended to it. It is idempotent, and returns the
+        # applied batch ids of the document, which are carried over to the next chunk, along with its last timestamp
+        # (that of its packed readings included), which becomes the floor of the next chunk.
+        "seal": "function (doc, req) {\n"
+                "    if (!doc) {\n"
+                "        return [null, {code: 404, json: {error: 'not_found', reason: 'missing'}}];\n"
+                "    }\n"
+                "    var applied = doc.applied_batches || [];\n"
+                "    var last = typeof doc.floor === 'number' ? doc.floor : null;\n"
+                f"    var packed = doc.{PACKED_FIELD};\n"
+                "    if (packed && typeof packed.last === 'number' && (last === null || packed.last > last)) {\n"
+                "        last = packed.last;\n"
+                "    }\n"
+                "    var data = doc.energy_data || [];\n"
+                "    for (var i = 0; i < data.length; i++) {\n"
+                "        var t = data[i] ? data[i].timestamp : undefined;\n"
+                "        if (typeof t === 'number' && isFinite(t) && (last === null || t > last)) {\n"
+                "            last = t;\n"
+                "        }\n"
+                "    }\n"
+                "    var res = {json: {ok: true, applied_batches: applied, last: last}};\n"
+                "    if (doc.sealed) {\n"
+                "        return [null, res];\n"
+                "    }\n"
+                "    doc.sealed = true;\n"
+                "    return [doc, res];\n"
+                "}",
+        # Registers the posted `chunk` id as the newest chunk of the (head) document, unless it is already registered
+        "add_chunk": "function (doc, req) {\n"
+                     "    if (!doc) {\n"
+                     "        return [null, {code: 404, json: {error: 'not_found', reason: 'missing'}}];\n"
+                     "    }\n"
+                     "    var chunk = JSON.parse(req.body).chunk;\n"
+                     "    var chunks = doc.chunks || [];\n"
+                     "    if (chunks.indexOf(chunk) >= 0) {\n"
+                     "        return [null, {json: {ok: true, chunks: chunks}}];\n"
+                     "    }\n"
+                     "    chunks.push(chunk);\n"
+                     "    doc.chunks = chunks;\n"
+                     "    return [doc, {json: {ok: true, chunks: chunks}}];\n"
+                     "}"
+    },
+    "shows": {
+        # Returns a document with only the readings within [start, end), optionally stripped down to the given
+        # (comma-separated) fields, so that the rest of them never leave the server.
+        "window": "function (doc, req) {\n"
+                  "    if (!doc) {\n"
+                  "        return {code: 404, json: {error: 'not_found', reason: 'missing'}};\n"
+                  "    }\n"
+                  "    var start = req.query.start !== undefined ? Number(req.query.start) : null;\n"
+                  "    var end = req.query.end !== undefined ? Number(req.query.end) : null;\n"
+                  "    var fields = req.query.fields !== undefined ? req.query.fields.split(',') : null;\n"
+                  "    var data = doc.energy_data || [];\n"
+                  "    var rows = [];\n"
+                  "    for (var i = 0; i < data.length; i++) {\n"
+                  "        var row = data[i];\n"
+                  "        if (start !== null && !(row.timestamp >= start)) continue;\n"
+                  "        if (end !== null && !(row.timestamp < end)) continue;\n"
+                  "        if (fields !== null) {\n"
+                  "            var picked = {timestamp: row.timestamp};\n"
+                  "            for (var j = 0; j < fields.length; j++) {\n"
+                  "                if (fields[j] in row) picked[fields[j]] = row[fields[j]];\n"
+                  "            }\n"
+                  "            row = picked;\n"
+                  "        }\n"
+                  "        rows.push(row);\n"
+                  "    }\n"
+                  "    return {json: {_id: doc._id, date: doc.date, energy_data: rows}};\n"
+                  "}",
+        # Returns the ids of the chunks of a (head) document, without any of its readings
+        "chunks": "function (doc, req) {\n"
+                  "    if (!doc) {\n"
+                  "        return {code: 404, json: {error: 'not_found', reason: 'missing'}};\n"
+                  "    }\n"
+                  "    return {json: {chunks: doc.chunks || []}};\n"
+                  "}"
+    }
+}
+
+# The views that index every single reading live in a design document of their own. CouchDB builds the views of a design
+# document together, so this keeps appends and get_dates queries from waiting for the readings to be (re)indexed, and
+# databases that never query readings by time never build these views at all. They are installed by the first
+# `fetch_readings` or `fetch_rollups`.
+#
+# Packed readings (see codec) cannot be decoded by a view, so by_timestamp and rollups skip packed documents altogether,
+# along with any reading appended to them since. Instead, packed_spans lists the packed documents by the time span of
+# their readings, and the adapters fetch and unpack those that overlap a query.
+READINGS_DESIGN_DOCUMENT = "_design/readings"
+
+READINGS_DESIGN_FUNCTIONS = {
+    "views": {
+        # Indexes every reading of every document by its timestamp, so that any time range can be read without
+        # touching the rest of the readings of its documents.
+        "by_timestamp": {
+            "map": "function (doc) {\n"
+                   f"    if (doc.{PACKED_FIELD}) return;\n"
+                   "    var data = doc.energy_data || [];\n"
+                   "    for (var i = 0; i < data.length; i++) {\n"
+                   "        if (typeof data[i].timestamp === 'number') {\n"
+                   "            emit(data[i].timestamp, data[i]);\n"
+                   "        }\n"
+                   "    }\n"
+                   "}"
+        },
+        # Rolls up every numeric field of every reading, keyed by [field, year, month, day, hour, minute] in UTC.
+        # CouchDB keeps the reduced values up to date incrementally, and queries pick the resolution by group_level.
+        "rollups": {
+            "map": "function (doc) {\n"
+                   f"    if (doc.{PACKED_FIELD}) return;\n"
+                   "    var data = doc.energy_data || [];\n"
+                   "    for (var i = 0; i < data.length; i++) {\n"
+                   "        var row = data[i];\n"
+                   "        if (typeof row.timestamp !== 'number') continue;\n"
+                   "        var d = new Date(row.timestamp * 1000);\n"
+                   "        var when = [d.getUTCFullYear(), d.getUTCMonth() + 1, d.getUTCDate(), d.getUTCHours(),\n"
+                   "                    d.getUTCMinutes()];\n"
+                   "        for (var field in row) {\n"
+                   "            if (field !== 'timestamp' && typeof row[field] === 'number' && isFinite(row[field])) {\n"
+                   "                emit([field].concat(when), row[field]);\n"
+                   "            }\n"
+                   "        }\n"
+                   "    }\n"
+                   "}",
+            "reduce": "_stats"
+        },
+        # Lists the packed documents, keyed by [0, last timestamp] and valued by their first timestamp, counting the
+        # readings appended since they were packed. Packed readings of unknown span (packed by older versions, or with
+        # no timestamps at all) are keyed by [1], after every known span. Querying from [0, start] thus lists every
+        # packed document that may hold readings from `start` on.
+        "packed_spans": {
+            "map": "function (doc) {\n"
+                   f"    var packed = doc.{PACKED_FIELD};\n"
+                   "    if (!packed) return;\n"
+                   "    if (typeof packed.last !== 'number') {\n"
+                   "        emit([1], null);\n"
+                   "        return;\n"
+                   "    }\n"
+                   "    var first = typeof packed.first === 'number' ? packed.first : null;\n"
+                   "    var last = packed.last;\n"
+                   "    var data = doc.energy_data || [];\n"
+                   "    for (var i = 0; i < data.length; i++) {\n"
+                   "        var timestamp = data[i].timestamp;\n"
+                   "        if (typeof timestamp !== 'number') continue;\n"
+                   "        if (first !== null && timestamp < first) first = timestamp;\n"
+                   "        if (timestamp > last) last = timestamp;\n"
+                   "    }\n"
+                   "    emit([0, last], first);\n"
+                   "}"
+        }
+    }
+}
+
+# Design functions that deployments may define in their own way, such as a get_dates view that emits dates of its own
+# format. An existing definition is kept as it is.
+DEPLOYMENT_FUNCTIONS = frozenset({"views/get_dates"})
+
+# The field of the design document that lists the functions installed by the adapters, which are theirs to upgrade
+OWNED_FUNCTIONS_FIELD = "cleanemon_functions"
+
+
+def _owned_functions(design: dict) -> set:
+    return set(design.get(OWNED_FUNCTIONS_FIELD, []))
+
+
+def design_conflicts(design: dict, functions: dict = None) -> List[str]:
+    """Returns the functions of the given design document that stand in the way of `functions`: functions of the same
+    name that differ, and were neither installed by the adapters nor provided by the deployment. They belong to someone
+    else, so they must never be overwritten.
+    Each one is listed as "<section>/<name>".
+
+    functions -- The design functions to be installed, grouped by section. Defaults to DESIGN_FUNCTIONS.
+    """
+
+    owned = _owned_functions(design)
+    conflicts = []
+
+    for section, section_functions in (functions or DESIGN_FUNCTIONS).items():
+        installed = design.get(section) or {}
+        for name, function in section_functions.items():
+            key = f"{section}/{name}"
+            if name in installed and installed[name] != function and key not in owned \
+                    and key not in DEPLOYMENT_FUNCTIONS:
+                conflicts.append(key)
+
+    return conflicts
+
+
+def merge_design_functions(design: dict, functions: dict = None) -> bool:
+    """Merges `functions` (or DESIGN_FUNCTIONS, if omitted) into the given design document, in-place. Missing functions
+    are added, and functions installed by the adapters are upgraded, or removed if they are no longer needed. Any other
+    function is left untouched, including the deployment-provided ones of DEPLOYMENT_FUNCTIONS; see `design_conflicts`
+    for the ones that cannot be merged.
+    Returns True if the design document had to be altered.
+    """
+
+    functions = functions or DESIGN_FUNCTIONS
+    owned = _owned_functions(design)
+    outdated = False
+
+    for key in sorted(owned):
+        section, name = key.split("/", 1)
+        if name not in functions.get(section, {}):
+            # Installed by an older version, e.g. a view that has since moved to a design document of its own
+            (design.get(section) or {}).pop(name, None)
+            owned.discard(key)
+            outdated = True
+
+    for section, section_functions in functions.items():
+        installed = design.setdefault(section, {})
+        for name, function in section_functions.items():
+            key = f"{section}/{name}"
+            if name not in installed:
+                installed[name] = function
+                if key not in DEPLOYMENT_FUNCTIONS:
+                    owned.add(key)
+                outdated = True
+            elif installed[name] != function and key in owned:
+                installed[name] = function
+                outdated = True
+
+    if outdated:
+        design[OWNED_FUNCTIONS_FIELD] = sorted(owned)
+    design.setdefault("language", "javascript")
+
+    return outdated
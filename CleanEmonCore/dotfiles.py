@@ -44,6 +44,7 @@ def read_config() -> configparser.ConfigParser:
 
 
 def write_config(cfg: configparser.ConfigParser):
+    init_dot_dir()
     config_file = get_dotfile(_CONFIG_FILENAME)
     with open(config_file, "w", encoding="utf8") as f_out:
         cfg.write(f_out)
@@ -59,6 +60,3 @@ def store_external_configfile(path: str):
     else:
         print(f"Path not found: {path}")
         print("Aborting...")
-
-
-init_dot_dir()
@@ -0,0 +1,261 @@
+"""Fast and incremental JSON (de)serialization of large documents"""
+
+import codecs
+import json
+from typing import Any
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Iterable
+from typing import Iterator
+from typing import List
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the standard library is used instead
+    orjson = None
+
+_WHITESPACE = " \t\n\r"
+
+# Characters that may continue a number
+_NUMBER_TAIL = "0123456789.eE+-"
+
+# Shared encoder, configured like json.dumps with no arguments
+_ENCODER = json.JSONEncoder()
+
+
+def dumps(obj: Any) -> bytes:
+    """Serializes `obj` straight to UTF-8 encoded JSON bytes, using orjson if it is installed."""
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _ENCODER.encode(obj).encode()
+
+
+def loads(data: bytes) -> Any:
+    """Deserializes JSON bytes (or text), using orjson if it is installed."""
+
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def iter_dumps(obj: Any, chunk_size: int = 65536) -> Iterator[bytes]:
+    """Serializes `obj` lazily, yielding UTF-8 encoded JSON in chunks of about `chunk_size` bytes. The whole document
+    is never held in memory at once, so it is suitable as a streamed (chunked) request body.
+    """
+
+    pending = []
+    size = 0
+    for fragment in _ENCODER.iterencode(obj):
+        pending.append(fragment)
+        size += len(fragment)
+        if size >= chunk_size:
+            yield "".join(pending).encode()
+            pending = []
+            size = 0
+
+    if pending:
+        yield "".join(pending).encode()
+
+
+# States of ArrayParser
+_OBJECT = 0  # Before the opening brace
+_FIRST_MEMBER = 1  # After the opening brace
+_NAME = 2  # Before the name of a member
+_COLON = 3  # After the name of a member
+_VALUE = 4  # Before the value of a member
+_FIRST_ITEM = 5  # After the opening bracket of the array
+_ITEM = 6  # Before an item of the array
+_AFTER_ITEM = 7  # After an item of the array
+_AFTER_MEMBER = 8  # After the value of a member
+_DONE = 9  # After the closing brace
+
+# Returned by ArrayParser._value while a value has not been received in full
+_INCOMPLETE = object()
+
+
+class ArrayParser:
+    """Picks the items of the array stored under `key` in a top-level JSON object, while the object is still being
+    received. Chunks are pushed to it as they arrive, and each push returns the items it completed, so it suits both
+    blocking and asyncio callers. Every other member of the object is parsed and discarded.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._state = _OBJECT
+        self._name = None
+        self._wanted = 0  # How many characters must be buffered before an incomplete value is parsed again
+        self._eof = False
+
+    @property
+    def done(self) -> bool:
+        """Whether the whole object has been received. Anything after it is ignored."""
+
+        return self._state == _DONE
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """Pushes the next chunk of the object. Returns the items that were completed by it, in order."""
+
+        # Whatever has been consumed is dropped, so that the buffer only grows as much as a single value
+        self._buffer = self._buffer[self._pos:] + self._decoder.decode(chunk)
+        self._pos = 0
+        return self._parse()
+
+    def close(self) -> List[Any]:
+        """Marks the end of the object. Returns the items that were still pending.
+
+        Throws:
+        ValueError -- If the object is incomplete or malformed.
+        """
+
+        self._buffer = self._buffer[self._pos:] + self._decoder.decode(b"", final=True)
+        self._pos = 0
+        self._eof = True
+
+        items = self._parse()
+        if self._state != _DONE:
+            raise ValueError(f"Malformed JSON: unexpected end of input at offset {self._pos}")
+        return items
+
+    def _peek(self) -> str:
+        """Skips any whitespace and returns the next character, without consuming it. Returns an empty string if
+        nothing more is buffered."""
+
+        while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+            self._pos += 1
+        return self._buffer[self._pos] if self._pos < len(self._buffer) else ""
+
+    def _expect(self, char: str, found: str):
+        if found != char:
+            raise ValueError(f"Malformed JSON: expected {char!r} at offset {self._pos}")
+        self._pos += 1
+
+    def _value(self) -> Any:
+        """Decodes and consumes the next complete JSON value, or returns _INCOMPLETE if more input is needed."""
+
+        if not self._eof and len(self._buffer) - self._pos < self._wanted:
+            return _INCOMPLETE
+
+        try:
+            value, end = self._json.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if self._eof:
+                raise
+            # Wait for twice the buffered amount before retrying, so that a large value is only re-parsed a
+            # logarithmic number of times.
+            self._wanted = 2 * max(len(self._buffer) - self._pos, 512)
+            return _INCOMPLETE
+
+        # A number can only be trusted once something that cannot continue it follows, as the rest of its digits (or
+        # its exponent) may still be on the way
+        if not self._eof and (end == len(self._buffer) or self._buffer[end] in _NUMBER_TAIL):
+            return _INCOMPLETE
+
+        self._wanted = 0
+        self._pos = end
+        return value
+
+    def _parse(self) -> List[Any]:
+        items = []
+
+        while self._state != _DONE:
+            char = self._peek()
+            if not char:
+                break
+
+            state = self._state
+            if state == _OBJECT:
+                self._expect("{", char)
+                self._state = _FIRST_MEMBER
+            elif state == _FIRST_MEMBER:
+                if char == "}":
+                    self._pos += 1
+                    self._state = _DONE
+                else:
+                    self._state = _NAME
+            elif state == _NAME:
+                name = self._value()
+                if name is _INCOMPLETE:
+                    break
+                self._name = name
+                self._state = _COLON
+            elif state == _COLON:
+                self._expect(":", char)
+                self._state = _VALUE
+            elif state == _VALUE:
+                if self._name == self.key and char == "[":
+                    self._pos += 1
+                    self._state = _FIRST_ITEM
+                elif self._value() is _INCOMPLETE:
+                    break
+                else:
+                    self._state = _AFTER_MEMBER
+            elif state == _FIRST_ITEM:
+                if char == "]":
+                    self._pos += 1
+                    self._state = _AFTER_MEMBER
+                else:
+                    self._state = _ITEM
+            elif state == _ITEM:
+                item = self._value()
+                if item is _INCOMPLETE:
+                    break
+                items.append(item)
+                self._state = _AFTER_ITEM
+            elif state == _AFTER_ITEM:
+                if char == ",":
+                    self._pos += 1
+                    self._state = _ITEM
+                else:
+                    self._expect("]", char)
+                    self._state = _AFTER_MEMBER
+            else:
+                if char == ",":
+                    self._pos += 1
+                    self._state = _NAME
+                else:
+                    self._expect("}", char)
+                    self._state = _DONE
+
+        return items
+
+
+def iter_array(chunks: Iterable[bytes], key: str) -> Iterator[Any]:
+    """Yields, one at a time, the items of the array stored under `key` in a top-level JSON object, while the object is
+    still being received. Every other member of the object is parsed and discarded. If there is no such key, nothing
+    is yielded.
+
+    chunks -- The raw JSON object as an iterable of byte chunks, e.g. `response.iter_content(65536)`
+    key -- The name of the member that holds the array
+    """
+
+    parser = ArrayParser(key)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+
+    yield from parser.close()
+
+
+async def aiter_array(chunks: AsyncIterable[bytes], key: str) -> AsyncIterator[Any]:
+    """asyncio counterpart of `iter_array`.
+
+    chunks -- The raw JSON object as an asynchronous iterable of byte chunks, e.g.
+              `response.content.iter_chunked(65536)`
+    key -- The name of the member that holds the array
+    """
+
+    parser = ArrayParser(key)
+    async for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+        if parser.done:
+            return
+
+    for item in parser.close():
+        yield item
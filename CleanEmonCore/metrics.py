@@ -0,0 +1,226 @@
+"""Instrumentation of the HTTP requests sent by the database adapters
+
+Every request sent through a transport with hooks is reported to each of them as a RequestSample, tagged by the logical
+operation (the public adapter method) it was sent on behalf of. `Metrics` is a hook that aggregates samples into
+counters and latency histograms, which can be read as a snapshot or dumped in the Prometheus text format.
+"""
+
+import contextvars
+import functools
+import inspect
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The operation of requests sent outside any instrumented method
+UNTAGGED = "other"
+
+DEFAULT_PREFIX = "cleanemon"
+
+_operation = contextvars.ContextVar("operation", default=UNTAGGED)
+
+
+@dataclass
+class RequestSample:
+    """The outcome of a single HTTP request. `status` is 0 if no response was received at all."""
+
+    operation: str
+    method: str
+    status: int
+    duration: float
+    bytes_sent: int
+    bytes_received: int
+    retries: int = 0
+
+
+def current_operation() -> str:
+    """Returns the operation that requests sent right now would be tagged with."""
+
+    return _operation.get()
+
+
+@contextmanager
+def operation(name: str):
+    """Tags every request sent within the block with `name`. Blocks may be nested, in which case the innermost tag
+    wins."""
+
+    token = _operation.set(name)
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+def _tagged(generator: Iterator, name: str) -> Iterator:
+    """Re-yields the items of `generator`, tagging only the requests it sends while producing them, as opposed to the
+    ones sent by the consumer in-between."""
+
+    try:
+        while True:
+            token = _operation.set(name)
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                _operation.reset(token)
+            yield item
+    finally:
+        generator.close()
+
+
+def instrumented(name: str):
+    """Decorates an adapter method, so that every request it sends is tagged with the operation `name`. Generator
+    methods are supported. The method is called as it is when the `transport` of the adapter has no hooks, so that
+    instrumentation costs nothing unless enabled.
+    """
+
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(self, *args, **kwargs):
+                if not self.transport.hooks:
+                    return fn(self, *args, **kwargs)
+                return _tagged(fn(self, *args, **kwargs), name)
+        else:
+            @functools.wraps(fn)
+            def wrapper(self, *args, **kwargs):
+                if not self.transport.hooks:
+                    return fn(self, *args, **kwargs)
+                with operation(name):
+                    return fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _Series:
+    """Everything recorded about the requests of a single operation."""
+
+    def __init__(self, buckets: tuple):
+        self.statuses = {}
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * len(buckets)
+
+    def as_dict(self, bounds: tuple) -> dict:
+        # Bucket counts are reported cumulatively, as in Prometheus
+        cumulative = []
+        running = 0
+        for count in self.buckets:
+            running += count
+            cumulative.append(running)
+
+        return {"requests": self.count,
+                "statuses": dict(self.statuses),
+                "retries": self.retries,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "latency": {"count": self.count,
+                            "sum": self.total,
+                            "buckets": dict(zip(bounds, cumulative))}}
+
+
+class Metrics:
+    """A thread-safe aggregation of request samples, per operation. An instance is a hook itself, so it can be added
+    as it is to any number of transports."""
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        """buckets -- The upper bounds (in seconds) of the latency histogram buckets"""
+
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # type: Dict[str, _Series]
+        self._lock = threading.Lock()
+
+    def __call__(self, sample: RequestSample):
+        self.record(sample)
+
+    def record(self, sample: RequestSample):
+        """Adds a single request to the metrics of its operation."""
+
+        # Samples above the last bound only count towards the implied +Inf bucket
+        index = next((i for i, bound in enumerate(self.buckets) if sample.duration <= bound), None)
+
+        with self._lock:
+            series = self._series.get(sample.operation)
+            if series is None:
+                series = self._series[sample.operation] = _Series(self.buckets)
+
+            series.statuses[sample.status] = series.statuses.get(sample.status, 0) + 1
+            series.retries += sample.retries
+            series.bytes_sent += sample.bytes_sent
+            series.bytes_received += sample.bytes_received
+            series.count += 1
+            series.total += sample.duration
+            if index is not None:
+                series.buckets[index] += 1
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Returns a copy of everything recorded so far, per operation: the number of requests, their count per status,
+        the number of retries, the bytes sent and received, and the latency histogram with cumulative bucket counts.
+        """
+
+        with self._lock:
+            return {name: series.as_dict(self.buckets) for name, series in sorted(self._series.items())}
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+
+        with self._lock:
+            self._series.clear()
+
+    def to_prometheus(self, prefix: str = DEFAULT_PREFIX) -> str:
+        """Returns the metrics in the Prometheus text exposition format.
+
+        prefix -- Prepended to the name of every metric
+        """
+
+        snapshot = self.snapshot()
+        lines = []  # type: List[str]
+
+        def family(name, kind, description, samples):
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for suffix, labels, value in samples:
+                rendered = ",".join(f'{label}="{_escape(str(text))}"' for label, text in labels)
+                lines.append(f"{prefix}_{name}{suffix}{{{rendered}}} {_number(value)}")
+
+        family("requests_total", "counter", "HTTP requests sent, by operation and status.",
+               [("", [("operation", op), ("status", status)], count)
+                for op, series in snapshot.items() for status, count in sorted(series["statuses"].items())])
+        family("request_retries_total", "counter", "Retries of HTTP requests, by operation.",
+               [("", [("operation", op)], series["retries"]) for op, series in snapshot.items()])
+        family("request_sent_bytes_total", "counter", "Bytes of HTTP request bodies, by operation.",
+               [("", [("operation", op)], series["bytes_sent"]) for op, series in snapshot.items()])
+        family("request_received_bytes_total", "counter", "Bytes of HTTP response bodies, by operation.",
+               [("", [("operation", op)], series["bytes_received"]) for op, series in snapshot.items()])
+
+        histogram = []
+        for op, series in snapshot.items():
+            latency = series["latency"]
+            for bound, count in latency["buckets"].items():
+                histogram.append(("_bucket", [("operation", op), ("le", _number(bound))], count))
+            histogram.append(("_bucket", [("operation", op), ("le", "+Inf")], latency["count"]))
+            histogram.append(("_sum", [("operation", op)], latency["sum"]))
+            histogram.append(("_count", [("operation", op)], latency["count"]))
+        family("request_duration_seconds", "histogram", "Latency of HTTP requests, by operation.", histogram)
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -1,9 +1,38 @@
 """Essential models definition for CleanEmon"""
+import bisect
 import dataclasses
+import functools
 import json
+import math
+from array import array
 from dataclasses import dataclass
-from dataclasses import asdict
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Union
+
+from .codec import PACKED_FIELD
+from .codec import unpack
+from .jsonstream import dumps
+from .jsonstream import iter_dumps
+
+TIMESTAMP_FIELD = "timestamp"
+
+# Marks a missing value in a non-numeric column. Missing values in numeric columns are stored as NaN.
+_MISSING = object()
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    """Returns the numpy module, or None if it is not installed. It is imported on first use only, as it is slow to
+    import and most users of the package never need it."""
+
+    try:
+        import numpy
+    except ImportError:  # numpy is optional; pure-python fallbacks are used instead
+        return None
+    return numpy
 
 
 @dataclass
@@ -11,10 +40,400 @@ class EnergyData:
     date: str = ""
     energy_data: List[dict] = dataclasses.field(default_factory=list)
 
+    @classmethod
+    def from_json(cls, data: dict) -> "EnergyData":
+        """Builds an EnergyData object out of a stored document. Packed readings are unpacked, followed by any reading
+        that was appended to the document since. Any other field of the document is ignored."""
+
+        energy_data = cls()
+
+        if data:
+            if "date" in data:
+                energy_data.date = data["date"]
+            if "energy_data" in data:
+                energy_data.energy_data = data["energy_data"]
+            if data.get(PACKED_FIELD):
+                # Readings appended since the document was packed are merged into the packed ones, as appends do
+                energy_data.energy_data = merge_readings(unpack(data[PACKED_FIELD]), energy_data.energy_data)
+
+        return energy_data
+
     def as_json(self, *, string):
-        as_dict = asdict(self)
+        # Unlike dataclasses.asdict, no deep copy takes place: the returned dict shares the readings of this object
+        as_dict = {"date": self.date, "energy_data": self.energy_data}
 
         if string:
             return json.dumps(as_dict)
         else:
             return as_dict
+
+    def as_bytes(self) -> bytes:
+        """Returns the UTF-8 encoded JSON representation of the object, using the fastest available JSON backend."""
+
+        return dumps(self.as_json(string=False))
+
+    def iter_json(self, chunk_size: int = 65536) -> Iterator[bytes]:
+        """Yields the UTF-8 encoded JSON representation of the object in chunks of about `chunk_size` bytes."""
+
+        return iter_dumps(self.as_json(string=False), chunk_size)
+
+
+def _timestamp_of(reading: dict):
+    """Returns the timestamp of a reading, or None if it has no finite numeric one."""
+
+    timestamp = reading.get(TIMESTAMP_FIELD)
+    if type(timestamp) in (int, float) and math.isfinite(timestamp):
+        return timestamp
+    return None
+
+
+def _sorted_unique(readings: List[dict]) -> List[dict]:
+    """Sorts timestamped readings, keeping only the last one of every timestamp."""
+
+    unique = []
+    last = None
+    for reading in sorted(readings, key=_timestamp_of):
+        timestamp = _timestamp_of(reading)
+        if unique and timestamp == last:
+            unique[-1] = reading
+        else:
+            unique.append(reading)
+        last = timestamp
+    return unique
+
+
+def merge_readings(stored: List[dict], incoming: Iterable[dict]) -> List[dict]:
+    """Merges a batch of incoming readings into the stored readings of a document, keeping them sorted by timestamp
+    and unique per timestamp. An incoming reading replaces a stored one of the same timestamp. Readings without a
+    numeric timestamp are kept after all others, in arrival order.
+    Only the incoming batch is sorted; it is then merged with the stored readings in a single linear pass, as they are
+    sorted already. Stored readings that turn out not to be (e.g. of documents written before appends kept them so) are
+    sorted once, after which they stay sorted. Returns a new list.
+
+    This is mirrored by the `append` update handler of the CouchDB adapter, and must be kept in sync with it.
+    """
+
+    timed = []
+    untimed = []
+    ordered = True
+    last = None
+    for reading in stored:
+        timestamp = _timestamp_of(reading)
+        if timestamp is None:
+            untimed.append(reading)
+            continue
+        if timed and timestamp <= last:
+            ordered = False
+        timed.append(reading)
+        last = timestamp
+
+    if not ordered:
+        timed = _sorted_unique(timed)
+
+    batch = []
+    for reading in incoming:
+        (batch if _timestamp_of(reading) is not None else untimed).append(reading)
+    batch = _sorted_unique(batch)
+
+    # Readings usually arrive in order, so the batch tends to fit right after the stored readings
+    if not timed or not batch or _timestamp_of(batch[0]) > _timestamp_of(timed[-1]):
+        return timed + batch + untimed
+
+    merged = []
+    i = j = 0
+    while i < len(timed) and j < len(batch):
+        a, b = _timestamp_of(timed[i]), _timestamp_of(batch[j])
+        if a < b:
+            merged.append(timed[i])
+            i += 1
+        elif a > b:
+            merged.append(batch[j])
+            j += 1
+        else:
+            merged.append(batch[j])
+            i += 1
+            j += 1
+
+    merged.extend(timed[i:])
+    merged.extend(batch[j:])
+    return merged + untimed
+
+
+def _as_column(values: list) -> Union[array, list]:
+    """Packs the values of a single field in the most compact column type that can hold them: a signed 64-bit integer
+    array, a double array (with NaN for missing values), or a plain list for anything non-numeric."""
+
+    numeric = True
+    integral = True
+    for value in values:
+        if value is _MISSING:
+            integral = False
+        elif type(value) is float:
+            integral = False
+        elif type(value) is not int:
+            numeric = False
+            break
+
+    if numeric and integral:
+        try:
+            return array("q", values)
+        except OverflowError:
+            pass
+
+    if numeric:
+        return array("d", [math.nan if value is _MISSING else value for value in values])
+
+    return values
+
+
+@dataclass
+class ColumnarEnergyData:
+    """A memory-efficient, column-oriented variant of EnergyData. Each field of the readings is kept in its own typed
+    array, instead of repeating it in a dict per reading. Readings are always kept sorted by their timestamp, and
+    readings without a timestamp are kept after all others, as `merge_readings` does.
+
+    Numeric fields are stored as 64-bit integers or doubles; readings missing a numeric field hold NaN in its place.
+    Any other field is kept in a plain list. The timestamp column is the exception: it only holds the timestamps of the
+    timed readings, which come first, so that it stays a sorted index (of integers, if they all are) and is never
+    padded with NaN. It is shorter than the other columns if some readings have no timestamp.
+    """
+
+    date: str = ""
+    columns: Dict[str, Union[array, list]] = dataclasses.field(default_factory=dict)
+
+    def __post_init__(self):
+        timestamps = self.columns.get(TIMESTAMP_FIELD)
+        if timestamps is None:
+            return
+
+        timed = [i for i, timestamp in enumerate(timestamps) if timestamp is not _MISSING and timestamp == timestamp]
+        if len(timed) == len(timestamps) and not any(a > b for a, b in zip(timestamps, timestamps[1:])):
+            return
+
+        # Timed readings first, in order, followed by the untimed ones, in their original order
+        order = sorted(timed, key=timestamps.__getitem__)
+        untimed = sorted(set(range(len(self))) - set(timed))
+        for field, column in self.columns.items():
+            reordered = [column[i] for i in (order if field == TIMESTAMP_FIELD else order + untimed)]
+            self.columns[field] = array(column.typecode, reordered) if isinstance(column, array) else reordered
+
+    @classmethod
+    def from_energy_data(cls, energy_data: EnergyData) -> "ColumnarEnergyData":
+        readings = energy_data.energy_data
+
+        # Readings without a timestamp go last, and the timestamp column is left without them
+        timed = [reading for reading in readings if reading.get(TIMESTAMP_FIELD, _MISSING) is not _MISSING]
+        if len(timed) < len(readings):
+            readings = timed + [reading for reading in readings if reading.get(TIMESTAMP_FIELD, _MISSING) is _MISSING]
+
+        fields = {}
+        for reading in readings:
+            fields.update(dict.fromkeys(reading))
+
+        columns = {field: _as_column([reading.get(field, _MISSING) for reading in readings]) for field in fields}
+        if TIMESTAMP_FIELD in columns:
+            columns[TIMESTAMP_FIELD] = _as_column([reading[TIMESTAMP_FIELD] for reading in timed])
+
+        return cls(energy_data.date, columns)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "ColumnarEnergyData":
+        return cls.from_energy_data(EnergyData.from_json(data))
+
+    def to_energy_data(self) -> EnergyData:
+        """Converts back to the dict-per-reading representation. Missing values are omitted from the dicts."""
+
+        readings = [{} for _ in range(len(self))]
+
+        for field, column in self.columns.items():
+            nan_means_missing = isinstance(column, array) and column.typecode == "d"
+            for reading, value in zip(readings, column):
+                if value is _MISSING or (nan_means_missing and value != value):
+                    continue
+                reading[field] = value
+
+        return EnergyData(self.date, readings)
+
+    def as_json(self, *, string):
+        return self.to_energy_data().as_json(string=string)
+
+    def __len__(self):
+        return max((len(column) for column in self.columns.values()), default=0)
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self.columns)
+
+    def column(self, field: str):
+        """Returns the values of `field`. Numeric columns are returned as (zero-copy) numpy arrays if numpy is
+        installed, and as typed arrays otherwise."""
+
+        column = self.columns[field]
+        numpy = _numpy()
+        if numpy is not None and isinstance(column, array):
+            return numpy.frombuffer(column, dtype=column.typecode)
+        return column
+
+    def _timestamps(self) -> array:
+        if TIMESTAMP_FIELD not in self.columns:
+            raise ValueError(f"There is no '{TIMESTAMP_FIELD}' field to index by")
+        return self.columns[TIMESTAMP_FIELD]
+
+    def slice(self, start=None, end=None) -> "ColumnarEnergyData":
+        """Returns the readings whose timestamp lies in [start, end), found by binary search. Readings without a
+        timestamp lie in no range, so they are only kept if both bounds are omitted, as `protocol.filter_readings` does.
+
+        start -- The first timestamp to include. If omitted, slicing starts from the first reading.
+        end -- The first timestamp to exclude. If omitted, slicing stops at the last (timed) reading.
+        """
+
+        timestamps = self._timestamps()
+        if start is None and end is None:
+            return ColumnarEnergyData(self.date, {field: column[:] for field, column in self.columns.items()})
+
+        lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+        hi = len(timestamps) if end is None else bisect.bisect_left(timestamps, end)
+
+        return ColumnarEnergyData(self.date, {field: column[lo:hi] for field, column in self.columns.items()})
+
+    def _numeric(self, field: str) -> array:
+        column = self.columns[field]
+        if not isinstance(column, array):
+            raise TypeError(f"Field '{field}' is not numeric")
+        return column
+
+    def count(self, field: str) -> int:
+        """Returns the number of readings that have a value for `field`."""
+
+        column = self._numeric(field)
+        if column.typecode == "q":
+            return len(column)
+        numpy = _numpy()
+        if numpy is not None:
+            return int(numpy.count_nonzero(~numpy.isnan(self.column(field))))
+        return sum(1 for value in column if value == value)
+
+    def sum(self, field: str):
+        column = self._numeric(field)
+        numpy = _numpy()
+        if numpy is not None:
+            return numpy.nansum(self.column(field)).item()
+        if column.typecode == "q":
+            return sum(column)
+        return math.fsum(value for value in column if value == value)
+
+    def mean(self, field: str) -> float:
+        count = self.count(field)
+        return self.sum(field) / count if count else math.nan
+
+    def min(self, field: str):
+        column = self._numeric(field)
+        if not self.count(field):
+            return math.nan
+        numpy = _numpy()
+        if numpy is not None:
+            return numpy.nanmin(self.column(field)).item()
+        return min(value for value in column if value == value)
+
+    def max(self, field: str):
+        column = self._numeric(field)
+        if not self.count(field):
+            return math.nan
+        numpy = _numpy()
+        if numpy is not None:
+            return numpy.nanmax(self.column(field)).item()
+        return max(value for value in column if value == value)
+
+    def resample(self, interval, how: str = "mean") -> "ColumnarEnergyData":
+        """Groups the readings in consecutive buckets of `interval` (in timestamp units, aligned to 0), and aggregates
+        every numeric field per bucket. Empty buckets are omitted, and non-numeric fields are dropped.
+        Returns a new object, whose timestamps are the starts of the buckets.
+
+        interval -- The width of each bucket
+        how -- The aggregate applied to each bucket: "mean", "sum", "min", "max" or "count"
+        """
+
+        if how not in ("mean", "sum", "min", "max", "count"):
+            raise ValueError(f"Unknown aggregate: {how}")
+
+        timestamps = self._timestamps()
+
+        if _numpy() is not None:
+            return self._resample_vectorized(interval, how)
+
+        # Readings are sorted, so every bucket is a contiguous run of them
+        starts = []
+        bounds = []
+        for i, timestamp in enumerate(timestamps):
+            bucket = timestamp // interval * interval
+            if not starts or bucket != starts[-1]:
+                starts.append(bucket)
+                bounds.append(i)
+        bounds.append(len(timestamps))
+
+        columns = {TIMESTAMP_FIELD: _as_column(starts)}
+        for field, column in self.columns.items():
+            if field == TIMESTAMP_FIELD or not isinstance(column, array):
+                continue
+
+            values = []
+            for lo, hi in zip(bounds, bounds[1:]):
+                bucket = ColumnarEnergyData(columns={field: column[lo:hi]})
+                values.append(getattr(bucket, how)(field))
+            columns[field] = _as_column(values)
+
+        return ColumnarEnergyData(self.date, columns)
+
+    def _resample_vectorized(self, interval, how: str) -> "ColumnarEnergyData":
+        """numpy implementation of `resample`, using a single reduction per field."""
+
+        numpy = _numpy()
+
+        buckets = self.column(TIMESTAMP_FIELD) // interval * interval
+        if not len(buckets):
+            return ColumnarEnergyData(self.date, {TIMESTAMP_FIELD: array("q")})
+
+        bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+
+        columns = {TIMESTAMP_FIELD: _as_column(buckets[bounds].tolist())}
+        for field, column in self.columns.items():
+            if field == TIMESTAMP_FIELD or not isinstance(column, array):
+                continue
+
+            # Integer columns are aggregated as they are, as doubles cannot hold every 64-bit integer
+            values = self.column(field)[:len(buckets)]
+            if column.typecode == "q":
+                present = numpy.ones(len(values), dtype=bool)
+                lowest, highest = numpy.minimum, numpy.maximum
+            else:
+                present = ~numpy.isnan(values)
+                lowest, highest = numpy.fmin, numpy.fmax
+            counts = numpy.add.reduceat(present, bounds)
+
+            if how == "count":
+                result = counts
+            elif how == "min":
+                result = lowest.reduceat(values, bounds)
+            elif how == "max":
+                result = highest.reduceat(values, bounds)
+            else:
+                sums = numpy.add.reduceat(numpy.where(present, values, 0), bounds)
+                if how == "sum":
+                    result = sums
+                else:
+                    with numpy.errstate(invalid="ignore", divide="ignore"):
+                        result = sums / counts
+
+            columns[field] = _as_column(result.tolist())
+
+        return ColumnarEnergyData(self.date, columns)
+
+
+@dataclass
+class BulkResult:
+    """The outcome of writing a single document as part of a bulk operation."""
+
+    id: str
+    ok: bool
+    rev: str = ""
+    error: str = ""
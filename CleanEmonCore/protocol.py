@@ -0,0 +1,1320 @@
+"""The CouchDB requests sent by the database adapters, the interpretation of their responses, and the flows that
+combine them into whole operations
+
+Nothing here performs any I/O: functions build Request objects, turn the decoded responses into results, and flows
+(see below) take every decision of an operation, such as when to retry an append or to roll a document over. The
+blocking and the asyncio adapters only differ in how they send requests, so that every path, parameter and body, and
+every decision taken on a response, is defined once for both of them.
+"""
+
+import datetime
+import heapq
+import json
+import threading
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Generator
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from .codec import JSON_ENCODING
+from .codec import PACKED_ENCODING
+from .codec import PACKED_FIELD
+from .codec import ZLIB
+from .codec import pack
+from .design import APPLIED_BATCHES_LIMIT
+from .design import DESIGN_DOCUMENT
+from .design import DESIGN_FUNCTIONS
+from .design import READINGS_DESIGN_DOCUMENT
+from .design import READINGS_DESIGN_FUNCTIONS
+from .design import design_conflicts
+from .design import merge_design_functions
+from .jsonstream import loads
+from .models import BulkResult
+from .models import EnergyData
+from .models import TIMESTAMP_FIELD
+from .models import _timestamp_of
+from .models import merge_readings
+from .rollups import GROUP_LEVELS
+from .rollups import Rollup
+from .rollups import aggregate
+from .rollups import key_parts
+from .rollups import merge_rollups
+from .rollups import timestamp_of
+
+# Outcomes of a write that may be refused because of a concurrent one
+DONE = "done"
+FULL = "full"  # Done, and the document has reached the rollover threshold
+SEALED = "sealed"  # Refused, as the document was rolled over by another writer
+STALE = "stale"  # Refused, as some of the rows belong to an older chunk of the document
+CONFLICT = "conflict"  # Refused, as the document was modified concurrently. It is worth retrying after a backoff.
+MISSING = "missing"  # Refused, as the update handler does not exist (anymore)
+FAILED = "failed"
+
+
+@dataclass
+class Request:
+    """A request to the CouchDB server, relative to its endpoint."""
+
+    method: str
+    path: str
+    params: Optional[dict] = None
+    body: Any = None  # Any json-serializable object
+    read: Optional[bool] = None  # Whether a replica may serve it. If None, only GET and HEAD requests are.
+    document: bool = False  # Whether the body holds whole documents, which are worth streaming when large
+    changes: Tuple[str, ...] = ()  # The ids of the documents the request may alter, e.g. to be dropped from a cache
+
+
+def ok(status: int) -> bool:
+    return 200 <= status < 400
+
+
+def decode(payload: bytes) -> Any:
+    """Returns the decoded json body of a response, or None if it is empty or not json."""
+
+    if not payload:
+        return None
+
+    try:
+        return loads(payload)
+    except ValueError:
+        return None
+
+
+def write_outcome(status: int) -> str:
+    """Returns the outcome of a plain document write: DONE, CONFLICT or FAILED."""
+
+    if ok(status):
+        return DONE
+    return CONFLICT if status == 409 else FAILED
+
+
+# --- Databases and documents ---
+
+def put_database(name: str) -> Request:
+    return Request("PUT", f"/{name}")
+
+
+def delete_database(name: str) -> Request:
+    return Request("DELETE", f"/{name}")
+
+
+def get_document(db: str, name: str) -> Request:
+    return Request("GET", f"/{db}/{name}")
+
+
+def parse_document(status: int, data: Any) -> dict:
+    """Returns the fetched document, or an empty dict if it could not be fetched."""
+
+    return data if ok(status) and isinstance(data, dict) else {}
+
+
+def put_document(db: str, name: str, doc: dict) -> Request:
+    return Request("PUT", f"/{db}/{name}", body=doc, document=True, changes=(name,))
+
+
+def delete_revision(db: str, name: str, rev: str) -> Request:
+    return Request("DELETE", f"/{db}/{name}", params={"rev": rev}, changes=(name,))
+
+
+def closed(doc: dict) -> bool:
+    """Returns whether the fetched document `doc` holds the data of a past date. Such documents are no longer written
+    to, so a cached copy of them never needs to be revalidated."""
+
+    return doc.get("date", "") not in ("", None) and doc["date"] < datetime.date.today().isoformat()
+
+
+def uuids(count: int) -> Request:
+    return Request("GET", "/_uuids", params={"count": count})
+
+
+def parse_uuids(data: dict) -> List[str]:
+    """Returns the generated UUIDs in reverse order, so that they can be handed out by pop()."""
+
+    return list(reversed(data["uuids"]))
+
+
+def encode_readings(doc: dict, encoding: str, compression: str) -> dict:
+    """Stores the readings of `doc` in the given encoding, in-place. The `energy_data` of the document must hold all of
+    its readings, as any packed ones are replaced.
+    Returns the document.
+    """
+
+    if encoding == PACKED_ENCODING:
+        doc[PACKED_FIELD] = pack(doc.get("energy_data", []), compression)
+        doc["energy_data"] = []
+    elif PACKED_FIELD in doc:
+        # Set rather than removed, as `_update_document` merges the document with the stored one
+        doc[PACKED_FIELD] = None
+
+    return doc
+
+
+def append_locally(doc: dict, rows: List[dict], batch_id: str = None) -> Optional[dict]:
+    """Merges `rows` into the readings of the fetched document `doc` (or a new one, if it is empty), in-place, exactly
+    as the `append` update handler does server-side.
+    Returns the document, or None if the batch `batch_id` has already been applied to it.
+    """
+
+    if not doc:
+        doc.update(EnergyData().as_json(string=False))
+
+    if batch_id:
+        applied = doc.get("applied_batches", [])
+        if batch_id in applied:
+            return None
+        doc["applied_batches"] = (applied + [batch_id])[-APPLIED_BATCHES_LIMIT:]
+
+    doc["energy_data"] = merge_readings(EnergyData.from_json(doc).energy_data, rows)
+    return doc
+
+
+def replace_readings(doc: dict, data: EnergyData) -> Tuple[dict, List[str]]:
+    """Returns a copy of the stored document `doc` holding the readings of `data` instead of its own, along with the
+    ids of its chunks, which are no longer part of it and should be deleted once the copy is stored."""
+
+    chunks = doc.get("chunks") or []
+    doc = dict(doc, energy_data=data.energy_data)
+    if chunks:
+        # The new readings replace those of every chunk of the document as well
+        doc.update(chunks=[], sealed=False)
+    return doc, chunks
+
+
+# --- Design document ---
+
+def put_design(db: str, design: dict, document: str = DESIGN_DOCUMENT) -> Request:
+    return Request("PUT", f"/{db}/{document}", body=design, changes=(document,))
+
+
+# --- Appends and rollover ---
+
+def append(db: str, document: str, rows: List[dict], batch_id: str = None) -> Request:
+    """Posts rows to the `append` update handler. POST is never retried by the transports, so that a batch cannot be
+    applied twice."""
+
+    body = {"energy_data": rows}
+    if batch_id:
+        body["batch_id"] = batch_id
+    return Request("POST", f"/{db}/{DESIGN_DOCUMENT}/_update/append/{document}", body=body, changes=(document,))
+
+
+def append_outcome(status: int, data: Any, chunk_readings: int = 0) -> str:
+    """Returns the outcome of a server-side append: DONE (or FULL, once the document holds `chunk_readings` readings),
+    SEALED, STALE, CONFLICT, MISSING or FAILED."""
+
+    data = data if isinstance(data, dict) else {}
+
+    if ok(status):
+        return FULL if chunk_readings and data.get("count", 0) >= chunk_readings else DONE
+    if status == 404:
+        return MISSING
+    if status != 409:
+        return FAILED
+    if data.get("error") in (SEALED, STALE):
+        return data["error"]
+    return CONFLICT
+
+
+def chunk_ids(db: str, document: str) -> Request:
+    return Request("GET", f"/{db}/{DESIGN_DOCUMENT}/_show/chunks/{document}")
+
+
+def parse_chunk_ids(status: int, data: Any) -> List[str]:
+    return data.get("chunks", []) if ok(status) and isinstance(data, dict) else []
+
+
+def seal(db: str, document: str) -> Request:
+    return Request("POST", f"/{db}/{DESIGN_DOCUMENT}/_update/seal/{document}", changes=(document,))
+
+
+def new_chunk(db: str, document: str, chunks: List[str], sealed: Any) -> Tuple[str, Request]:
+    """Returns the id of the chunk that follows `chunks`, along with the request that creates it. The id is derived from
+    the number of chunks, so that writers racing to roll over the same chunk end up with the same new one.
+
+    sealed -- The decoded response of sealing the previous chunk
+    """
+
+    chunk = f"{document}.{len(chunks) + 1}"
+    sealed = sealed if isinstance(sealed, dict) else {}
+
+    # Batches applied to the sealed chunk must still be recognized, if they are ever re-sent
+    body = {"chunk_of": document, "energy_data": [], "applied_batches": sealed.get("applied_batches", [])}
+
+    # The new chunk only takes readings newer than those of the sealed one, which keeps their time ranges disjoint
+    if sealed.get("last") is not None:
+        body["floor"] = sealed["last"]
+
+    return chunk, Request("PUT", f"/{db}/{chunk}", body=body, changes=(chunk,))
+
+
+def last_timestamp(doc: dict):
+    """Returns the last timestamp of the readings of the fetched document `doc` (or its floor, if it holds no newer
+    one), exactly as the `seal` update handler does server-side. Returns None if there is none at all."""
+
+    last = doc.get("floor")
+    packed = doc.get(PACKED_FIELD) or {}
+    for timestamp in [packed.get("last")] + [_timestamp_of(reading) for reading in doc.get("energy_data") or []]:
+        if timestamp is not None and (last is None or timestamp > last):
+            last = timestamp
+
+    return last
+
+
+def split_stale(rows: List[dict], floor) -> Tuple[List[dict], List[dict]]:
+    """Splits rows into those that belong to a chunk older than one of the given floor, and the rest of them. Rows
+    without a timestamp always belong to the newest chunk."""
+
+    if floor is None:
+        return [], rows
+
+    stale = []
+    fresh = []
+    for row in rows:
+        timestamp = _timestamp_of(row)
+        (stale if timestamp is not None and timestamp <= floor else fresh).append(row)
+    return stale, fresh
+
+
+def add_chunk(db: str, document: str, chunk: str) -> Request:
+    return Request("POST", f"/{db}/{DESIGN_DOCUMENT}/_update/add_chunk/{document}", body={"chunk": chunk},
+                   changes=(document,))
+
+
+def merge_chunks(doc: dict, chunk_docs: Iterable[dict]) -> dict:
+    """Returns the document `doc` with the readings of its (fetched) chunks merged into its own, in order (see
+    `models.merge_readings`). The time ranges of the chunks are disjoint, so this amounts to joining them, but a
+    timestamp that is still stored in two chunks (e.g. by an older version) is kept once, with its newest reading.
+    """
+
+    energy_data = EnergyData.from_json(doc).energy_data
+    for chunk in chunk_docs:
+        energy_data = merge_readings(energy_data, EnergyData.from_json(chunk).energy_data)
+
+    merged = dict(doc, energy_data=energy_data)
+    merged.pop(PACKED_FIELD, None)
+    return merged
+
+
+# --- Many documents at once ---
+
+def all_docs(db: str, ids: List[str], *, include_docs: bool = False) -> Request:
+    params = {"include_docs": "true"} if include_docs else None
+    return Request("POST", f"/{db}/_all_docs", params=params, body={"keys": ids}, read=True)
+
+
+def parse_deletions(status: int, data: Any) -> List[dict]:
+    """Returns a deletion stub for every existing document listed by an `_all_docs` response, to be bulk-written."""
+
+    if not ok(status) or not isinstance(data, dict):
+        return []
+
+    return [{"_id": row["id"], "_rev": row["value"]["rev"], "_deleted": True}
+            for row in data.get("rows", []) if "value" in row]
+
+
+def bulk_docs(db: str, docs: List[dict]) -> Request:
+    return Request("POST", f"/{db}/_bulk_docs", body={"docs": docs}, document=True,
+                   changes=tuple(doc["_id"] for doc in docs))
+
+
+def parse_bulk_docs(docs: List[dict], status: int, data: Any) -> List[BulkResult]:
+    """Returns the outcome of every document of a `_bulk_docs` request, in order."""
+
+    if not ok(status) or not isinstance(data, list):
+        return [BulkResult(doc["_id"], False, error=f"http_{status}") for doc in docs]
+
+    results = []
+    for doc, outcome in zip(docs, data):
+        if "error" in outcome:
+            results.append(BulkResult(doc["_id"], False, error=outcome["error"]))
+        else:
+            results.append(BulkResult(doc["_id"], True, rev=outcome.get("rev", "")))
+    return results
+
+
+def created_dates(docs: List[dict], results: List[BulkResult]) -> Iterator[Tuple[str, str]]:
+    """Yields the (date, document id) of every new document a `_bulk_docs` request created."""
+
+    for doc, result in zip(docs, results):
+        if result.ok and "_rev" not in doc and doc.get("date"):
+            yield doc["date"], doc["_id"]
+
+
+# --- Views ---
+
+def dates_view(db: str, **params) -> Request:
+    """Queries the get_dates view. Every given parameter is JSON-encoded, as CouchDB expects."""
+
+    keys = params.pop("keys", None)
+    params = {name: json.dumps(value) for name, value in params.items()}
+    path = f"/{db}/{DESIGN_DOCUMENT}/_view/get_dates"
+
+    # Long key lists do not fit in a query string; CouchDB accepts them in the body of a POST instead
+    if keys is not None:
+        return Request("POST", path, params=params, body={"keys": keys}, read=True)
+    return Request("GET", path, params=params)
+
+
+def parse_rows(status: int, data: Any) -> List[dict]:
+    """Returns the rows of a view response, or an empty list if the view could not be queried."""
+
+    return data.get("rows", []) if ok(status) and isinstance(data, dict) else []
+
+
+def first_by_key(rows: Iterable[dict], into: Dict[str, str] = None) -> Dict[str, str]:
+    """Maps the key of every row to its value. If a key is listed more than once, its first row wins, as views list
+    the rows of a key in the same order every time."""
+
+    index = {} if into is None else into
+    for row in rows:
+        index.setdefault(row["key"], row["value"])
+    return index
+
+
+def readings_view(db: str, start_ts, end_ts) -> Request:
+    params = {"startkey": json.dumps(start_ts), "endkey": json.dumps(end_ts), "inclusive_end": "false"}
+    return Request("GET", f"/{db}/{READINGS_DESIGN_DOCUMENT}/_view/by_timestamp", params=params)
+
+
+def rollups_view(db: str, field: str, start: int, end: int, resolution: int) -> Request:
+    params = {"startkey": json.dumps([field, *key_parts(start)]),
+              "endkey": json.dumps([field, *key_parts(end)]),
+              "inclusive_end": "false",
+              "group_level": GROUP_LEVELS[resolution]}
+    return Request("GET", f"/{db}/{READINGS_DESIGN_DOCUMENT}/_view/rollups", params=params)
+
+
+def parse_rollups(rows: Iterable[dict]) -> List[Rollup]:
+    return [Rollup(timestamp_of(row["key"][1:]), row["value"]["count"], row["value"]["sum"], row["value"]["min"],
+                   row["value"]["max"])
+            for row in rows]
+
+
+def packed_spans_view(db: str, start_ts) -> Request:
+    """Queries the packed_spans view for the packed documents that may hold readings from `start_ts` on."""
+
+    params = {"startkey": json.dumps([0, start_ts])}
+    return Request("GET", f"/{db}/{READINGS_DESIGN_DOCUMENT}/_view/packed_spans", params=params)
+
+
+def packed_span(doc: dict) -> Optional[Tuple[list, Any]]:
+    """Returns the key and the value that the packed_spans view emits for the stored document `doc`, exactly as the
+    view does server-side, or None if the readings of the document are not packed."""
+
+    packed = doc.get(PACKED_FIELD)
+    if not packed:
+        return None
+
+    last = packed.get("last")
+    if type(last) not in (int, float):
+        return [1], None
+
+    first = packed.get("first")
+    if type(first) not in (int, float):
+        first = None
+
+    for reading in doc.get("energy_data") or []:
+        timestamp = reading.get(TIMESTAMP_FIELD)
+        if type(timestamp) not in (int, float):
+            continue
+        if first is not None and timestamp < first:
+            first = timestamp
+        last = max(last, timestamp)
+
+    return [0, last], first
+
+
+def parse_packed_ids(rows: Iterable[dict], end_ts) -> List[str]:
+    """Returns the ids of the packed documents listed by the packed_spans view, except for those whose readings all
+    come at or after `end_ts`."""
+
+    return list(dict.fromkeys(row["id"] for row in rows if row["value"] is None or row["value"] < end_ts))
+
+
+def unpacked_readings(docs: Iterable[dict], start_ts, end_ts, fields: List[str] = None) -> List[dict]:
+    """Unpacks the readings of the given (fetched) packed documents, keeping those within [start_ts, end_ts).
+    Returns them in chronological order.
+    """
+
+    readings = []
+    for doc in docs:
+        readings.extend(filter_readings(EnergyData.from_json(doc).energy_data, fields, start_ts, end_ts))
+    return by_timestamp(readings)
+
+
+def merge_by_timestamp(*series: Iterable[dict]) -> Iterator[dict]:
+    """Merges series of readings that are each in chronological order, lazily."""
+
+    return heapq.merge(*series, key=lambda reading: reading[TIMESTAMP_FIELD])
+
+
+def aggregate_rollups(readings: Iterable[dict], resolution: int) -> List[Rollup]:
+    """Aggregates raw readings client-side, for when the rollups view cannot be used."""
+
+    return sorted(aggregate(readings, [resolution]).values(), key=lambda rollup: rollup.timestamp)
+
+
+def by_timestamp(readings: List[dict]) -> List[dict]:
+    """Sorts readings gathered from many documents, in-place. Returns them."""
+
+    readings.sort(key=lambda reading: reading[TIMESTAMP_FIELD])
+    return readings
+
+
+# --- Reading windows ---
+
+def window(db: str, document: str, *, fields: List[str] = None, start=None, end=None,
+           server_side: bool = True) -> Request:
+    """Returns the request that streams the readings of `document`. If any filter is given and `server_side` is set,
+    it is applied by the `window` show function, so the filtered-out readings are never downloaded. Otherwise, the
+    whole document is requested, and `filter_readings` must be applied to its readings.
+    """
+
+    if not server_side or (fields is None and start is None and end is None):
+        return get_document(db, document)
+
+    params = {}
+    if fields is not None:
+        params["fields"] = ",".join(fields)
+    if start is not None:
+        params["start"] = str(start)
+    if end is not None:
+        params["end"] = str(end)
+    return Request("GET", f"/{db}/{DESIGN_DOCUMENT}/_show/window/{document}", params=params)
+
+
+def filter_readings(readings: Iterable[dict], fields: List[str] = None, start=None, end=None) -> Iterator[dict]:
+    """Keeps the readings within [start, end), stripped down to the given fields (and the timestamp). It mirrors the
+    `window` show function, so that it can be safely re-applied to its output."""
+
+    if fields is None and start is None and end is None:
+        yield from readings
+        return
+
+    for reading in readings:
+        timestamp = reading.get("timestamp")
+        if start is not None and (timestamp is None or timestamp < start):
+            continue
+        if end is not None and (timestamp is None or timestamp >= end):
+            continue
+        if fields is not None:
+            reading = {field: reading[field] for field in ["timestamp", *fields] if field in reading}
+        yield reading
+
+
+def batched(readings: Iterable[dict], batch_size: int) -> Iterator[List[dict]]:
+    """Groups readings in lists of (at most) `batch_size` readings."""
+
+    batch = []
+    for reading in readings:
+        batch.append(reading)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+# --- Flows ---
+#
+# A flow is a generator that carries out a whole operation, such as an append along with its retries and rollovers. It
+# performs no I/O: it yields every step it needs to be performed (a Request, or one of the steps below), is sent back
+# the result of the step, and finally returns the result of the operation. Each adapter runs flows with its own I/O
+# (see their `_run`), so that every decision is taken here, once for both of them. The result of a Request step is its
+# status code along with its decoded json body (or None, if the body is not json).
+
+Flow = Generator[Any, Any, Any]
+
+
+@dataclass
+class Fetch:
+    """A step that fetches a document. Its result is the document, or an empty dict if it could not be fetched."""
+
+    document: str
+
+
+@dataclass
+class FetchMany:
+    """A step that fetches many documents at once. Its result is an iterable of the documents that exist, in order."""
+
+    documents: List[str]
+
+
+@dataclass
+class Backoff:
+    """A step that sleeps before the next attempt of a conflicting write."""
+
+    seconds: float
+
+
+@dataclass
+class Install:
+    """A step that installs the design functions of the design document `document`, calling the `install_design` (or
+    `install_readings_design`) method of the adapter. Its result is whether the design document is up-to-date."""
+
+    document: str
+
+
+@dataclass
+class NewUuid:
+    """A step whose result is a server-generated UUID."""
+
+
+class AdapterState:
+    """The settings of a CouchDB adapter, and everything its flows keep track of between operations. Both adapters
+    derive from it, so that every flow is given the adapter itself as its state."""
+
+    def __init__(self, section):
+        self.endpoint = section["endpoint"].split(",")[0].strip()  # The primary, if replicas are listed as well
+        self.db = section["db_name"]
+        self.document = section["document_name"]  # Todo: deprecate
+        self.username = section["username"]
+        self.password = section["password"]
+
+        # Appends are applied server-side through an update handler, unless explicitly disabled
+        self.server_side_append = section.getboolean("server_side_append", fallback=True)
+        self.conflict_retries = section.getint("conflict_retries", fallback=5)
+        self.conflict_backoff = section.getfloat("conflict_backoff", fallback=0.05)
+        self.stream_chunk_size = section.getint("stream_chunk_size", fallback=65536)
+        self.bulk_chunk_size = section.getint("bulk_chunk_size", fallback=500)
+        self.uuid_block_size = section.getint("uuid_block_size", fallback=100)
+
+        # Once a document holds `chunk_readings` readings, it is sealed and appends roll over to a new chunk document.
+        # Rollover is disabled unless it is set.
+        self.chunk_readings = section.getint("chunk_readings", fallback=0)
+
+        # With the "packed" encoding, the readings of every document written as a whole are stored packed (see codec).
+        # Packed readings are invisible to the views, so range and rollup queries scan the documents instead.
+        self.encoding = section.get("encoding", fallback=JSON_ENCODING)
+        self.compression = section.get("compression", fallback=ZLIB)
+
+        self._design_installed = False
+        self._readings_design_installed = False
+
+        # Local date -> document id index. It is filled lazily, or all at once by `load_date_index`, and kept in sync
+        # by the documents created and deleted through this adapter.
+        self._date_index = {}
+        self._date_index_lock = threading.Lock()
+
+        # Local (head) document id -> id of its newest chunk, which is the one appends are posted to
+        self._tails = {}
+        self._tails_lock = threading.Lock()
+
+    def _resolve(self, document: str = None) -> str:
+        """Returns the given document, or the default one if omitted.
+
+        Throws:
+        AssertionError -- If no document can be found.
+        """
+
+        if not document:
+            document = self.document
+
+        assert document, "No document was supplied!"
+
+        return document
+
+    def _encode_readings(self, doc: dict) -> dict:
+        """Stores the readings of `doc` in the configured encoding, in-place (see `encode_readings`).
+        Returns the document.
+        """
+
+        return encode_readings(doc, self.encoding, self.compression)
+
+    def _backoff(self, attempt: int) -> Backoff:
+        """Returns the step that sleeps before the next attempt of a conflicting write."""
+
+        return Backoff(self.conflict_backoff * (2 ** attempt))
+
+    def _index_date(self, date: str, document_id: str):
+        """Records that `date` is stored in `document_id`. If the date is already known, the existing entry wins, as
+        the view would list it first as well."""
+
+        if date:
+            with self._date_index_lock:
+                self._date_index.setdefault(date, document_id)
+
+    def _unindex_document(self, document_id: str):
+        """Forgets every date that pointed to the (deleted) document `document_id`."""
+
+        with self._date_index_lock:
+            for date in [date for date, doc in self._date_index.items() if doc == document_id]:
+                del self._date_index[date]
+
+    def _set_tail(self, document: str, tail: str = None):
+        """Records the newest chunk of `document`, or forgets it if `tail` is omitted."""
+
+        with self._tails_lock:
+            if tail:
+                self._tails[document] = tail
+            else:
+                self._tails.pop(document, None)
+
+
+def install_design(state: AdapterState, document: str, functions: dict) -> Flow:
+    """Merges the given design functions into the design document `document`, retrying on conflicting writes. Missing
+    functions are added, and the ones installed by the adapters are upgraded if they differ (see
+    `design.merge_design_functions`). If a function of the same name that the adapters did not install differs (see
+    `design.design_conflicts`), nothing is written at all.
+    Returns True if the design document is up-to-date.
+    """
+
+    for attempt in range(state.conflict_retries + 1):
+        design = yield Fetch(document)
+
+        if design_conflicts(design, functions):
+            break
+
+        if not merge_design_functions(design, functions):
+            return True
+
+        status, _ = yield put_design(state.db, design, document)
+
+        outcome = write_outcome(status)
+        if outcome == DONE:
+            return True
+
+        if outcome != CONFLICT:
+            break
+
+        yield state._backoff(attempt)
+
+    return False
+
+
+def design_ready(state: AdapterState) -> Flow:
+    """Returns whether the functions of DESIGN_DOCUMENT can be used, installing them first if needed."""
+
+    if state._design_installed:
+        return True
+    return (yield Install(DESIGN_DOCUMENT))
+
+
+def readings_design_ready(state: AdapterState) -> Flow:
+    """Returns whether the views of READINGS_DESIGN_DOCUMENT can be used, installing them first if needed."""
+
+    if state._readings_design_installed:
+        return True
+    return (yield Install(READINGS_DESIGN_DOCUMENT))
+
+
+def design_functions(document: str) -> dict:
+    """Returns the design functions the adapters install in the design document `document`."""
+
+    return READINGS_DESIGN_FUNCTIONS if document == READINGS_DESIGN_DOCUMENT else DESIGN_FUNCTIONS
+
+
+def view_failed(state: AdapterState, status: int):
+    """Takes note of a failed query of a view of READINGS_DESIGN_DOCUMENT."""
+
+    if status == 404:
+        # The design document was removed behind our back; it will be reinstalled on the next call
+        state._readings_design_installed = False
+
+
+def create_document(state: AdapterState, name: str = None, initial_data: EnergyData = None) -> Flow:
+    """Creates a new document named `name` (or a new UUID), initialized with `initial_data`.
+    Returns the name of the document if creation was successful, and an empty string otherwise.
+    """
+
+    if not name:
+        name = yield NewUuid()
+
+    # Empty bodied requests cannot create new CouchDB Documents.
+    # Make sure no empty data are sent.
+    if not initial_data:
+        initial_data = EnergyData()
+
+    status, _ = yield put_document(state.db, name, state._encode_readings(initial_data.as_json(string=False)))
+
+    if not ok(status):
+        return ""
+
+    state._index_date(initial_data.date, name)
+    return name
+
+
+def create_raw_document(state: AdapterState, name: str, initial_data: dict = None) -> Flow:
+    """Creates a new document with arbitrary data named `name`, initialized with `initial_data`.
+    Returns the name of the document if creation was successful, and an empty string otherwise.
+    """
+
+    if not name:
+        return ""
+
+    # Empty bodied requests cannot create new CouchDB Documents.
+    # Make sure no empty data are sent.
+    if not initial_data:
+        initial_data = {}
+
+    status, _ = yield put_document(state.db, name, initial_data)
+
+    if not ok(status):
+        return ""
+
+    state._index_date(initial_data.get("date"), name)
+    return name
+
+
+def delete_document(state: AdapterState, name: str) -> Flow:
+    """Deletes the document `name` along with its chunks.
+    Returns True if the document was deleted.
+    """
+
+    doc = yield Fetch(name)
+    if "_rev" not in doc:
+        return False
+
+    status, _ = yield delete_revision(state.db, name, doc["_rev"])
+    if ok(status):
+        state._unindex_document(name)
+        yield from drop_chunks(state, name, doc.get("chunks", []))
+
+    return ok(status)
+
+
+def update_document(state: AdapterState, data: dict, document: str = None) -> Flow:
+    """Overwrites the given fields of the (default) document with `data`.
+    Returns True if the document was updated successfully.
+    """
+
+    document = state._resolve(document)
+    contents = yield Fetch(document)
+    contents.update(data or {})
+
+    status, _ = yield put_document(state.db, document, contents)
+    return ok(status)
+
+
+def fetch_meta(state: AdapterState) -> Flow:
+    """Returns the contents of the "meta" document, without its CouchDB fields."""
+
+    meta = yield Fetch("meta")
+    meta.pop("_id", None)
+    meta.pop("_rev", None)
+    return meta
+
+
+def fetch_energy_data(state: AdapterState, document: str = None) -> Flow:
+    """Returns the readings of the (default) document as an EnergyData object, merged from all of its chunks."""
+
+    return (yield from energy_data_of(state, (yield Fetch(state._resolve(document)))))
+
+
+def energy_data_of(state: AdapterState, doc: dict) -> Flow:
+    """Returns the fetched document `doc` as an EnergyData object, along with the readings of all of its chunks."""
+
+    chunks = doc.get("chunks")
+    if chunks:
+        doc = merge_chunks(doc, (yield FetchMany(chunks)))
+
+    return EnergyData.from_json(doc)
+
+
+def windows(state: AdapterState, document: str, fields: List[str] = None, start=None, end=None) -> Flow:
+    """Returns the requests that stream the readings of `document` and of its chunks, in order (see `window`). Any
+    filter is applied server-side, unless the design document cannot be installed.
+    Returns None instead if the readings are packed, as they can only be fetched and unpacked as a whole.
+    """
+
+    if state.encoding == PACKED_ENCODING:
+        return None
+
+    filtered = fields is not None or start is not None or end is not None
+    server_side = filtered and (yield from design_ready(state))
+
+    documents = [document]
+    if state.chunk_readings:
+        documents.extend((yield from chunks_of(state, document)))
+
+    return [window(state.db, doc, fields=fields, start=start, end=end, server_side=server_side) for doc in documents]
+
+
+def chunks_of(state: AdapterState, document: str) -> Flow:
+    """Returns the ids of the chunks of `document`, oldest first, without fetching any of their readings (unless the
+    design document cannot be installed)."""
+
+    if (yield from design_ready(state)):
+        return parse_chunk_ids(*(yield chunk_ids(state.db, document)))
+
+    return (yield Fetch(document)).get("chunks", [])
+
+
+def tail(state: AdapterState, document: str) -> Flow:
+    """Returns the id of the newest chunk of `document`, which is the document itself if it was never rolled over.
+    Unless rollover is enabled, the document is only looked up once it turns out to be sealed.
+    """
+
+    with state._tails_lock:
+        known = state._tails.get(document)
+
+    if known:
+        return known
+
+    if not state.chunk_readings:
+        return document
+
+    chunks = yield from chunks_of(state, document)
+    newest = chunks[-1] if chunks else document
+    state._set_tail(document, newest)
+
+    return newest
+
+
+def roll_over(state: AdapterState, document: str, tail_id: str, server_side: bool = True) -> Flow:
+    """Seals the chunk `tail_id` of `document` and registers a new, empty chunk after it. Every step is idempotent and
+    the id of the new chunk is derived from the number of chunks, so any writer can complete a rollover that was
+    interrupted half-way, while writers racing to roll over the same chunk end up with the same new chunk.
+
+    server_side -- Whether the chunks are sealed and registered by the update handlers, or by plain document writes
+    that do exactly the same, for when the handlers are not available
+    """
+
+    chunks = yield from chunks_of(state, document)
+    newest = chunks[-1] if chunks else document
+
+    if newest == tail_id:
+        if server_side:
+            status, sealed = yield seal(state.db, tail_id)
+            if not ok(status):
+                return
+        else:
+            sealed = yield from rewrite(state, tail_id, seal_locally)
+            if sealed is None:
+                return
+            sealed = {"applied_batches": sealed.get("applied_batches", []), "last": last_timestamp(sealed)}
+
+        newest, request = new_chunk(state.db, document, chunks, sealed)
+        yield request
+
+        if server_side:
+            status, _ = yield add_chunk(state.db, document, newest)
+            if not ok(status):
+                return
+        elif (yield from rewrite(state, document, lambda doc: add_chunk_locally(doc, newest))) is None:
+            return
+
+    state._set_tail(document, newest)
+
+
+def seal_locally(doc: dict) -> bool:
+    """Seals the fetched document `doc`, in-place, exactly as the `seal` update handler does server-side.
+    Returns False if it was already sealed.
+    """
+
+    if doc.get("sealed"):
+        return False
+    doc["sealed"] = True
+    return True
+
+
+def add_chunk_locally(doc: dict, chunk: str) -> bool:
+    """Registers `chunk` as the newest chunk of the fetched (head) document `doc`, in-place, exactly as the `add_chunk`
+    update handler does server-side.
+    Returns False if it was already registered.
+    """
+
+    chunks = doc.get("chunks") or []
+    if chunk in chunks:
+        return False
+    doc["chunks"] = chunks + [chunk]
+    return True
+
+
+def rewrite(state: AdapterState, document: str, change: Callable[[dict], bool]) -> Flow:
+    """Fetches `document`, alters it with `change` and writes it back, retrying on conflicting writes. `change` alters
+    the fetched document in-place, and returns False if it needs no write at all.
+    Returns the document as it was written (or found), or None if it is missing or could not be written.
+    """
+
+    for attempt in range(state.conflict_retries + 1):
+        doc = yield Fetch(document)
+        if not doc:
+            return None
+
+        if change(doc) is False:
+            return doc
+
+        status, _ = yield put_document(state.db, document, doc)
+
+        outcome = write_outcome(status)
+        if outcome == DONE:
+            return doc
+
+        if outcome != CONFLICT:
+            return None
+
+        yield state._backoff(attempt)
+
+    return None
+
+
+def route_readings(state: AdapterState, document: str, target: str, rows: List[dict]) -> Flow:
+    """Merges rows that are older than the floor of the chunk `target` into the older chunks of `document` they belong
+    to: each one goes to the newest chunk whose floor lies before its timestamp. Sealed chunks no longer take appends,
+    so they are rewritten as a whole; this only happens to readings that are re-sent after a rollover.
+    Returns True if every row was merged.
+    """
+
+    chunks = [document] + (yield from chunks_of(state, document))
+    chunks = chunks[:chunks.index(target)] if target in chunks else chunks
+    floors = {doc["_id"]: doc.get("floor") for doc in (yield FetchMany(chunks))}
+
+    owners = {}
+    for row in rows:
+        owner = document
+        for chunk in chunks:
+            if chunk in floors and (floors[chunk] is None or floors[chunk] < _timestamp_of(row)):
+                owner = chunk
+        owners.setdefault(owner, []).append(row)
+
+    def merge_into(group):
+        def change(doc):
+            doc["energy_data"] = merge_readings(EnergyData.from_json(doc).energy_data, group)
+            state._encode_readings(doc)
+        return change
+
+    for chunk, group in owners.items():
+        if (yield from rewrite(state, chunk, merge_into(group))) is None:
+            return False
+
+    return True
+
+
+def drop_chunks(state: AdapterState, document: str, chunks: List[str]) -> Flow:
+    """Deletes the given chunks of `document`, after its readings were replaced or the document itself was deleted."""
+
+    state._set_tail(document)
+
+    if not chunks:
+        return
+
+    docs = parse_deletions(*(yield all_docs(state.db, chunks)))
+    if docs:
+        yield from bulk_write(state, docs)
+
+
+def append_energy_data(state: AdapterState, rows: List[dict], document: str = None, batch_id: str = None) -> Flow:
+    """Merges the given rows into the readings of the (default) document. Unless `server_side_append` is disabled,
+    only the new rows are posted to the `append` update handler. If the handler cannot be installed, the whole document
+    is fetched, extended and stored back instead. In both cases, conflicting writes are retried, and the document is
+    rolled over once it holds `chunk_readings` readings.
+    Returns True if the rows were appended.
+    """
+
+    document = state._resolve(document)
+
+    if state.server_side_append:
+        appended = yield from append_server_side(state, rows, document, batch_id)
+        if appended is not None:
+            return appended
+
+    return (yield from append_client_side(state, rows, document, batch_id))
+
+
+def append_server_side(state: AdapterState, rows: List[dict], document: str, batch_id: str = None) -> Flow:
+    """Posts the given rows to the `append` update handler of the design document. The rows are appended to the
+    newest chunk of the document, which is rolled over once it holds `chunk_readings` readings. Rows that belong to an
+    older chunk are merged into it first (see `route_readings`).
+    Returns True or False depending on the outcome, or None if the update handler is not available.
+    """
+
+    if not (yield from design_ready(state)):
+        # Most probably, the user lacks the rights to alter design documents. Stick to the client-side path.
+        state.server_side_append = False
+        return None
+
+    for attempt in range(state.conflict_retries + 1):
+        target = yield from tail(state, document)
+
+        status, data = yield append(state.db, target, rows, batch_id)
+        outcome = append_outcome(status, data, state.chunk_readings)
+
+        if outcome in (DONE, FULL):
+            if outcome == FULL:
+                yield from roll_over(state, document, target)
+            return True
+
+        if outcome == MISSING:
+            # The design document was removed behind our back; it will be reinstalled on the next call
+            state._design_installed = False
+            return None
+
+        if outcome == FAILED:
+            return False
+
+        if outcome == SEALED:
+            # The document was rolled over by another writer; catch up with (or complete) its rollover
+            yield from roll_over(state, document, target)
+            continue
+
+        if outcome == STALE:
+            # Nothing was appended, so the stale rows are merged into their chunks before the rest is posted again
+            stale, rows = split_stale(rows, data["floor"])
+            if not (yield from route_readings(state, document, target, stale)):
+                return False
+            continue
+
+        yield state._backoff(attempt)
+
+    return False
+
+
+def append_client_side(state: AdapterState, rows: List[dict], document: str, batch_id: str = None) -> Flow:
+    """Fetches the newest chunk of the document, extends its data and writes it back, retrying whenever a concurrent
+    write is detected. It follows the rules of the `append` update handler: sealed chunks are skipped, rows that belong
+    to an older chunk are merged into it (see `route_readings`), and the chunk is rolled over once it holds
+    `chunk_readings` readings.
+    Returns True if the rows were appended.
+    """
+
+    for attempt in range(state.conflict_retries + 1):
+        target = yield from tail(state, document)
+        contents = yield Fetch(target)
+
+        if contents.get("sealed"):
+            yield from roll_over(state, document, target, server_side=False)
+            continue
+
+        stale, rows = split_stale(rows, contents.get("floor"))
+        if stale and not (yield from route_readings(state, document, target, stale)):
+            return False
+
+        contents = append_locally(contents, rows, batch_id)
+        if contents is None:
+            return True
+
+        count = len(contents["energy_data"])
+        status, _ = yield put_document(state.db, target, state._encode_readings(contents))
+
+        outcome = write_outcome(status)
+        if outcome == DONE and state.chunk_readings and count >= state.chunk_readings:
+            yield from roll_over(state, document, target, server_side=False)
+
+        if outcome != CONFLICT:
+            return outcome == DONE
+
+        yield state._backoff(attempt)
+
+    return False
+
+
+def load_date_index(state: AdapterState) -> Flow:
+    """Reads the whole get_dates view once and (re)builds the local date index out of it.
+    Returns the number of indexed dates.
+    """
+
+    index = first_by_key(parse_rows(*(yield dates_view(state.db))))
+
+    with state._date_index_lock:
+        state._date_index = index
+
+    return len(index)
+
+
+def document_id_for_date(state: AdapterState, date: str) -> Flow:
+    """Returns the id of the document of the given date, or an empty string if there is no such date. Known dates are
+    served by the local index, and unknown ones are looked up with a keyed view query, which transfers a single row.
+    """
+
+    with state._date_index_lock:
+        document_id = state._date_index.get(date)
+
+    if document_id:
+        return document_id
+
+    for row in parse_rows(*(yield dates_view(state.db, key=date))):
+        state._index_date(date, row["value"])
+        return row["value"]
+
+    return ""
+
+
+def document_ids_for_dates(state: AdapterState, dates: Iterable[str]) -> Flow:
+    """Returns a mapping from each of the given dates to the id of its document. Dates that have no document are
+    omitted. Every date missing from the local index is resolved by a single keyed view query.
+    """
+
+    dates = list(dict.fromkeys(dates))
+
+    with state._date_index_lock:
+        ids = {date: state._date_index[date] for date in dates if date in state._date_index}
+
+    missing = [date for date in dates if date not in ids]
+    if missing:
+        for row in parse_rows(*(yield dates_view(state.db, keys=missing))):
+            if row["key"] not in ids:
+                ids[row["key"]] = row["value"]
+                state._index_date(row["key"], row["value"])
+
+    return {date: ids[date] for date in dates if date in ids}
+
+
+def document_ids_between(state: AdapterState, start: str, end: str) -> Flow:
+    """Returns the ids of the documents of every date between `start` and `end` (both inclusive), in chronological
+    order, with a single view query."""
+
+    ids = {}
+    for row in parse_rows(*(yield dates_view(state.db, startkey=start, endkey=end))):
+        if row["key"] not in ids:
+            ids[row["key"]] = row["value"]
+            state._index_date(row["key"], row["value"])
+
+    return list(ids.values())
+
+
+def scan_readings(state: AdapterState, start_ts, end_ts, fields: List[str] = None) -> Flow:
+    """Gathers the readings within [start_ts, end_ts) by scanning every document, for when the by_timestamp view
+    cannot be used.
+    Returns them in chronological order.
+    """
+
+    ids = list(dict.fromkeys(row["value"] for row in parse_rows(*(yield dates_view(state.db)))))
+
+    readings = []
+    for doc in (yield FetchMany(ids)):
+        energy_data = yield from energy_data_of(state, doc)
+        readings.extend(filter_readings(energy_data.energy_data, fields, start_ts, end_ts))
+
+    return by_timestamp(readings)
+
+
+def packed_documents(state: AdapterState, start_ts, end_ts) -> Flow:
+    """Fetches the packed documents that may hold readings within [start_ts, end_ts), as listed by the packed_spans
+    view. The by_timestamp and rollups views skip them, so their readings must be unpacked client-side.
+    Returns None if the view cannot be queried.
+    """
+
+    status, data = yield packed_spans_view(state.db, start_ts)
+    if not ok(status):
+        view_failed(state, status)
+        return None
+
+    ids = parse_packed_ids(parse_rows(status, data), end_ts)
+    return (yield FetchMany(ids)) if ids else []
+
+
+def view_rollups(state: AdapterState, field: str, start: int, end: int, resolution: int) -> Flow:
+    """Reads the rollups of `field` off the (reduced) rollups view, grouped at the level of the resolution. The readings
+    of packed documents, which the view skips, are aggregated client-side and merged in.
+    Returns None if the views cannot be used, in which case all the readings must be aggregated client-side.
+    """
+
+    if not (yield from readings_design_ready(state)):
+        return None
+
+    packed = yield from packed_documents(state, start, end)
+    if packed is None:
+        return None
+
+    status, data = yield rollups_view(state.db, field, start, end, resolution)
+    if not ok(status):
+        view_failed(state, status)
+        return None
+
+    rollups = parse_rollups(parse_rows(status, data))
+    if packed:
+        rollups = merge_rollups(rollups, aggregate_rollups(unpacked_readings(packed, start, end, [field]), resolution))
+
+    return rollups
+
+
+def new_document(state: AdapterState, item: Union[EnergyData, dict]) -> dict:
+    """Returns the document that stores `item`: an EnergyData object, in the configured encoding, or a raw dict."""
+
+    if isinstance(item, EnergyData):
+        return state._encode_readings(item.as_json(string=False))
+    return dict(item)
+
+
+def bulk_write(state: AdapterState, docs: List[dict]) -> Flow:
+    """Writes all the given documents with a single `_bulk_docs` request. Documents without an `_id` get a new UUID.
+    Returns the outcome of every document, in the given order.
+    """
+
+    for doc in docs:
+        if not doc.get("_id"):
+            doc["_id"] = yield NewUuid()
+
+    results = parse_bulk_docs(docs, *(yield bulk_docs(state.db, docs)))
+    for date, document_id in created_dates(docs, results):
+        state._index_date(date, document_id)
+
+    return results
+
+
+def replace_dates(state: AdapterState, items: List[EnergyData]) -> Flow:
+    """Stores the data of the given dates with a single bulk write: the data of dates that are already stored replace
+    the existing ones (and their chunks), while new dates get a new document.
+    Returns the outcome of every document, in the given order.
+    """
+
+    ids = yield from document_ids_for_dates(state, [data.date for data in items])
+    stored = {doc["_id"]: doc for doc in (yield FetchMany(list(ids.values())))}
+
+    docs = []
+    rolled_over = {}
+    for data in items:
+        doc = stored.get(ids.get(data.date))
+        if doc:
+            doc, chunks = replace_readings(doc, data)
+            if chunks:
+                rolled_over[doc["_id"]] = chunks
+        else:
+            doc = data.as_json(string=False)
+        docs.append(state._encode_readings(doc))
+
+    results = yield from bulk_write(state, docs)
+    for result in results:
+        if result.ok and result.id in rolled_over:
+            yield from drop_chunks(state, result.id, rolled_over[result.id])
+
+    return results
+
+
+def update_energy_data_by_date(state: AdapterState, date: str, data: EnergyData) -> Flow:
+    """Replaces the readings of the given date (and of its chunks), or stores them in a new document.
+    Returns True if the readings were stored.
+    """
+
+    if not data:
+        data = EnergyData()
+
+    document = yield from document_id_for_date(state, date)
+    if not document:
+        return bool((yield from create_document(state, initial_data=data)))
+
+    contents, chunks = replace_readings((yield Fetch(document)), data)
+    state._encode_readings(contents)
+
+    updated = yield from update_document(state, contents, document)
+    if updated:
+        yield from drop_chunks(state, document, chunks)
+
+    return updated
+
+
+def fetch_readings(state: AdapterState, start_ts, end_ts, fields: List[str] = None) -> Flow:
+    """Gathers the readings within [start_ts, end_ts) off the by_timestamp view, along with those of the packed
+    documents that the view skips, or by scanning every document if the views cannot be used.
+    Returns them in chronological order.
+    """
+
+    if (yield from readings_design_ready(state)):
+        packed = yield from packed_documents(state, start_ts, end_ts)
+        if packed is not None:
+            status, data = yield readings_view(state.db, start_ts, end_ts)
+            if ok(status):
+                readings = filter_readings((row["value"] for row in parse_rows(status, data)), fields)
+                return list(merge_by_timestamp(readings, unpacked_readings(packed, start_ts, end_ts, fields)))
+            view_failed(state, status)
+
+    return (yield from scan_readings(state, start_ts, end_ts, fields))
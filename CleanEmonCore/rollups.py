@@ -0,0 +1,154 @@
+"""Pre-aggregated series of readings (rollups) at coarser resolutions
+
+Timestamps are taken to be Unix times in seconds, and buckets are aligned to UTC.
+"""
+
+import calendar
+import math
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import timezone
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+
+from .models import TIMESTAMP_FIELD
+
+# The supported resolutions (bucket widths), in seconds
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+RESOLUTIONS = (DAY, HOUR, MINUTE)  # Coarsest first
+
+# How many items of a [field, year, month, day, hour, minute] key identify a bucket of each resolution
+GROUP_LEVELS = {DAY: 4, HOUR: 5, MINUTE: 6}
+
+# The fewest buckets a span should be split in, when the resolution is picked automatically
+DEFAULT_MIN_POINTS = 24
+
+
+@dataclass
+class Rollup:
+    """The aggregates of a single field over a single bucket."""
+
+    timestamp: int  # The start of the bucket
+    count: int
+    sum: float
+    min: float
+    max: float
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+
+def choose_resolution(start_ts, end_ts, min_points: int = DEFAULT_MIN_POINTS) -> int:
+    """Returns the coarsest resolution that splits [start_ts, end_ts) in at least `min_points` buckets, or the finest
+    one if none does."""
+
+    for resolution in RESOLUTIONS:
+        if (end_ts - start_ts) / resolution >= min_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def rollup_span(start_ts, end_ts, resolution: int = None, min_points: int = DEFAULT_MIN_POINTS) -> Tuple[int, int, int]:
+    """Returns the resolution of a rollup query over [start_ts, end_ts), along with the bounds of its buckets, aligned
+    to the resolution.
+
+    resolution -- One of MINUTE, HOUR or DAY. If omitted, it is picked by choose_resolution.
+
+    Throws:
+    ValueError -- If the resolution is not supported.
+    """
+
+    if resolution is None:
+        resolution = choose_resolution(start_ts, end_ts, min_points)
+    if resolution not in GROUP_LEVELS:
+        raise ValueError(f"Unsupported resolution: {resolution}")
+
+    return resolution, bucket_of(start_ts, resolution), bucket_ceil(end_ts, resolution)
+
+
+def bucket_of(timestamp, resolution: int) -> int:
+    """Returns the start of the bucket `timestamp` falls in."""
+
+    return int(timestamp // resolution * resolution)
+
+
+def bucket_ceil(timestamp, resolution: int) -> int:
+    """Returns the start of the first bucket that begins at or after `timestamp`."""
+
+    return int(-(-timestamp // resolution) * resolution)
+
+
+def key_parts(timestamp) -> List[int]:
+    """Returns the [year, month, day, hour, minute] of `timestamp`, in UTC, as used by the keys of the rollups view."""
+
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    return [moment.year, moment.month, moment.day, moment.hour, moment.minute]
+
+
+def timestamp_of(parts: List[int]) -> int:
+    """The inverse of key_parts. Any omitted trailing part is taken as its lowest value."""
+
+    parts = list(parts) + [1, 1, 0, 0][len(parts) - 1:]
+    return calendar.timegm((*parts[:5], 0))
+
+
+def numeric_fields(reading: dict) -> Iterable[Tuple[str, float]]:
+    """Yields every (field, value) of the reading that can be aggregated."""
+
+    for field, value in reading.items():
+        if field != TIMESTAMP_FIELD and type(value) in (int, float) and value == value:
+            yield field, value
+
+
+def aggregate(readings: Iterable[dict], resolutions: Iterable[int] = RESOLUTIONS) -> Dict[tuple, Rollup]:
+    """Aggregates the readings per resolution, field and bucket.
+    Returns a dict keyed by (resolution, field, bucket). Readings without a numeric timestamp are skipped.
+    """
+
+    resolutions = tuple(resolutions)
+    rollups = {}
+
+    for reading in readings:
+        timestamp = reading.get(TIMESTAMP_FIELD)
+        if type(timestamp) not in (int, float):
+            continue
+
+        for field, value in numeric_fields(reading):
+            for resolution in resolutions:
+                bucket = bucket_of(timestamp, resolution)
+                rollup = rollups.get((resolution, field, bucket))
+                if rollup is None:
+                    rollups[(resolution, field, bucket)] = Rollup(bucket, 1, value, value, value)
+                else:
+                    rollup.count += 1
+                    rollup.sum += value
+                    rollup.min = min(rollup.min, value)
+                    rollup.max = max(rollup.max, value)
+
+    return rollups
+
+
+def merge_rollups(*series: Iterable[Rollup]) -> List[Rollup]:
+    """Combines rollups of the same field and resolution that were computed over different readings, bucket by bucket.
+    Returns them in chronological order.
+    """
+
+    merged = {}
+    for rollups in series:
+        for rollup in rollups:
+            into = merged.get(rollup.timestamp)
+            if into is None:
+                merged[rollup.timestamp] = Rollup(rollup.timestamp, rollup.count, rollup.sum, rollup.min, rollup.max)
+            else:
+                into.count += rollup.count
+                into.sum += rollup.sum
+                into.min = min(into.min, rollup.min)
+                into.max = max(into.max, rollup.max)
+
+    return sorted(merged.values(), key=lambda rollup: rollup.timestamp)
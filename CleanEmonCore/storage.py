@@ -0,0 +1,161 @@
+"""The storage interface shared by every backend, and the selection of a backend out of the config file"""
+
+from abc import ABC
+from abc import abstractmethod
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+
+from .config import load_config
+from .models import BulkResult
+from .models import EnergyData
+from .rollups import DEFAULT_MIN_POINTS
+from .rollups import Rollup
+from .rollups import rollup_span
+
+COUCHDB_BACKEND = "couchdb"
+SQLITE_BACKEND = "sqlite"
+
+
+class StorageBackend(ABC):
+    """Abstract Base Class for anything that stores energy data: one document per date, each holding the readings of
+    that date, plus a few documents of arbitrary data (such as "meta")."""
+
+    def close(self):
+        """Releases any resource held by the backend."""
+
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @abstractmethod
+    def create_document(self, name: str = None, *, initial_data: EnergyData = None) -> str:
+        """Creates a new document named `name` (or a generated one), initialized with `initial_data`.
+        Returns the name of the document if creation was successful, and an empty string otherwise.
+        """
+
+    @abstractmethod
+    def create_raw_document(self, name: str, *, initial_data: Dict = None) -> str:
+        """Creates a new document with arbitrary (json-serializable) data named `name`.
+        Returns the name of the document if creation was successful, and an empty string otherwise.
+        """
+
+    @abstractmethod
+    def delete_document(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def fetch_energy_data(self, *, document: str = None) -> EnergyData:
+        """Returns the contents of the given (or the default) document. If it cannot be fetched, an empty EnergyData
+        object is returned."""
+
+    @abstractmethod
+    def append_energy_data(self, *energy_data_list: EnergyData, document=None, batch_id: str = None) -> bool:
+        """Appends the readings of one or more EnergyData objects to the given (or the default) document, keeping its
+        readings sorted by timestamp and unique per timestamp. Appending again with the same `batch_id` is a no-op."""
+
+    @abstractmethod
+    def get_document_id_for_date(self, date: str) -> str:
+        """Returns the id of the document of the given date, or an empty string if there is none."""
+
+    @abstractmethod
+    def fetch_energy_data_by_date(self, date: str) -> EnergyData:
+        pass
+
+    @abstractmethod
+    def update_energy_data_by_date(self, date: str, data: EnergyData) -> bool:
+        """Replaces the readings of the given date, creating its document if needed."""
+
+    @abstractmethod
+    def fetch_energy_data_range(self, start: str, end: str) -> Iterator[EnergyData]:
+        """Yields an EnergyData object per stored date between `start` and `end` (both inclusive), in chronological
+        order."""
+
+    @abstractmethod
+    def fetch_readings(self, start_ts, end_ts, *, fields: List[str] = None) -> Iterator[dict]:
+        """Yields, in chronological order, the readings of any date whose timestamp lies in [start_ts, end_ts). If
+        `fields` are given, only these fields (and the timestamp) of each reading are kept."""
+
+    @abstractmethod
+    def fetch_meta(self) -> dict:
+        pass
+
+    def fetch_rollups(self, start_ts, end_ts, fields: List[str], *, resolution: int = None,
+                      min_points: int = DEFAULT_MIN_POINTS) -> Dict[str, List[Rollup]]:
+        """Returns the pre-aggregated count, sum, min and max of the given fields, per bucket of `resolution` seconds,
+        for every bucket that overlaps [start_ts, end_ts). The rollups are maintained by the backend as data is written,
+        so no raw reading is read at query time.
+        Returns a list of Rollup objects per field, in chronological order. Empty buckets are omitted.
+
+        resolution -- One of MINUTE, HOUR or DAY. If omitted, the coarsest resolution that splits the span in at least
+        `min_points` buckets is used.
+
+        Throws:
+        ValueError -- If the resolution is not supported.
+        """
+
+        resolution, start, end = rollup_span(start_ts, end_ts, resolution, min_points)
+        return {field: self._fetch_rollups(field, start, end, resolution) for field in fields}
+
+    @abstractmethod
+    def _fetch_rollups(self, field: str, start: int, end: int, resolution: int) -> List[Rollup]:
+        """Returns the rollups of `field` at `resolution`, whose buckets start within [start, end). Both bounds are
+        aligned to the resolution."""
+
+    def get_document_ids_for_dates(self, dates: Iterable[str]) -> Dict[str, str]:
+        """Returns a mapping from each of the given dates to the id of its document. Dates that have no document are
+        omitted."""
+
+        ids = {}
+        for date in dates:
+            document_id = self.get_document_id_for_date(date)
+            if document_id:
+                ids[date] = document_id
+        return ids
+
+    def fetch_many(self, dates: Iterable[str]) -> Iterator[EnergyData]:
+        """Yields an EnergyData object per date that has a document, in the given order."""
+
+        for document_id in self.get_document_ids_for_dates(dates).values():
+            yield self.fetch_energy_data(document=document_id)
+
+    def update_energy_data_by_dates(self, items: Iterable[EnergyData], *,
+                                    chunk_size: int = None) -> List[BulkResult]:
+        """Replaces the readings of many dates, creating their documents if needed. Returns the outcome of every date,
+        in the given order. `chunk_size` is a hint for backends that write in bulk."""
+
+        results = []
+        for data in items:
+            ok = self.update_energy_data_by_date(data.date, data)
+            results.append(BulkResult(self.get_document_id_for_date(data.date) if ok else "", ok,
+                                      error="" if ok else "failed"))
+        return results
+
+
+def open_storage(config_file: str) -> StorageBackend:
+    """Opens the storage backend selected by the `backend` option of the [DB] section of the config file: either
+    "couchdb" (the default) or "sqlite".
+
+    Throws:
+    ValueError -- If the backend is unknown.
+    """
+
+    cfg = load_config(config_file)
+
+    backend = cfg.get("DB", "backend", fallback=COUCHDB_BACKEND).strip().lower()
+
+    # Backends are imported on demand, so that none of them depends on the packages the others need
+    if backend == COUCHDB_BACKEND:
+        from .CouchDBAdapter import CouchDBAdapter
+        return CouchDBAdapter(config_file)
+
+    if backend == SQLITE_BACKEND:
+        from .SQLiteAdapter import SQLiteAdapter
+        return SQLiteAdapter(config_file)
+
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -19,13 +19,15 @@ def test_date_change():
 def test_stress_timer():
     class TimerObserver(Observer):
         def on_notify(self, *args, **kwargs):
+            event.stop()
             raise RuntimeError("Everything works as expected")
 
     event = Timer(2)
     TimerObserver(event)
 
-    with pytest.raises(RuntimeError, match="Everything works as expected"):
-        event.run()
+    # Errors of the observers are logged and recorded on the job, rather than stopping the scheduler
+    event.run()
+    assert str(event.job.last_error) == "Everything works as expected"
 
 
 @pytest.mark.skip(reason="This can only be checked when date changes")
@@ -37,9 +39,10 @@ def test_stress_date_change():
 
     class DateChangeObserver(Observer):
         def on_notify(self, *args, **kwargs):
+            event.stop()
             raise RuntimeError("Everything works as expected")
 
     DateChangeObserver(event)
 
-    with pytest.raises(RuntimeError, match="Everything works as expected"):
-        event.run()
+    event.run()
+    assert str(event.job.last_error) == "Everything works as expected"
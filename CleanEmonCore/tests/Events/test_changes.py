@@ -0,0 +1,102 @@
+import threading
+import time
+
+from pytest import fixture
+
+from CleanEmonCore.Events import ChangesFeed
+from CleanEmonCore.Events import Observer
+from CleanEmonCore.models import EnergyData
+
+DUMMY_DATE = "2000-01-01"
+
+
+class Recorder(Observer):
+    def __init__(self, observable):
+        super().__init__(observable)
+        self.calls = []
+        self.event = threading.Event()
+
+    def on_notify(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        self.event.set()
+
+
+@fixture
+def checkpoint(tmp_path):
+    return str(tmp_path / "changes.seq")
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_continuous_notifies_per_change(adapter, checkpoint):
+    feed = ChangesFeed(adapter, checkpoint=checkpoint, heartbeat=0.1)
+    recorder = Recorder(feed)
+    thread = threading.Thread(target=feed.run, daemon=True)
+    thread.start()
+
+    try:
+        # Wait for the feed to connect, so that "now" is well defined
+        time.sleep(0.2)
+
+        started = time.monotonic()
+        document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+        assert recorder.event.wait(5)
+        assert time.monotonic() - started < 1
+
+        adapter.install_design()
+        adapter.append_energy_data(EnergyData(DUMMY_DATE, [{"timestamp": 1}]), document=document)
+        assert wait_until(lambda: len(recorder.calls) >= 2)
+    finally:
+        feed.stop()
+        thread.join(5)
+
+    assert not thread.is_alive()
+    assert [call["change"]["id"] for call in recorder.calls] == [document, document]
+
+
+def test_resume_from_checkpoint(adapter, checkpoint):
+    first = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+
+    feed = ChangesFeed(adapter, feed="longpoll", since=0, checkpoint=checkpoint, timeout=0.2)
+    recorder = Recorder(feed)
+    assert feed.poll()
+    assert [change["id"] for change in recorder.calls[0]["changes"]] == [first]
+
+    second = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+
+    # A new feed over the same checkpoint only sees what happened after the last processed change
+    feed = ChangesFeed(adapter, feed="longpoll", since=0, checkpoint=checkpoint, timeout=0.2)
+    recorder = Recorder(feed)
+    assert feed.poll()
+    assert [change["id"] for change in recorder.calls[0]["changes"]] == [second]
+
+    # Nothing new: no notification at all
+    recorder.calls.clear()
+    assert feed.poll()
+    assert recorder.calls == []
+
+
+def test_include_docs_and_deletions(adapter, checkpoint):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, [{"timestamp": 1}]))
+
+    feed = ChangesFeed(adapter, feed="longpoll", since=0, include_docs=True, checkpoint=checkpoint, timeout=0.2)
+    recorder = Recorder(feed)
+    assert feed.poll()
+    assert recorder.calls[0]["changes"][0]["doc"]["energy_data"] == [{"timestamp": 1}]
+
+    adapter.delete_document(document)
+    assert feed.poll()
+    assert recorder.calls[1]["changes"][0]["deleted"]
+
+
+def test_failed_request(adapter, checkpoint):
+    adapter.db = "missing"
+    feed = ChangesFeed(adapter, feed="longpoll", since=0, checkpoint=checkpoint)
+
+    assert not feed.poll()
+    assert feed.last_error is not None
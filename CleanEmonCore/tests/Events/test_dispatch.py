@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from CleanEmonCore.Events import ASYNCIO
+from CleanEmonCore.Events import BLOCK
+from CleanEmonCore.Events import COALESCE
+from CleanEmonCore.Events import DROP_OLDEST
+from CleanEmonCore.Events import Observable
+from CleanEmonCore.Events import Observer
+from CleanEmonCore.Events import PROCESS
+from CleanEmonCore.Events import THREAD
+
+
+class Recorder(Observer):
+    def __init__(self, observable, delay=0.0, gate=None):
+        super().__init__(observable)
+        self.delay = delay
+        self.gate = gate
+        self.values = []
+
+    def on_notify(self, *args, **kwargs):
+        if self.gate is not None:
+            self.gate.wait()
+        time.sleep(self.delay)
+        self.values.append(kwargs["value"])
+
+
+class Failing(Observer):
+    def on_notify(self, *args, **kwargs):
+        raise RuntimeError("Broken observer")
+
+
+class FileWriter(Observer):
+    """Records its notifications to a file, as anything kept in memory stays in the worker process."""
+
+    def __init__(self, observable, path):
+        super().__init__(observable)
+        self.path = path
+
+    def on_notify(self, *args, **kwargs):
+        with open(self.path, "a", encoding="utf8") as f_out:
+            f_out.write(f"{kwargs['value']}\n")
+
+
+class AsyncRecorder(Observer):
+    def __init__(self, observable):
+        super().__init__(observable)
+        self.values = []
+
+    async def on_notify(self, *args, **kwargs):
+        await asyncio.sleep(0)
+        self.values.append(kwargs["value"])
+
+
+def test_inline_is_the_default():
+    event = Observable()
+    recorder = Recorder(event)
+    event.notify(value=1)
+    assert recorder.values == [1]
+
+    # Just like before dispatch modes existed, a failing observer stops the fan-out and the error reaches the caller
+    Failing(event)
+    late = Recorder(event)
+    with pytest.raises(RuntimeError, match="Broken observer"):
+        event.notify(value=2)
+    assert late.values == []
+
+
+def test_inline_isolation():
+    event = Observable()
+    event.set_dispatch(isolate=True)
+    failing = Failing(event)
+    recorder = Recorder(event)
+
+    event.notify(value=1)
+
+    assert recorder.values == [1]
+    stats = event.observer_stats()
+    assert stats[failing]["errors"] == 1
+    assert isinstance(stats[failing]["last_error"], RuntimeError)
+    assert stats[recorder]["delivered"] == 1
+
+
+def test_thread_slow_observer_does_not_delay_the_rest():
+    event = Observable()
+    event.set_dispatch(THREAD)
+    slow = Recorder(event, delay=0.5)
+    fast = Recorder(event)
+    Failing(event)
+
+    started = time.monotonic()
+    event.notify(value=1)
+    assert time.monotonic() - started < 0.1
+
+    deadline = time.monotonic() + 5
+    while not fast.values and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fast.values == [1] and slow.values == []
+
+    assert event.join(5)
+    assert slow.values == [1]
+    event.close()
+
+
+def test_thread_delivery_is_ordered():
+    event = Observable()
+    event.set_dispatch(THREAD, queue_size=1000)
+    recorder = Recorder(event)
+
+    for value in range(200):
+        event.notify(value=value)
+
+    assert event.join(5)
+    assert recorder.values == list(range(200))
+    event.close()
+
+
+@pytest.mark.parametrize("overflow, expected, dropped, coalesced", [
+    (DROP_OLDEST, [0, 2, 3, 4], 1, 0),
+    (COALESCE, [0, 4], 0, 3),
+])
+def test_overflow_policies(overflow, expected, dropped, coalesced):
+    gate = threading.Event()
+    event = Observable()
+    event.set_dispatch(THREAD, queue_size=3, overflow=overflow)
+    recorder = Recorder(event, gate=gate)
+
+    event.notify(value=0)
+    deadline = time.monotonic() + 5
+    while event.observer_stats()[recorder]["pending"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # The first notification is held by the gate, while the rest overflow the queue
+    for value in range(1, 5):
+        event.notify(value=value)
+    gate.set()
+
+    assert event.join(5)
+    assert recorder.values == expected
+    stats = event.observer_stats()[recorder]
+    assert stats["dropped"] == dropped and stats["coalesced"] == coalesced
+    event.close()
+
+
+def test_block_policy_applies_backpressure():
+    event = Observable()
+    event.set_dispatch(THREAD, queue_size=1, overflow=BLOCK)
+    recorder = Recorder(event, delay=0.1)
+
+    started = time.monotonic()
+    for value in range(4):
+        event.notify(value=value)
+
+    assert time.monotonic() - started >= 0.15
+    assert event.join(5)
+    assert recorder.values == [0, 1, 2, 3]
+    event.close()
+
+
+def test_asyncio():
+    event = Observable()
+    event.set_dispatch(ASYNCIO)
+    recorder = AsyncRecorder(event)
+    sync_recorder = Recorder(event)
+    failing = Failing(event)
+
+    for value in range(3):
+        event.notify(value=value)
+
+    assert event.join(5)
+    assert recorder.values == sync_recorder.values == [0, 1, 2]
+    assert event.observer_stats()[failing]["errors"] == 3
+    event.close()
+
+
+def test_block_policy_drops_on_the_loop():
+    event = Observable()
+
+    async def main():
+        event.set_dispatch(ASYNCIO, queue_size=1, overflow=BLOCK, loop=asyncio.get_running_loop())
+        recorder = AsyncRecorder(event)
+
+        # The queue is drained by this very loop, so blocking on it would never return
+        for value in range(3):
+            event.notify(value=value)
+
+        await asyncio.sleep(0.05)
+        return recorder
+
+    recorder = asyncio.run(main())
+    assert recorder.values == [2]
+    assert event.observer_stats()[recorder]["dropped"] == 2
+    event.close()
+
+
+def test_process(tmp_path):
+    path = tmp_path / "values.txt"
+    event = Observable()
+    event.set_dispatch(PROCESS, workers=2)
+    FileWriter(event, str(path))
+
+    for value in range(3):
+        event.notify(value=value)
+
+    assert event.join(30)
+    assert path.read_text().split() == ["0", "1", "2"]
+    event.close()
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from datetime import date
+from datetime import timedelta
+
+from CleanEmonCore.Events import DateChange
+from CleanEmonCore.Events import Observer
+from CleanEmonCore.Events import Scheduler
+from CleanEmonCore.Events import Timer
+
+
+class Recorder(Observer):
+    def __init__(self, observable):
+        super().__init__(observable)
+        self.calls = []
+
+    def on_notify(self, *args, **kwargs):
+        self.calls.append(kwargs)
+
+
+class StopAfter(Observer):
+    """Stops the observed event after `count` notifications."""
+
+    def __init__(self, observable, count):
+        super().__init__(observable)
+        self.event = observable
+        self.count = count
+
+    def on_notify(self, *args, **kwargs):
+        self.count -= 1
+        if not self.count:
+            self.event.stop()
+
+
+def test_jobs_run_in_deadline_order():
+    scheduler = Scheduler()
+    order = []
+
+    scheduler.call_later(0.03, lambda: order.append(3))
+    scheduler.call_later(0.01, lambda: order.append(1))
+    scheduler.call_later(0.02, lambda: order.append(2))
+    scheduler.call_later(0.04, scheduler.stop)
+
+    scheduler.run()
+    assert order == [1, 2, 3]
+
+
+def test_cancel():
+    scheduler = Scheduler()
+    ran = []
+
+    job = scheduler.call_later(0.01, lambda: ran.append(True))
+    job.cancel()
+    scheduler.call_later(0.02, scheduler.stop)
+
+    scheduler.run()
+    assert ran == []
+    assert len(scheduler) == 0
+
+
+def test_failing_job_does_not_stop_the_rest(caplog):
+    scheduler = Scheduler()
+    ticks = []
+
+    def fail():
+        raise RuntimeError("Everything works as expected")
+
+    failing = scheduler.call_every(0.01, fail)
+    scheduler.call_every(0.01, lambda: ticks.append(True))
+    scheduler.call_later(0.055, scheduler.stop)
+
+    scheduler.run()
+    assert len(ticks) >= 3
+    assert failing.errors == failing.runs >= 3
+    assert isinstance(failing.last_error, RuntimeError)
+    assert "Scheduled job" in caplog.text
+
+
+def test_periodic_jobs_do_not_drift():
+    scheduler = Scheduler()
+    ticks = []
+
+    def slow_tick():
+        ticks.append(time.monotonic())
+        time.sleep(0.005)  # Work done on each tick must not push the next one later
+        if len(ticks) == 10:
+            scheduler.stop()
+
+    job = scheduler.call_every(0.02, slow_tick)
+    started = job.deadline
+    scheduler.run()
+
+    assert ticks[-1] - started < 9 * 0.02 + 0.015
+    assert job.runs == 10
+
+
+def test_many_timers_on_one_thread():
+    scheduler = Scheduler().start()
+    timers = [Timer(0.01 + i * 0.001, scheduler=scheduler) for i in range(20)]
+    recorders = [Recorder(timer) for timer in timers]
+
+    time.sleep(0.2)
+    for timer in timers:
+        timer.stop()
+    scheduler.stop()
+
+    assert all(recorder.calls for recorder in recorders)
+    assert all("time" in recorder.calls[0] for recorder in recorders)
+    assert len(scheduler) == 0
+
+
+def test_timer_run_and_stop():
+    timer = Timer(0.01)
+    recorder = Recorder(timer)
+    StopAfter(timer, 3)
+
+    timer.run()
+    assert len(recorder.calls) == 3
+
+
+def test_timer_run_async():
+    timer = Timer(0.01)
+    recorder = Recorder(timer)
+    StopAfter(timer, 2)
+
+    asyncio.run(timer.run_async())
+    assert len(recorder.calls) == 2
+
+
+def test_date_change_notifies_right_away_for_another_date():
+    event = DateChange(initial_date=date.today() - timedelta(days=1))
+    recorder = Recorder(event)
+    StopAfter(event, 1)
+
+    event.run()
+    assert recorder.calls == [{"date": date.today() - timedelta(days=1)}]
+    assert event.current_date == date.today()
+
+
+def test_date_change_sleeps_until_midnight():
+    scheduler = Scheduler()
+    event = DateChange(initial_date=date.today(), scheduler=scheduler)
+
+    remaining = event.job.deadline - time.monotonic()
+    assert abs(remaining - event._seconds_to_midnight()) < 1
+    # Only the clock comparison runs every `check_interval` seconds
+    assert 0 < event.timer.job.deadline - time.monotonic() <= 60
+
+    event.stop()
+    assert event.job.cancelled and event.timer.job.cancelled
+
+
+def test_date_change_rechecks_after_wall_clock_adjustments():
+    scheduler = Scheduler()
+    yesterday = date.today() - timedelta(days=1)
+    event = DateChange(initial_date=date.today(), scheduler=scheduler)
+    recorder = Recorder(event)
+    deadline = event.job
+
+    # Ticks with no drift leave the deadline alone
+    event.timer._tick()
+    assert event.job is deadline and not recorder.calls
+
+    # The wall clock jumped forward past midnight
+    event.current_date = yesterday
+    event._clock_offset -= 3600
+    event.timer._tick()
+
+    assert recorder.calls == [{"date": yesterday}]
+    assert deadline.cancelled and event.job is not deadline
+    event.stop()
@@ -0,0 +1,64 @@
+"""Fixtures shared by the tests that run against the in-process FakeCouchDB"""
+
+from pytest import fixture
+
+from CleanEmonCore.CouchDBAdapter import CouchDBAdapter
+from CleanEmonCore._fake_couchdb import FakeCouchDB
+
+
+@fixture
+def couch():
+    with FakeCouchDB() as couch:
+        yield couch
+
+
+@fixture
+def make_config(couch, tmp_path):
+    """Returns a function that writes a config file of the fake server, extended by the given lines.
+    The function returns the path of the file.
+    """
+
+    def make(*lines: str, name: str = "clean.cfg") -> str:
+        path = couch.write_config(str(tmp_path / name))
+        with open(path, "a", encoding="utf8") as f_out:
+            # Conflicting writes are retried at once, so that the tests that provoke them stay fast
+            f_out.write("conflict_backoff = 0\n")
+            for line in lines:
+                f_out.write(f"{line}\n")
+        return path
+
+    return make
+
+
+@fixture
+def make_adapter(make_config):
+    """Returns a function that creates a CouchDBAdapter of the fake server, configured by the given extra lines.
+    Every adapter it creates is closed afterwards.
+    """
+
+    adapters = []
+
+    def make(*lines: str) -> CouchDBAdapter:
+        adapters.append(CouchDBAdapter(make_config(*lines, name=f"clean{len(adapters) or ''}.cfg")))
+        return adapters[-1]
+
+    yield make
+
+    for adapter in adapters:
+        adapter.close()
+
+
+@fixture
+def adapter(request, make_adapter):
+    """A CouchDBAdapter of the fake server. Extra config lines are given by parametrizing it indirectly, e.g.
+    `@pytest.mark.parametrize("adapter", [["chunk_readings = 3"]], indirect=True)`.
+    """
+
+    return make_adapter(*getattr(request, "param", ()))
+
+
+@fixture
+def design(adapter):
+    """Installs the design document through `adapter`. It provides the get_dates view, as every deployment does."""
+
+    assert adapter.install_design()
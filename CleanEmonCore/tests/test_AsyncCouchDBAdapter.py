@@ -0,0 +1,202 @@
+import asyncio
+
+import pytest
+from pytest import fixture
+
+pytest.importorskip("aiohttp")
+
+from CleanEmonCore.AsyncCouchDBAdapter import AsyncCouchDBAdapter  # noqa: E402
+from CleanEmonCore.models import EnergyData  # noqa: E402
+
+TEST_DOC_NAME = "test_doc"
+DUMMY_DATE = "2000-01-01"
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@fixture
+def energy_data():
+    return EnergyData(DUMMY_DATE,
+                      [
+                          {"timestamp": 1,
+                           "power": 100,
+                           "temp": 20
+                           },
+                          {"timestamp": 2,
+                           "power": 150,
+                           "temp": 21
+                           },
+                          {"timestamp": 3,
+                           "power": 120,
+                           "temp": 21
+                           }
+                      ])
+
+
+@fixture
+def config_file(make_config):
+    return make_config()
+
+
+def adapter_run(config_file, fn):
+    """Runs `fn(adapter)` in a fresh event loop, closing the adapter afterwards."""
+
+    async def main():
+        async with AsyncCouchDBAdapter(config_file) as adapter:
+            return await fn(adapter)
+
+    return run(main())
+
+
+class TestCreateDelete:
+    def test_create_delete_document(self, config_file):
+        async def scenario(adapter):
+            assert await adapter.create_document(TEST_DOC_NAME)
+            assert not await adapter.create_document(TEST_DOC_NAME)
+            assert await adapter.delete_document(TEST_DOC_NAME)
+            assert not await adapter.delete_document(TEST_DOC_NAME)
+
+        adapter_run(config_file, scenario)
+
+    def test_create_unnamed_documents(self, config_file, couch):
+        async def scenario(adapter):
+            names = await asyncio.gather(*(adapter.create_document() for _ in range(5)))
+            assert len(set(names)) == 5
+
+        adapter_run(config_file, scenario)
+        assert couch.count("GET", "/_uuids") == 1
+
+    def test_create_delete_database(self, config_file):
+        async def scenario(adapter):
+            assert await adapter.create_database("other")
+            assert not await adapter.create_database("other")
+            assert await adapter.delete_database("other")
+            assert not await adapter.delete_database("other")
+
+        adapter_run(config_file, scenario)
+
+
+class TestEnergyData:
+    def test_append_energy_data(self, config_file, energy_data):
+        async def scenario(adapter):
+            assert await adapter.create_document(TEST_DOC_NAME, initial_data=energy_data)
+            assert await adapter.append_energy_data(later, energy_data, document=TEST_DOC_NAME)
+            adapter.server_side_append = False
+            assert await adapter.append_energy_data(latest, later, document=TEST_DOC_NAME)
+            return await adapter.fetch_energy_data(document=TEST_DOC_NAME)
+
+        # Re-sent readings replace the stored ones, rather than being appended again
+        later = EnergyData(energy_data=[dict(reading, timestamp=reading["timestamp"] + 10)
+                                        for reading in energy_data.energy_data])
+        latest = EnergyData(energy_data=[dict(reading, timestamp=reading["timestamp"] + 20)
+                                         for reading in energy_data.energy_data])
+        data = adapter_run(config_file, scenario)
+        assert data.energy_data == energy_data.energy_data + later.energy_data + latest.energy_data
+
+    def test_post_is_not_resent_after_a_timeout(self, make_config, couch, energy_data):
+        config_file = make_config("read_timeout = 0.2", "backoff_factor = 0")
+
+        async def scenario(adapter):
+            assert await adapter.create_document(TEST_DOC_NAME)
+            await adapter.install_design()
+
+            couch.latency = 0.4
+            with pytest.raises(asyncio.TimeoutError):
+                await adapter.append_energy_data(energy_data, document=TEST_DOC_NAME)
+
+            # The server applies the append after the client gave up on it
+            await asyncio.sleep(0.4)
+            couch.latency = 0
+            return await adapter.fetch_energy_data(document=TEST_DOC_NAME)
+
+        assert adapter_run(config_file, scenario).energy_data == energy_data.energy_data
+        assert couch.count("POST", "/_update/append/") == 1
+
+    def test_iter_energy_data(self, config_file, couch, energy_data):
+        async def scenario(adapter):
+            assert await adapter.create_document(TEST_DOC_NAME, initial_data=energy_data)
+            readings = [reading async for reading in adapter.iter_energy_data(document=TEST_DOC_NAME)]
+            batches = [batch async for batch in adapter.iter_energy_data(document=TEST_DOC_NAME, batch_size=2)]
+            window = [reading async for reading in adapter.iter_energy_data(document=TEST_DOC_NAME, fields=["power"],
+                                                                            start=2, end=3)]
+            return readings, batches, window
+
+        readings, batches, window = adapter_run(config_file, scenario)
+        assert readings == energy_data.energy_data
+        assert batches == [energy_data.energy_data[:2], energy_data.energy_data[2:]]
+        assert window == [{"timestamp": 2, "power": 150}]
+        assert couch.count("GET", "_show/window/") == 1
+
+    def test_by_date(self, config_file, energy_data):
+        async def scenario(adapter):
+            await adapter.install_design()
+            assert not await adapter.get_document_id_for_date(DUMMY_DATE)
+            assert await adapter.update_energy_data_by_date(DUMMY_DATE, energy_data)
+            doc = await adapter.get_document_id_for_date(DUMMY_DATE)
+            assert doc
+            assert await adapter.fetch_energy_data_by_date(DUMMY_DATE) == energy_data
+            assert await adapter.update_energy_data_by_date(DUMMY_DATE, EnergyData(DUMMY_DATE))
+            assert await adapter.fetch_energy_data_by_date(DUMMY_DATE) == EnergyData(DUMMY_DATE)
+
+        adapter_run(config_file, scenario)
+
+    def test_fetch_meta(self, config_file):
+        async def scenario(adapter):
+            assert await adapter.create_raw_document("meta", initial_data={"version": 1})
+            return await adapter.fetch_meta()
+
+        assert adapter_run(config_file, scenario) == {"version": 1}
+
+
+class TestBulk:
+    def test_fetch_energy_data_range(self, config_file, couch, energy_data):
+        dates = [f"2000-01-{day:02}" for day in range(1, 21)]
+
+        async def scenario(adapter):
+            await adapter.install_design()
+            results = await adapter.create_documents(EnergyData(date, energy_data.energy_data) for date in dates)
+            assert all(result.ok for result in results)
+
+            couch.latency = 0.02
+            data = await adapter.fetch_energy_data_range("2000-01-05", "2000-01-14")
+            assert [item.date for item in data] == dates[4:14]
+
+            data = await adapter.fetch_many(["2000-01-20", "1999-01-01", "2000-01-01"])
+            assert [item.date for item in data] == ["2000-01-20", "2000-01-01"]
+
+        adapter_run(config_file, scenario)
+        assert 1 < couch.max_in_flight <= 16
+
+    def test_fetch_readings(self, config_file, couch, energy_data):
+        async def scenario(adapter):
+            for day in range(1, 4):
+                readings = [{"timestamp": day * 10 + t, "power": t} for t in range(3)]
+                assert await adapter.create_document(initial_data=EnergyData(f"2000-01-0{day}", readings))
+            return await adapter.fetch_readings(12, 31, fields=[])
+
+        assert adapter_run(config_file, scenario) == [{"timestamp": t} for t in (12, 20, 21, 22, 30)]
+        assert couch.count("GET", "_design/readings/_view/by_timestamp") == 1
+
+    def test_fetch_rollups(self, config_file, couch):
+        async def scenario(adapter):
+            readings = [{"timestamp": 946684800 + t * 30, "power": t, "temp": 20} for t in range(4)]
+            assert await adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings))
+            return await adapter.fetch_rollups(946684800, 946684800 + 3600, ["power", "temp"])
+
+        rollups = adapter_run(config_file, scenario)
+        assert [(rollup.count, rollup.sum) for rollup in rollups["power"]] == [(2, 1), (2, 5)]
+        assert [rollup.mean for rollup in rollups["temp"]] == [20, 20]
+        assert couch.count("GET", "_design/readings/_view/rollups") == 2
+
+    def test_update_energy_data_by_dates(self, config_file, energy_data):
+        async def scenario(adapter):
+            await adapter.install_design()
+            assert await adapter.create_document(initial_data=energy_data)
+            results = await adapter.update_energy_data_by_dates([EnergyData(DUMMY_DATE), EnergyData("2000-01-02")])
+            assert all(result.ok for result in results)
+            return await adapter.fetch_many([DUMMY_DATE, "2000-01-02"])
+
+        data = adapter_run(config_file, scenario)
+        assert data == [EnergyData(DUMMY_DATE), EnergyData("2000-01-02")]
@@ -0,0 +1,167 @@
+"""CouchDBAdapter tests that run against the in-process FakeCouchDB, so that they need no live server"""
+
+import pytest
+from pytest import fixture
+
+from CleanEmonCore.design import DESIGN_DOCUMENT
+from CleanEmonCore.models import EnergyData
+
+TEST_DOC_NAME = "test_doc"
+DUMMY_DATE = "2000-01-01"
+
+pytestmark = pytest.mark.usefixtures("design")
+
+
+def shifted(energy_data, seconds):
+    return EnergyData(energy_data=[dict(reading, timestamp=reading["timestamp"] + seconds)
+                                   for reading in energy_data.energy_data])
+
+
+@fixture
+def energy_data():
+    return EnergyData(DUMMY_DATE,
+                      [
+                          {"timestamp": 1,
+                           "power": 100,
+                           "temp": 20
+                           },
+                          {"timestamp": 2,
+                           "power": 150,
+                           "temp": 21
+                           },
+                          {"timestamp": 3,
+                           "power": 120,
+                           "temp": 21
+                           }
+                      ])
+
+
+@fixture
+def populated_document(adapter, energy_data):
+    return adapter.create_document(TEST_DOC_NAME, initial_data=energy_data)
+
+
+class TestEnergyData:
+    def test_append_energy_data_server_side(self, adapter, couch, populated_document, energy_data):
+        later = shifted(energy_data, 10)
+        assert adapter.append_energy_data(later, energy_data, document=populated_document)
+        assert adapter._fetch_document(document=DESIGN_DOCUMENT)["updates"]["append"]
+        assert couch.count("POST", f"/_update/append/{populated_document}") == 1
+        data = adapter.fetch_energy_data(document=populated_document)
+        assert data.energy_data == energy_data.energy_data + later.energy_data
+        assert data.date == DUMMY_DATE
+
+    def test_streamed_uploads(self, adapter, couch, energy_data):
+        adapter.stream_uploads = True
+        adapter.stream_chunk_size = 16
+        assert adapter.create_document(TEST_DOC_NAME, initial_data=energy_data)
+        assert adapter.fetch_energy_data(document=TEST_DOC_NAME) == energy_data
+        assert couch.chunked_requests == 1
+
+    def test_append_energy_data_client_side(self, adapter, couch, populated_document, energy_data):
+        adapter.server_side_append = False
+        later = shifted(energy_data, 10)
+        assert adapter.append_energy_data(later, energy_data, document=populated_document)
+        assert couch.count("POST", "/_update/append/") == 0
+        data = adapter.fetch_energy_data(document=populated_document)
+        assert data.energy_data == energy_data.energy_data + later.energy_data
+
+    @pytest.mark.parametrize("server_side", [True, False])
+    def test_append_keeps_readings_sorted_and_unique(self, adapter, populated_document, server_side):
+        adapter.server_side_append = server_side
+        late = {"timestamp": 1.5, "power": 1}
+        resent = {"timestamp": 2, "power": 2}
+        assert adapter.append_energy_data(EnergyData(energy_data=[resent, {"power": 0}, late]),
+                                          document=populated_document)
+
+        readings = adapter.fetch_energy_data(document=populated_document).energy_data
+        assert [reading.get("timestamp") for reading in readings] == [1, 1.5, 2, 3, None]
+        assert resent in readings
+
+
+class TestStreaming:
+    def test_iter_energy_data(self, adapter, energy_data, populated_document):
+        readings = list(adapter.iter_energy_data(document=populated_document))
+        assert readings == energy_data.energy_data
+
+    def test_iter_energy_data_batches(self, adapter, energy_data, populated_document):
+        batches = list(adapter.iter_energy_data(document=populated_document, batch_size=2))
+        assert batches == [energy_data.energy_data[:2], energy_data.energy_data[2:]]
+
+    def test_iter_energy_data_window(self, adapter, couch, populated_document):
+        readings = list(adapter.iter_energy_data(document=populated_document, fields=["power"], start=2, end=3))
+        assert readings == [{"timestamp": 2, "power": 150}]
+        assert couch.count("GET", f"/_show/window/{populated_document}") == 1
+
+    def test_iter_energy_data_client_side_window(self, adapter, couch, populated_document):
+        adapter._design_installed = False
+        adapter.install_design = lambda: False
+        readings = list(adapter.iter_energy_data(document=populated_document, start=2))
+        assert [reading["timestamp"] for reading in readings] == [2, 3]
+        assert couch.count("GET", "/_show/window/") == 0
+
+
+class TestByDate:
+    def test_get_document_id_for_missing_date(self, adapter, populated_document):
+        assert adapter.get_document_id_for_date("1900-01-01") == ""
+
+    def test_get_document_ids_for_dates(self, adapter, couch, populated_document):
+        adapter.load_date_index()
+        ids = adapter.get_document_ids_for_dates(["1900-01-01", DUMMY_DATE, "1900-01-02"])
+        assert ids == {DUMMY_DATE: populated_document}
+        # Only the dates missing from the index are looked up, with a single keyed query
+        assert couch.count("POST", "/_view/get_dates") == 1
+
+    def test_date_index(self, adapter, couch, make_adapter, energy_data):
+        other = make_adapter()
+        assert adapter.create_document(TEST_DOC_NAME, initial_data=energy_data)
+        assert adapter._date_index[DUMMY_DATE] == TEST_DOC_NAME
+        assert other.load_date_index() == 1
+
+        views = couch.count("GET", "/_view/get_dates")
+        assert other.get_document_id_for_date(DUMMY_DATE) == TEST_DOC_NAME
+        assert couch.count("GET", "/_view/get_dates") == views
+
+        assert adapter.delete_document(TEST_DOC_NAME)
+        assert DUMMY_DATE not in adapter._date_index
+
+
+class TestBulkFetch:
+    def test_fetch_many(self, adapter, couch, energy_data, populated_document):
+        data = list(adapter.fetch_many(["1900-01-01", DUMMY_DATE]))
+        assert data == [energy_data]
+        assert couch.count("POST", "/_all_docs") == 1
+
+    def test_fetch_energy_data_range(self, adapter, energy_data, populated_document):
+        data = list(adapter.fetch_energy_data_range("1999-12-31", "2000-01-02"))
+        assert data == [energy_data]
+        assert not list(adapter.fetch_energy_data_range("1900-01-01", "1900-12-31"))
+
+    def test_fetch_readings(self, adapter, energy_data, populated_document):
+        adapter.create_document(initial_data=EnergyData("2000-01-02", [{"timestamp": 4, "power": 1}]))
+        readings = list(adapter.fetch_readings(2, 5, fields=["power"]))
+        assert readings == [{"timestamp": 2, "power": 150}, {"timestamp": 3, "power": 120},
+                            {"timestamp": 4, "power": 1}]
+        assert not list(adapter.fetch_readings(5, 10))
+
+
+class TestBulkWrite:
+    def test_create_documents(self, adapter, couch, energy_data):
+        raw = {"_id": TEST_DOC_NAME, "hello": "world"}
+        results = adapter.create_documents([energy_data, raw, raw], chunk_size=2)
+        assert [result.ok for result in results] == [True, True, False]
+        assert results[1].id == TEST_DOC_NAME
+        assert results[2].error == "conflict"
+        assert adapter.fetch_energy_data(document=results[0].id) == energy_data
+        assert adapter.get_document_id_for_date(DUMMY_DATE) == results[0].id
+        assert couch.count("POST", "/_bulk_docs") == 2
+
+    def test_update_energy_data_by_dates(self, adapter, energy_data, populated_document):
+        other_date = EnergyData("2000-01-02", energy_data.energy_data[:1])
+        energy_data.energy_data.pop()
+
+        results = adapter.update_energy_data_by_dates([energy_data, other_date])
+        assert all(result.ok for result in results)
+        assert results[0].id == populated_document
+        assert adapter.fetch_energy_data_by_date(DUMMY_DATE) == energy_data
+        assert adapter.fetch_energy_data_by_date("2000-01-02") == other_date
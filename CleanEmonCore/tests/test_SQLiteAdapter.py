@@ -0,0 +1,149 @@
+import pytest
+from pytest import fixture
+
+from CleanEmonCore.SQLiteAdapter import SQLiteAdapter
+from CleanEmonCore.models import EnergyData
+from CleanEmonCore.models import merge_readings
+from CleanEmonCore.storage import StorageBackend
+from CleanEmonCore.storage import open_storage
+
+DUMMY_DATE = "2000-01-01"
+
+
+def readings(start, stop):
+    return [{"timestamp": t, "power": t * 10} for t in range(start, stop)]
+
+
+@fixture
+def adapter(tmp_path):
+    with SQLiteAdapter(path=str(tmp_path / "db.sqlite")) as adapter:
+        yield adapter
+
+
+def test_open_storage(tmp_path):
+    config = tmp_path / "clean.cfg"
+    config.write_text("[DB]\n"
+                      "backend = sqlite\n"
+                      f"sqlite_path = {tmp_path / 'db.sqlite'}\n"
+                      "document_name = default\n")
+
+    with open_storage(str(config)) as storage:
+        assert isinstance(storage, SQLiteAdapter)
+        assert isinstance(storage, StorageBackend)
+        assert storage.append_energy_data(EnergyData(energy_data=readings(0, 2)))
+        assert storage.fetch_energy_data().energy_data == readings(0, 2)
+
+    config.write_text("[DB]\nbackend = nothing\n")
+    with pytest.raises(ValueError):
+        open_storage(str(config))
+
+
+def test_create_fetch_delete(adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 3)))
+    assert document
+
+    assert adapter.create_document(document) == ""
+    assert adapter.fetch_energy_data(document=document) == EnergyData(DUMMY_DATE, readings(0, 3))
+    assert adapter.get_document_id_for_date(DUMMY_DATE) == document
+
+    assert adapter.delete_document(document)
+    assert not adapter.delete_document(document)
+    assert adapter.fetch_energy_data(document=document) == EnergyData()
+    assert adapter.get_document_id_for_date(DUMMY_DATE) == ""
+
+
+def test_append(adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 2)))
+
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(2, 4)), EnergyData(energy_data=readings(4, 5)),
+                                      document=document)
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE).energy_data == readings(0, 5)
+
+    # Missing documents are created, just like the server-side append of CouchDB does
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(0, 1)), document="new")
+    assert adapter.fetch_energy_data(document="new").energy_data == readings(0, 1)
+
+
+def test_append_out_of_order(adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 6)[::2]))
+
+    late = readings(1, 6)[::2] + [{"timestamp": 4, "power": 0}]
+    assert adapter.append_energy_data(EnergyData(energy_data=late), document=document)
+    assert adapter.fetch_energy_data(document=document).energy_data == \
+        readings(0, 4) + [{"timestamp": 4, "power": 0}, {"timestamp": 5, "power": 50}]
+
+    # Rollups reflect the readings that were replaced
+    rollup = adapter.fetch_rollups(0, 60, ["power"], resolution=60)["power"][0]
+    assert (rollup.count, rollup.sum) == (6, 110)
+
+
+def test_append_keeps_untimed_readings_last(adapter):
+    stored = [{"timestamp": 1}, {"power": 1}, {"timestamp": 3}]
+    incoming = [{"timestamp": 4}, {"power": 2}, {"timestamp": 2}]
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, stored))
+
+    assert adapter.append_energy_data(EnergyData(energy_data=incoming), document=document)
+    assert adapter.fetch_energy_data(document=document).energy_data == merge_readings(stored, incoming)
+
+    # Batches after the last timestamp are no exception
+    assert adapter.append_energy_data(EnergyData(energy_data=[{"timestamp": 5}]), document=document)
+    assert adapter.fetch_energy_data(document=document).energy_data == \
+        [{"timestamp": t} for t in range(1, 6)] + [{"power": 1}, {"power": 2}]
+
+
+def test_append_batch_is_applied_once(adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+
+    for _ in range(3):
+        assert adapter.append_energy_data(EnergyData(energy_data=readings(0, 2)), document=document, batch_id="b1")
+
+    assert adapter.fetch_energy_data(document=document).energy_data == readings(0, 2)
+
+
+def test_iter_energy_data(adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 10)))
+
+    assert list(adapter.iter_energy_data(document=document, start=3, end=6, fields=[])) == \
+        [{"timestamp": t} for t in range(3, 6)]
+    assert [len(batch) for batch in adapter.iter_energy_data(document=document, batch_size=4)] == [4, 4, 2]
+
+
+def test_update_by_date(adapter):
+    adapter.update_energy_data_by_date(DUMMY_DATE, EnergyData(DUMMY_DATE, readings(0, 2)))
+    adapter.update_energy_data_by_date(DUMMY_DATE, EnergyData(DUMMY_DATE, readings(5, 6)))
+
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE).energy_data == readings(5, 6)
+
+
+def test_range_and_many(adapter):
+    for day in (3, 1, 2):
+        adapter.create_document(initial_data=EnergyData(f"2000-01-0{day}", readings(day, day + 1)))
+
+    assert [data.date for data in adapter.fetch_energy_data_range("2000-01-01", "2000-01-02")] == \
+        ["2000-01-01", "2000-01-02"]
+    assert [data.energy_data for data in adapter.fetch_many(["2000-01-03", "2000-01-09", "2000-01-01"])] == \
+        [readings(3, 4), readings(1, 2)]
+
+
+def test_fetch_readings(adapter):
+    for day in (1, 2, 3):
+        adapter.create_document(initial_data=EnergyData(f"2000-01-0{day}", readings(day * 10, day * 10 + 3)))
+
+    assert list(adapter.fetch_readings(12, 31, fields=[])) == [{"timestamp": t} for t in (12, 20, 21, 22, 30)]
+    assert list(adapter.fetch_readings(20, 21)) == readings(20, 21)
+    assert not list(adapter.fetch_readings(40, 50))
+
+
+def test_raw_document_and_meta(adapter):
+    assert adapter.fetch_meta() == {}
+    assert adapter.create_raw_document("meta", initial_data={"version": 2, "owner": "me"})
+    assert adapter.fetch_meta() == {"version": 2, "owner": "me"}
+
+
+def test_persistence(tmp_path):
+    path = str(tmp_path / "db.sqlite")
+    with SQLiteAdapter(path=path) as adapter:
+        adapter.create_document("doc", initial_data=EnergyData(DUMMY_DATE, readings(0, 2)))
+
+    with SQLiteAdapter(path=path) as adapter:
+        assert adapter.fetch_energy_data(document="doc").energy_data == readings(0, 2)
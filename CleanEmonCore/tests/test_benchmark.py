@@ -0,0 +1,32 @@
+import json
+
+from CleanEmonCore import benchmark
+
+
+def test_percentile():
+    assert benchmark.percentile([], 50) == 0.0
+    assert benchmark.percentile([3, 1, 2], 50) == 2
+    assert benchmark.percentile([1, 2], 50) == 1.5
+    assert benchmark.percentile([1, 2, 3, 4, 5], 100) == 5
+
+
+def test_run_and_compare(tmp_path):
+    results = benchmark.run(sizes=[5], days=[1, 3], repeat=2, options={"encoding": "packed"})
+
+    assert [(result["operation"], result["doc_size"], result["days"]) for result in results["results"]] == \
+        [("append", 5, 1), ("fetch_by_date", 5, 1), ("create_delete", 5, 1), ("range_fetch", 5, 1),
+         ("range_fetch", 5, 3)]
+    for result in results["results"]:
+        assert result["runs"] == 2
+        assert result["throughput"] > 0
+        assert 0 < result["latency_ms"]["p50"] <= result["latency_ms"]["max"]
+
+    path = str(tmp_path / "results.json")
+    benchmark.save(results, path)
+    assert benchmark.load(path) == json.loads(json.dumps(results))
+
+    assert benchmark.compare(results, results) == []
+
+    slower = json.loads(json.dumps(results))
+    slower["results"][0]["latency_ms"]["p50"] *= 2
+    assert len(benchmark.compare(results, slower)) == 1
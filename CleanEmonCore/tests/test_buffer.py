@@ -0,0 +1,89 @@
+import time
+
+import pytest
+from pytest import fixture
+
+from CleanEmonCore.buffer import IngestBuffer
+from CleanEmonCore.models import EnergyData
+
+DUMMY_DATE = "2000-01-01"
+
+pytestmark = pytest.mark.usefixtures("design")
+
+
+def readings(start, stop):
+    return EnergyData(DUMMY_DATE, [{"timestamp": t, "power": t * 10} for t in range(start, stop)])
+
+
+@fixture
+def buffer_path(tmp_path):
+    return str(tmp_path / "buffer.sqlite")
+
+
+def test_flush_coalesces_per_document(adapter, couch, buffer_path):
+    with IngestBuffer(adapter, path=buffer_path, autostart=False) as buffer:
+        for t in range(10):
+            buffer.enqueue(readings(t, t + 1))
+        buffer.enqueue(EnergyData(energy_data=[{"timestamp": 0}]), document="other")
+        assert buffer.queue_depth() == 11
+
+        assert buffer.flush()
+        assert buffer.queue_depth() == 0
+        assert couch.count("POST", "_update/append") == 2
+        assert buffer.stats()["flushed_readings"] == 11
+
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE) == readings(0, 10)
+    assert adapter.fetch_energy_data(document="other").energy_data == [{"timestamp": 0}]
+
+
+def test_background_flush_by_size_and_latency(adapter, buffer_path):
+    with IngestBuffer(adapter, path=buffer_path, max_batch=5, max_latency=0.2) as buffer:
+        buffer.enqueue(readings(0, 5))
+        buffer.enqueue(readings(5, 6))
+
+        deadline = time.monotonic() + 5
+        while buffer.queue_depth() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert buffer.queue_depth() == 0
+        assert buffer.stats()["flushes"] >= 1
+
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE) == readings(0, 6)
+
+
+def test_failed_flush_keeps_readings(adapter, couch, buffer_path):
+    with IngestBuffer(adapter, path=buffer_path, autostart=False) as buffer:
+        buffer.enqueue(readings(0, 3))
+        couch.pending_conflicts = 100
+        assert not buffer.flush()
+        assert buffer.queue_depth() == 3
+        couch.pending_conflicts = 0
+        assert buffer.flush()
+
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE) == readings(0, 3)
+
+
+def test_replay_after_crash_is_exactly_once(adapter, buffer_path):
+    buffer = IngestBuffer(adapter, path=buffer_path, autostart=False)
+    buffer.enqueue(readings(0, 3))
+
+    # Simulate a crash right after the append went through, but before the batch was removed from the buffer
+    original_append = adapter.append_energy_data
+
+    def append_and_crash(*args, **kwargs):
+        original_append(*args, **kwargs)
+        raise KeyboardInterrupt
+
+    adapter.append_energy_data = append_and_crash
+    try:
+        buffer.flush()
+    except KeyboardInterrupt:
+        pass
+    adapter.append_energy_data = original_append
+
+    with IngestBuffer(adapter, path=buffer_path, autostart=False) as replayed:
+        assert replayed.queue_depth() == 3
+        assert replayed.flush()
+        assert replayed.queue_depth() == 0
+
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE) == readings(0, 3)
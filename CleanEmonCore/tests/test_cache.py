@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+
+from CleanEmonCore.cache import DocumentCache
+from CleanEmonCore.models import EnergyData
+
+PAST_DATE = "2000-01-01"
+TODAY = datetime.date.today().isoformat()
+
+cached = pytest.mark.parametrize("adapter", [["cache_entries = 16"]], indirect=True)
+
+
+def test_lru_eviction_by_entries():
+    cache = DocumentCache(max_entries=2)
+    cache.put("a", {}, "", 1)
+    cache.put("b", {}, "", 1)
+    cache.get("a")
+    cache.put("c", {}, "", 1)
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert cache.evictions == 1
+
+
+def test_eviction_by_bytes():
+    cache = DocumentCache(max_bytes=10)
+    cache.put("a", {}, "", 6)
+    cache.put("b", {}, "", 6)
+    assert "a" not in cache and "b" in cache
+
+    assert cache.put("huge", {}, "", 11) is None
+    assert "huge" not in cache
+    assert cache.stats()["bytes"] == 6
+
+
+def test_invalidate_and_stats():
+    cache = DocumentCache()
+    cache.put("a", {"x": 1}, '"1-a"', 5)
+
+    assert cache.get("a").etag == '"1-a"'
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["entries"] == 0 and stats["bytes"] == 0
+
+
+@cached
+def test_current_document_is_revalidated(adapter, couch):
+    document = adapter.create_document(initial_data=EnergyData(TODAY, [{"timestamp": 1}]))
+
+    first = adapter.fetch_energy_data(document=document)
+    second = adapter.fetch_energy_data(document=document)
+
+    assert first == second
+    assert couch.count("GET", document) == 2
+    assert adapter.cache.revalidations == 1
+
+
+@cached
+def test_past_document_is_served_from_cache(adapter, couch):
+    document = adapter.create_document(initial_data=EnergyData(PAST_DATE, [{"timestamp": 1}]))
+
+    for _ in range(3):
+        assert adapter.fetch_energy_data(document=document).energy_data == [{"timestamp": 1}]
+
+    assert couch.count("GET", document) == 1
+
+
+@cached
+def test_writes_invalidate(adapter):
+    document = adapter.create_document(initial_data=EnergyData(PAST_DATE, [{"timestamp": 1}]))
+    adapter.fetch_energy_data(document=document)
+
+    adapter.server_side_append = False
+    adapter.append_energy_data(EnergyData(PAST_DATE, [{"timestamp": 2}]), document=document)
+    assert adapter.fetch_energy_data(document=document).energy_data == [{"timestamp": 1}, {"timestamp": 2}]
+
+    adapter.server_side_append = True
+    adapter.append_energy_data(EnergyData(PAST_DATE, [{"timestamp": 3}]), document=document)
+    assert len(adapter.fetch_energy_data(document=document).energy_data) == 3
+
+
+@cached
+def test_returned_documents_are_copies(adapter):
+    document = adapter.create_document(initial_data=EnergyData(PAST_DATE, [{"timestamp": 1}]))
+
+    adapter.fetch_energy_data(document=document).energy_data.append({"timestamp": 2})
+    assert adapter.fetch_energy_data(document=document).energy_data == [{"timestamp": 1}]
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from CleanEmonCore.design import DESIGN_DOCUMENT
+from CleanEmonCore.models import EnergyData
+
+DUMMY_DATE = "2000-01-01"
+CHUNKED = ["chunk_readings = 3"]
+
+pytestmark = pytest.mark.parametrize("adapter", [CHUNKED], indirect=True)
+
+
+def readings(start, stop):
+    return [{"timestamp": t, "power": t * 10} for t in range(start, stop)]
+
+
+def stored(couch, document):
+    return couch.databases["test"][document]
+
+
+def test_appends_roll_over(adapter, couch):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+
+    for t in range(7):
+        assert adapter.append_energy_data(EnergyData(energy_data=readings(t, t + 1)), document=document,
+                                          batch_id=f"b{t}")
+
+    assert stored(couch, document)["chunks"] == [f"{document}.1", f"{document}.2"]
+    assert stored(couch, document)["sealed"]
+    assert [len(stored(couch, chunk)["energy_data"]) for chunk in (document, f"{document}.1", f"{document}.2")] == \
+        [3, 3, 1]
+
+    # Once rolled over, appends no longer touch the first document
+    assert couch.count("POST", f"append/{document}.2") == 1
+
+    assert adapter.get_document_id_for_date(DUMMY_DATE) == document
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE) == EnergyData(DUMMY_DATE, readings(0, 7))
+    assert [data.energy_data for data in adapter.fetch_many([DUMMY_DATE])] == [readings(0, 7)]
+    assert list(adapter.iter_energy_data(document=document, start=2, end=5)) == readings(2, 5)
+    assert list(adapter.fetch_readings(0, 100)) == readings(0, 7)
+
+
+def test_replayed_batch_is_ignored_after_rollover(adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(0, 3)), document=document, batch_id="b1")
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(0, 3)), document=document, batch_id="b1")
+
+    assert adapter.fetch_energy_data(document=document).energy_data == readings(0, 3)
+
+
+def test_other_writers_follow_the_newest_chunk(adapter, couch, make_adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(0, 3)), document=document)
+
+    # A writer without rollover enabled, or with an outdated view of the chunks, moves on once it hits a sealed chunk
+    other = make_adapter()
+    assert other.append_energy_data(EnergyData(energy_data=readings(3, 4)), document=document)
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(4, 5)), document=document)
+
+    assert adapter.fetch_energy_data(document=document).energy_data == readings(0, 5)
+    assert stored(couch, document)["chunks"] == [f"{document}.1"]
+
+
+def test_interrupted_rollover_is_completed(adapter):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 1)))
+    adapter.install_design()
+    adapter.transport.post(f"/test/{DESIGN_DOCUMENT}/_update/seal/{document}")
+
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(1, 2)), document=document)
+    assert adapter.fetch_energy_data(document=document).energy_data == readings(0, 2)
+
+
+def test_replace_and_delete_drop_chunks(adapter, couch):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(0, 4)), document=document)
+    assert f"{document}.1" in couch.databases["test"]
+
+    assert adapter.update_energy_data_by_date(DUMMY_DATE, EnergyData(DUMMY_DATE, readings(10, 11)))
+    assert f"{document}.1" not in couch.databases["test"]
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE).energy_data == readings(10, 11)
+
+    # Appends start over from the (no longer sealed) first document
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(11, 14)), document=document)
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(14, 15)), document=document)
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE).energy_data == readings(10, 15)
+
+    assert adapter.delete_document(document)
+    assert set(couch.databases["test"]) == {DESIGN_DOCUMENT}
+
+
+def test_async_adapter_rolls_over(adapter, make_config):
+    pytest.importorskip("aiohttp")
+    from CleanEmonCore.AsyncCouchDBAdapter import AsyncCouchDBAdapter
+
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+
+    async def main():
+        async with AsyncCouchDBAdapter(make_config(*CHUNKED, name="async.cfg")) as async_adapter:
+            for t in range(5):
+                assert await async_adapter.append_energy_data(EnergyData(energy_data=readings(t, t + 1)),
+                                                              document=document)
+            return await async_adapter.fetch_many([DUMMY_DATE])
+
+    assert [data.energy_data for data in asyncio.run(main())] == [readings(0, 5)]
+    assert adapter.fetch_energy_data(document=document).energy_data == readings(0, 5)
+
+
+@pytest.mark.parametrize("server_side", [True, False])
+def test_resent_readings_replace_those_of_sealed_chunks(adapter, couch, server_side):
+    adapter.server_side_append = server_side
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE))
+    for t in (1, 11, 21, 31):
+        assert adapter.append_energy_data(EnergyData(energy_data=readings(t, t + 2)), document=document)
+
+    assert adapter.append_energy_data(EnergyData(energy_data=[{"timestamp": 1, "power": 99},
+                                                              {"timestamp": 22, "power": 99},
+                                                              {"timestamp": 40, "power": 99}]),
+                                      document=document, batch_id="resent")
+
+    expected = readings(1, 3) + readings(11, 13) + readings(21, 23) + readings(31, 33) + \
+        [{"timestamp": 40, "power": 99}]
+    expected[0]["power"] = expected[5]["power"] = 99
+    assert adapter.fetch_energy_data(document=document).energy_data == expected
+    assert list(adapter.iter_energy_data(document=document)) == expected
+    assert list(adapter.fetch_readings(0, 100)) == expected
+
+    # Both paths roll over alike, and every chunk keeps to its own time range
+    chunks = [stored(couch, chunk) for chunk in [document] + stored(couch, document)["chunks"]]
+    assert [chunk.get("floor") for chunk in chunks] == [None, 12, 32]
+    assert [[reading["timestamp"] for reading in chunk["energy_data"]] for chunk in chunks] == \
+        [[1, 2, 11, 12], [21, 22, 31, 32], [40]]
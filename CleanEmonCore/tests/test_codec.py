@@ -0,0 +1,144 @@
+import json
+import math
+
+import pytest
+
+from CleanEmonCore.codec import LZ4
+from CleanEmonCore.codec import NO_COMPRESSION
+from CleanEmonCore.codec import PACKED_FIELD
+from CleanEmonCore.codec import lz4
+from CleanEmonCore.codec import pack
+from CleanEmonCore.codec import unpack
+from CleanEmonCore.models import EnergyData
+from CleanEmonCore.rollups import HOUR
+
+DUMMY_DATE = "2000-01-01"
+DAY_START = 946684800
+
+packed = pytest.mark.parametrize("adapter", [["encoding = packed"]], indirect=True)
+
+
+def day_of_readings(count=8640):
+    """A day of readings every 10 seconds, as a typical meter produces them."""
+
+    return [{"timestamp": DAY_START + 10 * i,
+             "power": round(200 + 50 * math.sin(i / 100), 2),
+             "temp": round(20 + (i % 7) / 10, 1),
+             "kwh": 1000 + i // 3}
+            for i in range(count)]
+
+
+def readings(start, stop):
+    return [{"timestamp": DAY_START + t, "power": t * 10} for t in range(start, stop)]
+
+
+def test_round_trip():
+    rows = [{"timestamp": 1.5, "a": None, "b": True, "nested": {"x": [1, 2]}},
+            {"timestamp": 2, "c": "text", "big": 2 ** 63 - 1},
+            {"big": -2 ** 63, "power": 1.0},
+            {}]
+
+    assert unpack(pack(rows)) == rows
+    assert unpack(pack([])) == []
+
+    # Types are preserved, even where they would compare equal
+    assert [type(row.get("power")) for row in unpack(pack(rows))] == [type(None), type(None), float, type(None)]
+    assert math.isnan(unpack(pack([{"power": math.nan}]))[0]["power"])
+
+
+@pytest.mark.parametrize("compression", ["zlib", NO_COMPRESSION,
+                                         pytest.param(LZ4, marks=pytest.mark.skipif(lz4 is None,
+                                                                                    reason="lz4 is not installed"))])
+def test_compressions(compression):
+    rows = day_of_readings(100)
+    packed = pack(rows, compression)
+
+    assert packed["compression"] == compression
+    assert packed["count"] == 100
+    assert unpack(packed) == rows
+
+
+def test_packed_span_is_kept_in_the_clear():
+    packed = pack([{"timestamp": 5}, {"power": 1}, {"timestamp": 2.5}, {"timestamp": math.inf}])
+
+    assert (packed["first"], packed["last"]) == (2.5, 5)
+    assert "first" not in pack([{"power": 1}]) and "last" not in pack([])
+
+
+def test_unknown_compression_and_format():
+    with pytest.raises(ValueError):
+        pack([], "unknown")
+
+    with pytest.raises(ValueError):
+        unpack(dict(pack([]), format=99))
+
+
+def test_packed_day_is_much_smaller():
+    rows = day_of_readings()
+
+    plain = len(json.dumps(EnergyData(DUMMY_DATE, rows).as_json(string=False)))
+    packed = len(json.dumps({"date": DUMMY_DATE, "energy_data": [], PACKED_FIELD: pack(rows)}))
+
+    assert packed * 5 < plain
+
+
+def test_from_json_unpacks_transparently():
+    doc = {"date": DUMMY_DATE, "energy_data": readings(2, 3), PACKED_FIELD: pack(readings(0, 2))}
+
+    assert EnergyData.from_json(doc) == EnergyData(DUMMY_DATE, readings(0, 3))
+    assert EnergyData.from_json(dict(doc, **{PACKED_FIELD: None})) == EnergyData(DUMMY_DATE, readings(2, 3))
+
+
+@packed
+def test_adapter_stores_packed_documents(adapter, couch):
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 3)))
+
+    stored = couch.databases["test"][document]
+    assert stored["energy_data"] == []
+    assert unpack(stored[PACKED_FIELD]) == readings(0, 3)
+
+    # Server-side appends leave the packed readings alone, client-side ones repack the whole document
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(3, 4)), document=document)
+    assert couch.databases["test"][document]["energy_data"] == readings(3, 4)
+
+    adapter.server_side_append = False
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(4, 5)), document=document)
+    assert couch.databases["test"][document]["energy_data"] == []
+
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE) == EnergyData(DUMMY_DATE, readings(0, 5))
+    assert list(adapter.iter_energy_data(document=document, start=DAY_START + 1, fields=[])) == \
+        [{"timestamp": DAY_START + t} for t in range(1, 5)]
+    assert list(adapter.fetch_readings(DAY_START + 3, DAY_START + 10)) == readings(3, 5)
+    assert adapter.fetch_rollups(DAY_START, DAY_START + HOUR, ["power"], resolution=HOUR)["power"][0].count == 5
+
+
+@packed
+def test_plain_writer_replaces_packed_readings(adapter, make_adapter):
+    adapter.install_design()
+    adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 3)))
+
+    plain = make_adapter()
+    assert plain.fetch_energy_data_by_date(DUMMY_DATE).energy_data == readings(0, 3)
+
+    assert plain.update_energy_data_by_date(DUMMY_DATE, EnergyData(DUMMY_DATE, readings(5, 6)))
+    assert plain.fetch_energy_data_by_date(DUMMY_DATE).energy_data == readings(5, 6)
+    assert adapter.fetch_energy_data_by_date(DUMMY_DATE).energy_data == readings(5, 6)
+
+
+def test_views_see_packed_documents(adapter, couch, make_adapter):
+    """Days stored by a packed writer are merged into the by_timestamp and rollups views, which skip them."""
+
+    packer = make_adapter("encoding = packed")
+    assert adapter.create_document(initial_data=EnergyData("1999-12-31", readings(-3, 0)))
+    document = packer.create_document(initial_data=EnergyData(DUMMY_DATE, readings(0, 3)))
+    later = packer.create_document(initial_data=EnergyData("2000-01-02", readings(HOUR, HOUR + 1)))
+    assert packer.append_energy_data(EnergyData(energy_data=readings(3, 4)), document=document)
+
+    assert list(adapter.fetch_readings(DAY_START - 2, DAY_START + 10, fields=["power"])) == readings(-2, 4)
+    rollups = adapter.fetch_rollups(DAY_START - HOUR, DAY_START + HOUR, ["power"], resolution=HOUR)["power"]
+    assert [(rollup.count, rollup.sum, rollup.min, rollup.max) for rollup in rollups] == [(3, -60, -30, -10),
+                                                                                          (4, 60, 0, 30)]
+
+    # Only the packed documents that overlap the range are fetched
+    assert couch.count("GET", f"/{later}") == 0
+    assert couch.count("GET", "/_view/packed_spans") == 2
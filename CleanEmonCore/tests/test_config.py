@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+
+from CleanEmonCore.config import clear_config_cache
+from CleanEmonCore.config import load_config
+
+# The time that importing the package and its main modules may take, in a fresh interpreter
+IMPORT_BUDGET = 0.5
+
+# Modules that take long to import, and must only be imported once they are actually needed
+DEFERRED_MODULES = ["requests", "urllib3", "asyncio", "numpy"]
+
+IMPORT_SCRIPT = f"""
+import json
+import sys
+import time
+
+started = time.perf_counter()
+import CleanEmonCore
+import CleanEmonCore.CouchDBAdapter
+import CleanEmonCore.SQLiteAdapter
+import CleanEmonCore.Events
+elapsed = time.perf_counter() - started
+
+print(json.dumps({{"elapsed": elapsed, "loaded": [name for name in {DEFERRED_MODULES!r} if name in sys.modules]}}))
+"""
+
+
+def test_config_is_parsed_once_until_changed(tmp_path):
+    path = tmp_path / "clean.cfg"
+    path.write_text("[DB]\nendpoint = a\n")
+
+    first = load_config(str(path))
+    assert first["DB"]["endpoint"] == "a"
+    assert load_config(str(path)) is first
+
+    path.write_text("[DB]\nendpoint = changed\n")
+    assert load_config(str(path))["DB"]["endpoint"] == "changed"
+
+    clear_config_cache()
+    assert load_config(str(path)) is not first
+
+
+def test_missing_config_is_empty(tmp_path):
+    cfg = load_config(str(tmp_path / "missing.cfg"))
+    assert not cfg.has_section("DB")
+
+
+def test_import_is_fast_and_has_no_side_effects(tmp_path):
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    # Installed packages must stay importable, or the deferred ones would be missing anyway
+    python_path = os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")]))
+    env = dict(os.environ, HOME=str(tmp_path), PYTHONPATH=python_path)
+
+    # The fastest of a few runs, so that a momentarily busy machine does not fail the test
+    runs = [json.loads(subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=str(tmp_path), env=env, check=True,
+                                      stdout=subprocess.PIPE).stdout)
+            for _ in range(3)]
+
+    assert all(run["loaded"] == [] for run in runs)
+    assert min(run["elapsed"] for run in runs) < IMPORT_BUDGET
+    assert os.listdir(str(tmp_path)) == []
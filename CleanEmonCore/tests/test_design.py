@@ -0,0 +1,316 @@
+import json
+import random
+import shutil
+import subprocess
+
+import pytest
+import requests
+from pytest import fixture
+
+from CleanEmonCore import protocol
+from CleanEmonCore.codec import PACKED_FIELD
+from CleanEmonCore.codec import pack
+from CleanEmonCore.design import DESIGN_DOCUMENT
+from CleanEmonCore.design import DESIGN_FUNCTIONS
+from CleanEmonCore.design import OWNED_FUNCTIONS_FIELD
+from CleanEmonCore.design import READINGS_DESIGN_DOCUMENT
+from CleanEmonCore.design import READINGS_DESIGN_FUNCTIONS
+from CleanEmonCore.models import EnergyData
+from CleanEmonCore.models import merge_readings
+
+CUSTOM_GET_DATES = {"map": "function (doc) { if (doc.day) { emit(doc.day, doc._id); } }"}
+
+requires_node = pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+
+
+@fixture
+def emulated(couch, adapter):
+    """The fake server, with the design document installed, so that it emulates the design functions"""
+
+    assert adapter.install_design()
+    return couch
+
+
+def stored_design(couch, document=DESIGN_DOCUMENT):
+    return couch.databases["test"].get(document)
+
+
+def put_design(couch, design):
+    couch.databases["test"][DESIGN_DOCUMENT] = dict(design, _id=DESIGN_DOCUMENT, _rev="1-a")
+
+
+def test_install_design_keeps_the_deployment_get_dates(adapter, couch):
+    put_design(couch, {"views": {"get_dates": CUSTOM_GET_DATES, "other": {"map": "x"}}})
+
+    assert adapter.install_design()
+
+    design = stored_design(couch)
+    assert design["views"]["get_dates"] == CUSTOM_GET_DATES
+    assert design["views"]["other"] == {"map": "x"}
+    assert design["updates"] == DESIGN_FUNCTIONS["updates"]
+    assert "views/get_dates" not in design[OWNED_FUNCTIONS_FIELD]
+    assert "updates/append" in design[OWNED_FUNCTIONS_FIELD]
+
+
+def test_install_design_upgrades_its_own_functions(adapter, couch):
+    assert adapter.install_design()
+    design = stored_design(couch)
+    design["updates"]["append"] = "function (doc, req) { return [null, 'outdated']; }"
+    rev = design["_rev"]
+
+    adapter._design_installed = False
+    assert adapter.install_design()
+
+    assert stored_design(couch)["updates"]["append"] == DESIGN_FUNCTIONS["updates"]["append"]
+    assert stored_design(couch)["_rev"] != rev
+
+    # An up-to-date design document is not written again
+    rev = stored_design(couch)["_rev"]
+    assert adapter.install_design()
+    assert stored_design(couch)["_rev"] == rev
+
+
+def test_install_design_never_overwrites_foreign_functions(adapter, couch):
+    foreign = "function (doc, req) { return [doc, 'mine']; }"
+    put_design(couch, {"views": {"get_dates": DESIGN_FUNCTIONS["views"]["get_dates"]}, "updates": {"append": foreign}})
+
+    assert not adapter.install_design()
+    assert stored_design(couch)["_rev"] == "1-a"
+    assert stored_design(couch)["updates"] == {"append": foreign}
+
+    # Appends fall back to the client-side path
+    document = adapter.create_document(initial_data=EnergyData("2000-01-01"))
+    assert adapter.append_energy_data(EnergyData(energy_data=[{"timestamp": 1}]), document=document)
+    assert adapter.fetch_energy_data(document=document).energy_data == [{"timestamp": 1}]
+    assert couch.count("POST", "/_update/append/") == 0
+
+
+def test_readings_views_are_installed_on_first_use(adapter, couch):
+    assert adapter.install_design()
+    document = adapter.create_document(initial_data=EnergyData("2000-01-01", [{"timestamp": 1, "power": 2}]))
+    assert adapter.append_energy_data(EnergyData(energy_data=[{"timestamp": 2, "power": 3}]), document=document)
+
+    assert set(stored_design(couch)["views"]) == {"get_dates"}
+    assert stored_design(couch, READINGS_DESIGN_DOCUMENT) is None
+
+    assert list(adapter.fetch_readings(0, 10, fields=["power"])) == [{"timestamp": 1, "power": 2},
+                                                                     {"timestamp": 2, "power": 3}]
+    assert stored_design(couch, READINGS_DESIGN_DOCUMENT)["views"] == READINGS_DESIGN_FUNCTIONS["views"]
+    assert couch.count("GET", f"{READINGS_DESIGN_DOCUMENT}/_view/by_timestamp") == 1
+
+    # Installed once per adapter
+    list(adapter.fetch_readings(0, 10))
+    assert adapter.fetch_rollups(0, 60, ["power"])["power"][0].count == 2
+    assert couch.count("GET", f"{READINGS_DESIGN_DOCUMENT}/_view/rollups") == 1
+    assert couch.count("PUT", READINGS_DESIGN_DOCUMENT) == 1
+
+
+def test_install_design_drops_the_views_that_moved(adapter, couch):
+    moved = {name: READINGS_DESIGN_FUNCTIONS["views"][name] for name in ("by_timestamp", "rollups")}
+    views = dict(DESIGN_FUNCTIONS["views"], **moved)
+    put_design(couch, {"views": views, OWNED_FUNCTIONS_FIELD: ["views/by_timestamp", "views/rollups"]})
+
+    assert adapter.install_design()
+    assert set(stored_design(couch)["views"]) == {"get_dates"}
+    assert not {"views/by_timestamp", "views/rollups"} & set(stored_design(couch)[OWNED_FUNCTIONS_FIELD])
+
+
+def run_function(kind, name, calls):
+    """Runs a design function of DESIGN_FUNCTIONS under node, once per (doc, req) pair of `calls`.
+    Returns the results of the calls, in order.
+    """
+
+    script = f"""
+        var fn = {DESIGN_FUNCTIONS[kind][name]};
+        console.log(JSON.stringify({json.dumps(calls)}.map(function (c) {{ return fn(c[0], c[1]); }})));
+    """
+    return json.loads(subprocess.run(["node", "-e", script], capture_output=True, text=True, check=True).stdout)
+
+
+def run_map(name, docs):
+    """Runs a view of READINGS_DESIGN_FUNCTIONS under node, once per document of `docs`.
+    Returns the [key, value] pairs emitted for each document.
+    """
+
+    script = f"""
+        var rows;
+        function emit(key, value) {{ rows.push([key, value === undefined ? null : value]); }}
+        var fn = {READINGS_DESIGN_FUNCTIONS["views"][name]["map"]};
+        console.log(JSON.stringify({json.dumps(docs)}.map(function (doc) {{ rows = []; fn(doc); return rows; }})));
+    """
+    return json.loads(subprocess.run(["node", "-e", script], capture_output=True, text=True, check=True).stdout)
+
+
+def update_result(result):
+    """Describes the outcome of an update function as (status, response body, stored document or None)."""
+
+    doc, response = result
+    return response.get("code", 201 if doc is not None else 200), response["json"], doc
+
+
+def fake_update(couch, name, doc, body=None):
+    """Runs the emulation of the update function `name` on `doc` (or on a missing document, if None), the way
+    `update_result` describes a real run."""
+
+    db = couch.databases["test"]
+    db.pop("x", None)
+    if doc is not None:
+        db["x"] = dict(doc, _id="x", _rev="1-a")
+
+    res = requests.post(f"{couch.url}/test/{DESIGN_DOCUMENT}/_update/{name}/x", json=body)
+    stored = db.get("x")
+    if stored is None or stored["_rev"] == "1-a":
+        stored = None
+    else:
+        stored = {key: value for key, value in stored.items() if key != "_rev"}
+    return res.status_code, res.json(), stored
+
+
+def random_readings(rng, count):
+    readings = []
+    for _ in range(count):
+        reading = {"power": rng.randint(0, 99)}
+        if rng.random() < 0.5:
+            reading["temp"] = rng.randint(15, 25)
+        if rng.random() < 0.9:
+            reading["timestamp"] = rng.randint(0, 30) + rng.choice([0, 0.5])
+        readings.append(reading)
+    return readings
+
+
+@requires_node
+def test_append_handler_mirrors_merge_readings():
+    rng = random.Random(0)
+    cases = []
+    for _ in range(100):
+        stored = random_readings(rng, rng.randint(0, 15))
+        if rng.random() < 0.7:
+            stored = merge_readings([], stored)
+        cases.append((stored, random_readings(rng, rng.randint(0, 8))))
+
+    calls = [({"_id": "x", "energy_data": stored}, {"id": "x", "body": json.dumps({"energy_data": rows})})
+             for stored, rows in cases]
+    merged = [doc["energy_data"] for doc, _ in run_function("updates", "append", calls)]
+    assert merged == [merge_readings(*case) for case in cases]
+
+
+SEAL_CASES = [
+    None,
+    {"energy_data": [{"timestamp": 1}]},
+    {"energy_data": [], "applied_batches": ["b1", "b2"]},
+    {"energy_data": [], "applied_batches": ["b1"], "sealed": True},
+    {"energy_data": [{"timestamp": 3}, {"power": 1}], "floor": 2, "packed_energy_data": {"last": 5}},
+    {"energy_data": [], "floor": 2},
+]
+
+STALE_CASES = [
+    ({"energy_data": [{"timestamp": 5}], "floor": 4}, {"energy_data": [{"timestamp": 4}, {"timestamp": 6}]}),
+    ({"energy_data": [], "floor": 4}, {"energy_data": [{"power": 1}, {"timestamp": 4.5}], "batch_id": "b1"}),
+    ({"energy_data": [], "floor": 4, "applied_batches": ["b1"]}, {"energy_data": [{"timestamp": 1}], "batch_id": "b1"}),
+]
+
+ADD_CHUNK_CASES = [
+    (None, "x.1"),
+    ({"energy_data": []}, "x.1"),
+    ({"energy_data": [], "chunks": ["x.1"]}, "x.1"),
+    ({"energy_data": [], "chunks": ["x.1"]}, "x.2"),
+]
+
+
+@requires_node
+def test_seal_handler_matches_the_emulation(emulated):
+    calls = [(dict(doc, _id="x") if doc is not None else None, {"id": "x", "body": "undefined"}) for doc in SEAL_CASES]
+    results = [update_result(result) for result in run_function("updates", "seal", calls)]
+
+    assert results == [fake_update(emulated, "seal", doc) for doc in SEAL_CASES]
+    assert [doc["sealed"] for _, _, doc in results[1:3]] == [True, True]
+    assert [body["last"] for _, body, _ in results[1:]] == [1, None, None, 5, 2]
+
+
+@requires_node
+def test_append_handler_refuses_stale_rows_as_the_emulation(emulated):
+    calls = [(dict(doc, _id="x"), {"id": "x", "body": json.dumps(body)}) for doc, body in STALE_CASES]
+    results = [update_result(result) for result in run_function("updates", "append", calls)]
+
+    assert results == [fake_update(emulated, "append", doc, body) for doc, body in STALE_CASES]
+    assert results[0][:2] == (409, {"error": "stale", "floor": 4, "reason": "Readings belong to an older chunk"})
+    assert results[1][2]["applied_batches"] == ["b1"]
+
+
+@requires_node
+def test_add_chunk_handler_matches_the_emulation(emulated):
+    calls = [(dict(doc, _id="x") if doc is not None else None, {"id": "x", "body": json.dumps({"chunk": chunk})})
+             for doc, chunk in ADD_CHUNK_CASES]
+    results = [update_result(result) for result in run_function("updates", "add_chunk", calls)]
+
+    assert results == [fake_update(emulated, "add_chunk", doc, {"chunk": chunk}) for doc, chunk in ADD_CHUNK_CASES]
+    assert results[3][2]["chunks"] == ["x.1", "x.2"]
+
+
+@requires_node
+def test_chunks_show_matches_the_emulation(emulated):
+    docs = [None, {"energy_data": [{"timestamp": 1}]}, {"energy_data": [], "chunks": ["x.1", "x.2"]}]
+    results = run_function("shows", "chunks", [(dict(doc, _id="x") if doc else None, {"query": {}}) for doc in docs])
+
+    served = []
+    for doc in docs:
+        emulated.databases["test"].pop("x", None)
+        if doc is not None:
+            emulated.databases["test"]["x"] = dict(doc, _id="x", _rev="1-a")
+        res = requests.get(f"{emulated.url}/test/{DESIGN_DOCUMENT}/_show/chunks/x")
+        served.append((res.status_code, res.json()))
+
+    assert [(result.get("code", 200), result["json"]) for result in results] == served
+
+
+@requires_node
+def test_window_show_mirrors_filter_readings(emulated):
+    rng = random.Random(0)
+    cases = []
+    for _ in range(100):
+        fields = rng.choice([None, [], ["power"], ["temp", "power"], ["missing"]])
+        start = rng.choice([None, rng.randint(0, 30), rng.randint(0, 30) + 0.5])
+        end = rng.choice([None, rng.randint(0, 30)])
+        cases.append((random_readings(rng, rng.randint(0, 15)), fields, start, end))
+
+    calls = []
+    for readings, fields, start, end in cases:
+        request = protocol.window("test", "x", fields=fields, start=start, end=end)
+        calls.append(({"_id": "x", "date": "", "energy_data": readings}, {"query": request.params or {}}))
+    shown = [result["json"]["energy_data"] for result in run_function("shows", "window", calls)]
+
+    expected = [list(protocol.filter_readings(readings, fields, start, end)) for readings, fields, start, end in cases]
+    assert shown == expected
+
+    served = []
+    for readings, fields, start, end in cases:
+        emulated.databases["test"]["x"] = {"_id": "x", "_rev": "1-a", "date": "", "energy_data": readings}
+        request = protocol.window("test", "x", fields=fields, start=start, end=end)
+        served.append(requests.get(f"{emulated.url}{request.path}", params=request.params).json()["energy_data"])
+    assert served == expected
+
+
+PACKED_DOCS = [
+    {"energy_data": [{"timestamp": 1, "power": 2}]},
+    {"energy_data": [{"timestamp": 9}, {"power": 1}], PACKED_FIELD: pack([{"timestamp": 3}, {"timestamp": 5}])},
+    {"energy_data": [{"timestamp": 1}], PACKED_FIELD: pack([{"timestamp": 3}])},
+    {"energy_data": [{"timestamp": 1}], PACKED_FIELD: {"count": 1, "last": 3}},
+    {"energy_data": [{"timestamp": 1}], PACKED_FIELD: pack([{"power": 1}])},
+    {"energy_data": [{"timestamp": 1, "power": 2}], PACKED_FIELD: None},
+]
+
+
+@requires_node
+def test_packed_spans_view_matches_the_emulation():
+    emitted = [[tuple(row) for row in rows] for rows in run_map("packed_spans", PACKED_DOCS)]
+
+    spans = [protocol.packed_span(doc) for doc in PACKED_DOCS]
+    assert emitted == [[span] if span is not None else [] for span in spans]
+    assert spans[1:5] == [([0, 9], 3), ([0, 3], 1), ([0, 3], None), ([1], None)]
+
+
+@requires_node
+@pytest.mark.parametrize("name", ["by_timestamp", "rollups"])
+def test_readings_views_skip_packed_documents(name):
+    emitted = run_map(name, PACKED_DOCS)
+    assert [bool(rows) for rows in emitted] == [True, False, False, False, False, True]
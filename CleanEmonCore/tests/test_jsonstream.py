@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pytest
+
+from CleanEmonCore.jsonstream import aiter_array
+from CleanEmonCore.jsonstream import dumps
+from CleanEmonCore.jsonstream import iter_array
+from CleanEmonCore.jsonstream import iter_dumps
+from CleanEmonCore.jsonstream import loads
+
+
+def chunked(text: str, size: int):
+    data = text.encode()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.fixture
+def document():
+    return {"_id": "abc", "_rev": "1-x", "date": "2022-05-01",
+            "energy_data": [{"timestamp": i, "power": i * 1.5, "label": "κ"} for i in range(200)],
+            "tail": {"nested": [1, 2, {"energy_data": []}]}}
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, 100000])
+def test_iter_array(document, size):
+    items = list(iter_array(chunked(json.dumps(document), size), "energy_data"))
+    assert items == document["energy_data"]
+
+
+def test_iter_array_numbers_across_chunks():
+    text = '{"rows": [12345, 678, 9, 1e+20, -2.5e-3]}'
+    for size in range(1, 6):
+        assert list(iter_array(chunked(text, size), "rows")) == [12345, 678, 9, 1e+20, -2.5e-3]
+
+
+def test_aiter_array(document):
+    async def chunks():
+        for chunk in chunked(json.dumps(document), 7):
+            yield chunk
+
+    async def collect():
+        return [item async for item in aiter_array(chunks(), "energy_data")]
+
+    assert asyncio.run(collect()) == document["energy_data"]
+
+
+def test_iter_array_missing_or_empty():
+    assert list(iter_array(chunked('{"a": 1}', 3), "rows")) == []
+    assert list(iter_array(chunked('{"rows": []}', 3), "rows")) == []
+    assert list(iter_array(chunked('{}', 3), "rows")) == []
+
+
+def test_iter_array_is_lazy():
+    def chunks():
+        yield b'{"rows": [1, 2,'
+        raise RuntimeError("Should not be read yet")
+
+    items = iter_array(chunks(), "rows")
+    assert next(items) == 1
+
+
+def test_iter_array_malformed():
+    with pytest.raises(ValueError):
+        list(iter_array(chunked('{"rows": [1, 2', 3), "rows"))
+
+
+def test_dumps_loads(document):
+    assert isinstance(dumps(document), bytes)
+    assert loads(dumps(document)) == document
+
+
+def test_iter_dumps(document):
+    chunks = list(iter_dumps(document, chunk_size=256))
+    assert len(chunks) > 1
+    assert json.loads(b"".join(chunks)) == document
+    assert list(iter_array(chunks, "energy_data")) == document["energy_data"]
@@ -0,0 +1,147 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+from CleanEmonCore import PACKAGE_DIR
+from CleanEmonCore.metrics import Metrics
+from CleanEmonCore.metrics import RequestSample
+from CleanEmonCore.metrics import UNTAGGED
+from CleanEmonCore.metrics import operation
+from CleanEmonCore.models import EnergyData
+from CleanEmonCore.transport import HTTPTransport
+
+DUMMY_DATE = "2000-01-01"
+
+
+def readings(count):
+    return [{"timestamp": t, "power": t * 10} for t in range(count)]
+
+
+def test_snapshot_and_prometheus():
+    metrics = Metrics(buckets=[0.1, 1])
+    metrics(RequestSample("fetch", "GET", 200, 0.05, 0, 100))
+    metrics(RequestSample("fetch", "GET", 404, 0.5, 0, 10, retries=2))
+    metrics(RequestSample("append", "POST", 0, 3.0, 20, 0))
+
+    snapshot = metrics.snapshot()
+    assert snapshot["fetch"]["requests"] == 2
+    assert snapshot["fetch"]["statuses"] == {200: 1, 404: 1}
+    assert snapshot["fetch"]["retries"] == 2
+    assert snapshot["fetch"]["bytes_received"] == 110
+    assert snapshot["fetch"]["latency"]["buckets"] == {0.1: 1, 1: 2}
+    assert snapshot["append"]["latency"]["buckets"] == {0.1: 0, 1: 0}
+    assert snapshot["append"]["latency"]["count"] == 1
+
+    text = metrics.to_prometheus()
+    assert 'cleanemon_requests_total{operation="fetch",status="404"} 1' in text
+    assert 'cleanemon_request_retries_total{operation="fetch"} 2' in text
+    assert 'cleanemon_request_sent_bytes_total{operation="append"} 20' in text
+    assert 'cleanemon_request_duration_seconds_bucket{operation="fetch",le="0.1"} 1' in text
+    assert 'cleanemon_request_duration_seconds_bucket{operation="append",le="+Inf"} 1' in text
+    assert 'cleanemon_request_duration_seconds_sum{operation="append"} 3.0' in text
+
+    metrics.reset()
+    assert metrics.snapshot() == {}
+
+
+def test_disabled_by_default(adapter):
+    assert adapter.metrics is None
+    assert adapter.transport.hooks == []
+
+
+@pytest.mark.parametrize("adapter", [["metrics = yes"]], indirect=True)
+def test_requests_are_tagged_by_operation(adapter):
+    adapter.install_design()
+    document = adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(5)))
+    assert adapter.append_energy_data(EnergyData(energy_data=readings(1)), document=document)
+
+    adapter.fetch_energy_data_by_date(DUMMY_DATE)
+
+    # Requests sent by the consumer of a generator are not tagged with the operation of the generator
+    untagged = []
+    for _ in adapter.iter_energy_data(document=document):
+        if not untagged:
+            untagged.append(adapter.transport.get("/").status_code)
+
+    snapshot = adapter.metrics.snapshot()
+    assert set(snapshot) == {"install_design", "create_document", "append_energy_data", "fetch_energy_data",
+                             "iter_energy_data", UNTAGGED}
+    assert snapshot["create_document"]["bytes_sent"] > 0
+    assert snapshot["append_energy_data"]["statuses"] == {201: 1}
+    assert snapshot[UNTAGGED]["requests"] == 1
+
+    # Streamed responses are measured once they are closed
+    streamed = snapshot["iter_energy_data"]
+    assert streamed["requests"] == 1
+    assert streamed["bytes_received"] > 0
+    assert streamed["latency"]["count"] == 1
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    failures = 0
+
+    def do_GET(self):
+        if FlakyHandler.failures:
+            FlakyHandler.failures -= 1
+            status = 503
+        else:
+            status = 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_retries_and_failures_are_counted():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    metrics = Metrics()
+    transport = HTTPTransport(f"http://127.0.0.1:{server.server_address[1]}", backoff_factor=0, hooks=[metrics])
+
+    FlakyHandler.failures = 2
+    with operation("flaky"):
+        assert transport.get("/").ok
+
+    server.shutdown()
+    server.server_close()
+
+    unreachable = HTTPTransport(f"http://127.0.0.1:{server.server_address[1]}", retries=0, hooks=[metrics])
+    with operation("down"):
+        with pytest.raises(requests.ConnectionError):
+            unreachable.get("/")
+
+    snapshot = metrics.snapshot()
+    assert snapshot["flaky"]["retries"] == 2
+    assert snapshot["flaky"]["bytes_received"] == 2
+    assert snapshot["down"]["statuses"] == {0: 1}
+    transport.close()
+
+
+@pytest.mark.usefixtures("design")
+def test_probe_command(adapter, tmp_path):
+    adapter.create_document(initial_data=EnergyData(DUMMY_DATE, readings(3)))
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(PACKAGE_DIR))
+    output = subprocess.run([sys.executable, "-m", "CleanEmonCore", "probe", "--config", str(tmp_path / "clean.cfg"),
+                             "--date", DUMMY_DATE, "--repeat", "2"],
+                            env=env, capture_output=True, text=True, check=True).stdout
+
+    assert 'cleanemon_requests_total{operation="fetch_energy_data",status="200"} 2' in output
+    assert 'cleanemon_requests_total{operation="get_document_id_for_date",status="200"} 1' in output
+
+    output = subprocess.run([sys.executable, "-m", "CleanEmonCore", "probe", "--config", str(tmp_path / "clean.cfg"),
+                             "--date", DUMMY_DATE, "--json"],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    assert json.loads(output)["fetch_energy_data"]["requests"] == 1
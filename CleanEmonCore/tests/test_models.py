@@ -1,6 +1,12 @@
 from pytest import fixture
 
+import json
+import math
+from array import array
+
+from CleanEmonCore.models import ColumnarEnergyData
 from CleanEmonCore.models import EnergyData
+from CleanEmonCore.models import merge_readings
 
 
 @fixture
@@ -33,3 +39,127 @@ class TestEnergyData:
         assert data.energy_data
         assert type(data.as_json(string=True)) is str
         assert type(data.as_json(string=False)) is dict
+
+    def test_as_json_is_shallow(self, energy_data):
+        data = energy_data
+        assert data.as_json(string=False)["energy_data"] is data.energy_data
+
+    def test_as_bytes(self, energy_data):
+        data = energy_data
+        assert json.loads(data.as_bytes()) == json.loads(data.as_json(string=True))
+        assert b"".join(data.iter_json(chunk_size=16)) == data.as_json(string=True).encode()
+        assert len(list(data.iter_json(chunk_size=16))) > 1
+
+    def test_from_json(self, energy_data):
+        data = energy_data
+        doc = dict(data.as_json(string=False), _id="abc", _rev="1-abc")
+        assert EnergyData.from_json(doc) == data
+        assert EnergyData.from_json({}) == EnergyData()
+
+
+class TestColumnarEnergyData:
+
+    def test_round_trip(self, energy_data):
+        columnar = ColumnarEnergyData.from_energy_data(energy_data)
+        assert len(columnar) == 3
+        assert columnar.fields == ["timestamp", "power", "temp"]
+        assert isinstance(columnar.columns["power"], array)
+        assert columnar.to_energy_data() == energy_data
+        assert columnar.as_json(string=True) == energy_data.as_json(string=True)
+
+    def test_mixed_and_missing_fields(self):
+        data = EnergyData("2022-05-01", [{"timestamp": 2, "power": 1.5, "label": "b"},
+                                         {"timestamp": 1, "temp": 20}])
+        columnar = ColumnarEnergyData.from_energy_data(data)
+        assert list(columnar.columns["timestamp"]) == [1, 2]
+        assert columnar.columns["timestamp"].typecode == "q"
+        assert columnar.columns["power"].typecode == "d"
+        assert columnar.to_energy_data().energy_data == [{"timestamp": 1, "temp": 20},
+                                                         {"timestamp": 2, "power": 1.5, "label": "b"}]
+
+    def test_slice(self, energy_data):
+        columnar = ColumnarEnergyData.from_energy_data(energy_data)
+        assert list(columnar.slice(2, 3).columns["power"]) == [150]
+        assert len(columnar.slice(start=2)) == 2
+        assert len(columnar.slice(end=2)) == 1
+        assert len(columnar.slice(10, 20)) == 0
+
+    def test_aggregates(self, energy_data):
+        columnar = ColumnarEnergyData.from_energy_data(energy_data)
+        assert columnar.sum("power") == 370
+        assert columnar.mean("power") == 370 / 3
+        assert columnar.min("temp") == 20
+        assert columnar.max("temp") == 21
+        assert columnar.count("temp") == 3
+        assert math.isnan(columnar.slice(10, 20).mean("power"))
+
+    def test_resample(self):
+        data = EnergyData("2022-05-01", [{"timestamp": t, "power": t * 10} for t in range(10)])
+        columnar = ColumnarEnergyData.from_energy_data(data)
+        resampled = columnar.resample(4, how="sum")
+        assert list(resampled.columns["timestamp"]) == [0, 4, 8]
+        assert list(resampled.columns["power"]) == [60, 220, 170]
+        assert list(columnar.resample(4).columns["power"]) == [15.0, 55.0, 85.0]
+        assert list(columnar.resample(4, how="max").columns["power"]) == [30, 70, 90]
+
+    def test_untimed_readings_stay_out_of_the_index(self):
+        data = EnergyData("2022-05-01", [{"timestamp": 5, "power": 1}, {"power": 2}, {"timestamp": 1, "power": 3}])
+        columnar = ColumnarEnergyData.from_energy_data(data)
+
+        assert columnar.columns["timestamp"] == array("q", [1, 5])
+        assert list(columnar.columns["power"]) == [3, 1, 2]
+        assert len(columnar) == 3
+        assert columnar.to_energy_data().energy_data == merge_readings([], data.energy_data)
+        assert columnar.slice(0, 4).to_energy_data().energy_data == [{"timestamp": 1, "power": 3}]
+        assert len(columnar.slice(start=0)) == 2
+        assert len(columnar.slice()) == 3
+
+        # Columns built by hand, with NaN for the missing timestamps, are ordered the same way
+        columnar = ColumnarEnergyData(columns={"timestamp": array("d", [5.0, math.nan, 1.0]),
+                                               "power": array("q", [1, 2, 3])})
+        assert list(columnar.columns["timestamp"]) == [1.0, 5.0]
+        assert list(columnar.columns["power"]) == [3, 1, 2]
+        assert len(columnar.slice(0, 4)) == 1
+
+    def test_integer_aggregates_are_exact(self):
+        big = 2 ** 60 + 1
+        data = EnergyData("2022-05-01", [{"timestamp": 0, "power": big}, {"timestamp": 1, "power": big}])
+        columnar = ColumnarEnergyData.from_energy_data(data)
+
+        assert list(columnar.resample(4, how="max").columns["power"]) == [big]
+        assert list(columnar.resample(4, how="min").columns["power"]) == [big]
+        assert list(columnar.resample(4, how="sum").columns["power"]) == [2 * big]
+        assert columnar.resample(4, how="sum").columns["power"].typecode == "q"
+
+
+class TestMergeReadings:
+
+    def test_in_order(self):
+        stored = [{"timestamp": t} for t in range(3)]
+        assert merge_readings(stored, [{"timestamp": 3}, {"timestamp": 4}]) == [{"timestamp": t} for t in range(5)]
+
+    def test_out_of_order_and_duplicates(self):
+        stored = [{"timestamp": 1, "power": 1}, {"timestamp": 3, "power": 3}]
+        incoming = [{"timestamp": 4, "power": 4}, {"timestamp": 3, "power": 30}, {"timestamp": 2, "power": 2},
+                    {"timestamp": 2, "power": 20}]
+        assert merge_readings(stored, incoming) == [{"timestamp": 1, "power": 1}, {"timestamp": 2, "power": 20},
+                                                    {"timestamp": 3, "power": 30}, {"timestamp": 4, "power": 4}]
+
+    def test_untimed_readings_are_kept_last(self):
+        stored = [{"timestamp": 2}, {"power": 1}]
+        incoming = [{"power": 2}, {"timestamp": 1}, {"timestamp": "3"}]
+        assert merge_readings(stored, incoming) == [{"timestamp": 1}, {"timestamp": 2}, {"power": 1}, {"power": 2},
+                                                    {"timestamp": "3"}]
+
+    def test_unsorted_stored_readings(self):
+        stored = [{"timestamp": 3}, {"timestamp": 1}, {"timestamp": 3, "power": 3}]
+        assert merge_readings(stored, [{"timestamp": 2}]) == [{"timestamp": 1}, {"timestamp": 2},
+                                                               {"timestamp": 3, "power": 3}]
+
+    def test_inputs_are_not_modified(self):
+        stored = [{"timestamp": 1}, {"timestamp": 3}]
+        incoming = [{"timestamp": 2}]
+        merged = merge_readings(stored, incoming)
+        assert merged is not stored
+        assert stored == [{"timestamp": 1}, {"timestamp": 3}]
+        assert incoming == [{"timestamp": 2}]
@@ -0,0 +1,136 @@
+import configparser
+import json
+
+from CleanEmonCore import protocol
+from CleanEmonCore.design import DESIGN_DOCUMENT
+from CleanEmonCore.models import BulkResult
+
+
+def test_append_outcome():
+    assert protocol.append_outcome(201, {"count": 2}, chunk_readings=3) == protocol.DONE
+    assert protocol.append_outcome(201, {"count": 3}, chunk_readings=3) == protocol.FULL
+    assert protocol.append_outcome(201, None) == protocol.DONE
+    assert protocol.append_outcome(409, {"error": "sealed"}) == protocol.SEALED
+    assert protocol.append_outcome(409, {"error": "stale", "floor": 1}) == protocol.STALE
+    assert protocol.append_outcome(409, {"error": "conflict"}) == protocol.CONFLICT
+    assert protocol.append_outcome(409, None) == protocol.CONFLICT
+    assert protocol.append_outcome(404, None) == protocol.MISSING
+    assert protocol.append_outcome(500, None) == protocol.FAILED
+
+
+def test_append_locally_ignores_replayed_batches():
+    doc = protocol.append_locally({}, [{"timestamp": 2}, {"timestamp": 1}], "b1")
+    assert doc["energy_data"] == [{"timestamp": 1}, {"timestamp": 2}]
+    assert doc["applied_batches"] == ["b1"]
+    assert protocol.append_locally(doc, [{"timestamp": 3}], "b1") is None
+
+
+def test_new_chunk_carries_applied_batches():
+    chunk, request = protocol.new_chunk("db", "doc", ["doc.1"], {"applied_batches": ["b1"]})
+
+    assert chunk == "doc.2"
+    assert (request.method, request.path) == ("PUT", "/db/doc.2")
+    assert request.body == {"chunk_of": "doc", "energy_data": [], "applied_batches": ["b1"]}
+
+    _, request = protocol.new_chunk("db", "doc", [], {"applied_batches": [], "last": 5})
+    assert request.body["floor"] == 5
+
+
+def test_split_stale():
+    rows = [{"timestamp": 1}, {"power": 1}, {"timestamp": 3}, {"timestamp": 2}]
+
+    assert protocol.split_stale(rows, None) == ([], rows)
+    assert protocol.split_stale(rows, 2) == ([{"timestamp": 1}, {"timestamp": 2}], [{"power": 1}, {"timestamp": 3}])
+
+
+def test_window():
+    assert protocol.window("db", "doc").path == "/db/doc"
+    assert protocol.window("db", "doc", start=1, server_side=False).path == "/db/doc"
+
+    request = protocol.window("db", "doc", fields=["power", "temp"], start=1, end=5)
+    assert request.path == f"/db/{DESIGN_DOCUMENT}/_show/window/doc"
+    assert request.params == {"fields": "power,temp", "start": "1", "end": "5"}
+
+
+def test_dates_view_posts_long_key_lists():
+    request = protocol.dates_view("db", key="2000-01-01")
+    assert (request.method, request.params, request.body) == ("GET", {"key": json.dumps("2000-01-01")}, None)
+
+    request = protocol.dates_view("db", keys=["2000-01-01"])
+    assert (request.method, request.body, request.read) == ("POST", {"keys": ["2000-01-01"]}, True)
+
+
+def test_parse_bulk_docs():
+    docs = [{"_id": "a", "date": "2000-01-01"}, {"_id": "b", "_rev": "1-x", "date": "2000-01-02"}, {"_id": "c"}]
+
+    results = protocol.parse_bulk_docs(docs, 201, [{"rev": "1-a"}, {"rev": "2-b"}, {"error": "conflict"}])
+    assert results == [BulkResult("a", True, rev="1-a"), BulkResult("b", True, rev="2-b"),
+                       BulkResult("c", False, error="conflict")]
+    assert list(protocol.created_dates(docs, results)) == [("2000-01-01", "a")]
+
+    assert [result.error for result in protocol.parse_bulk_docs(docs, 500, None)] == ["http_500"] * 3
+
+
+def test_filter_readings():
+    readings = [{"timestamp": t, "power": t, "temp": 20} for t in range(5)] + [{"power": 1}]
+
+    assert list(protocol.filter_readings(readings)) == readings
+    assert list(protocol.filter_readings(readings, ["power"], 1, 3)) == [{"timestamp": 1, "power": 1},
+                                                                         {"timestamp": 2, "power": 2}]
+    assert list(protocol.batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def state(**options):
+    config = configparser.ConfigParser()
+    config["DB"] = dict({"endpoint": "http://localhost:5984", "db_name": "db", "document_name": "doc",
+                         "username": "", "password": ""}, **options)
+    return protocol.AdapterState(config["DB"])
+
+
+def drive(flow, results):
+    """Runs a flow against scripted results, one per step.
+    Returns the steps it took along with the result of the flow.
+    """
+
+    steps = []
+    results = iter(results)
+    try:
+        step = next(flow)
+        while True:
+            steps.append(step)
+            step = flow.send(next(results))
+    except StopIteration as stop:
+        return steps, stop.value
+
+
+def test_append_flow_retries_conflicts_and_rolls_over():
+    adapter = state(chunk_readings="2")
+    adapter._design_installed = True
+    adapter._tails["doc"] = "doc"
+
+    steps, appended = drive(protocol.append_energy_data(adapter, [{"timestamp": 1}]),
+                            [(409, {"error": "conflict"}), None,  # The conflicting append, and its backoff
+                             (201, {"count": 2}),  # The retried append, which fills the document up
+                             (200, {"chunks": []}), (201, {}), (201, {}), (201, {})])  # The rollover
+
+    assert appended
+    assert isinstance(steps[1], protocol.Backoff)
+    assert [(step.method, step.path) for step in steps[3:]] == [
+        ("GET", f"/db/{DESIGN_DOCUMENT}/_show/chunks/doc"),
+        ("POST", f"/db/{DESIGN_DOCUMENT}/_update/seal/doc"),
+        ("PUT", "/db/doc.1"),
+        ("POST", f"/db/{DESIGN_DOCUMENT}/_update/add_chunk/doc"),
+    ]
+    assert adapter._tails["doc"] == "doc.1"
+
+
+def test_append_flow_falls_back_to_the_client_side():
+    adapter = state()
+
+    steps, appended = drive(protocol.append_energy_data(adapter, [{"timestamp": 2}]),
+                            [False, {"date": "", "energy_data": [{"timestamp": 1}]}, (201, {})])
+
+    assert appended
+    assert not adapter.server_side_append
+    assert steps[:2] == [protocol.Install(DESIGN_DOCUMENT), protocol.Fetch("doc")]
+    assert steps[2].body["energy_data"] == [{"timestamp": 1}, {"timestamp": 2}]
@@ -0,0 +1,114 @@
+import calendar
+
+import pytest
+from pytest import fixture
+
+from CleanEmonCore.SQLiteAdapter import SQLiteAdapter
+from CleanEmonCore.models import EnergyData
+from CleanEmonCore.rollups import DAY
+from CleanEmonCore.rollups import HOUR
+from CleanEmonCore.rollups import MINUTE
+from CleanEmonCore.rollups import Rollup
+from CleanEmonCore.rollups import aggregate
+from CleanEmonCore.rollups import choose_resolution
+from CleanEmonCore.rollups import key_parts
+from CleanEmonCore.rollups import merge_rollups
+from CleanEmonCore.rollups import timestamp_of
+
+DAY_1 = calendar.timegm((2000, 1, 1, 0, 0, 0))
+DAY_2 = DAY_1 + DAY
+
+
+def readings(start, count, step=30):
+    """`count` readings every `step` seconds, with power equal to their index."""
+
+    return [{"timestamp": start + i * step, "power": i, "label": "x"} for i in range(count)]
+
+
+def test_choose_resolution():
+    assert choose_resolution(0, 30 * DAY) == DAY
+    assert choose_resolution(0, DAY) == HOUR
+    assert choose_resolution(0, HOUR) == MINUTE
+    assert choose_resolution(0, 10) == MINUTE
+    assert choose_resolution(0, DAY, min_points=1) == DAY
+
+
+def test_key_parts():
+    timestamp = calendar.timegm((2000, 2, 3, 4, 5, 6))
+    assert key_parts(timestamp) == [2000, 2, 3, 4, 5]
+    assert timestamp_of(key_parts(timestamp)) == timestamp - 6
+    assert timestamp_of([2000, 2, 3]) == calendar.timegm((2000, 2, 3, 0, 0, 0))
+
+
+def test_aggregate():
+    rollups = aggregate(readings(DAY_1, 4) + [{"power": 1}, {"timestamp": DAY_1, "power": float("nan")}], [MINUTE])
+
+    assert rollups == {(MINUTE, "power", DAY_1): Rollup(DAY_1, 2, 1, 0, 1),
+                       (MINUTE, "power", DAY_1 + MINUTE): Rollup(DAY_1 + MINUTE, 2, 5, 2, 3)}
+    assert rollups[(MINUTE, "power", DAY_1)].mean == 0.5
+
+
+def test_merge_rollups():
+    ours = [Rollup(DAY_1, 2, 1, 0, 1), Rollup(DAY_1 + MINUTE, 1, 2, 2, 2)]
+    theirs = [Rollup(DAY_1 - MINUTE, 1, 5, 5, 5), Rollup(DAY_1, 1, -3, -3, -3)]
+
+    assert merge_rollups(ours, theirs) == [Rollup(DAY_1 - MINUTE, 1, 5, 5, 5), Rollup(DAY_1, 3, -2, -3, 1),
+                                           Rollup(DAY_1 + MINUTE, 1, 2, 2, 2)]
+    assert ours[0] == Rollup(DAY_1, 2, 1, 0, 1)
+
+
+@fixture
+def sqlite(tmp_path):
+    with SQLiteAdapter(path=str(tmp_path / "db.sqlite")) as adapter:
+        yield adapter
+
+
+@fixture
+def couchdb(make_adapter):
+    return make_adapter()
+
+
+@fixture(params=["sqlite", "couchdb"])
+def adapter(request):
+    return request.getfixturevalue(request.param)
+
+
+def test_fetch_rollups(adapter):
+    document = adapter.create_document(initial_data=EnergyData("2000-01-01", readings(DAY_1, 240)))
+    adapter.create_document(initial_data=EnergyData("2000-01-02", readings(DAY_2, 2)))
+
+    hours = adapter.fetch_rollups(DAY_1, DAY_1 + DAY, ["power"])["power"]
+    assert [rollup.timestamp for rollup in hours] == [DAY_1, DAY_1 + HOUR]
+    assert hours[0] == Rollup(DAY_1, 120, sum(range(120)), 0, 119)
+
+    days = adapter.fetch_rollups(DAY_1, DAY_2 + DAY, ["power", "missing"], resolution=DAY)
+    assert [(rollup.timestamp, rollup.count) for rollup in days["power"]] == [(DAY_1, 240), (DAY_2, 2)]
+    assert days["missing"] == []
+
+    # Buckets that merely overlap the span are returned whole
+    minutes = adapter.fetch_rollups(DAY_1 + 90, DAY_1 + 150, ["power"])["power"]
+    assert [(rollup.timestamp, rollup.count) for rollup in minutes] == [(DAY_1 + MINUTE, 2), (DAY_1 + 2 * MINUTE, 2)]
+
+    # Rollups follow appends and replacements
+    adapter.append_energy_data(EnergyData(energy_data=[{"timestamp": DAY_1 + 1, "power": 1000}]), document=document)
+    assert adapter.fetch_rollups(DAY_1, DAY_1 + MINUTE, ["power"])["power"] == [Rollup(DAY_1, 3, 1001, 0, 1000)]
+
+    adapter.update_energy_data_by_date("2000-01-01", EnergyData("2000-01-01", readings(DAY_1, 1)))
+    assert adapter.fetch_rollups(DAY_1, DAY_1 + DAY, ["power"], resolution=DAY)["power"] == \
+        [Rollup(DAY_1, 1, 0, 0, 0)]
+
+    with pytest.raises(ValueError):
+        adapter.fetch_rollups(DAY_1, DAY_2, ["power"], resolution=7)
+
+
+def test_sqlite_rollups_follow_deletions(sqlite):
+    first = sqlite.create_document(initial_data=EnergyData("2000-01-01", readings(DAY_1, 2)))
+    sqlite.create_document(initial_data=EnergyData("2000-01-01", [{"timestamp": DAY_1, "power": 50}]))
+
+    assert sqlite.fetch_rollups(DAY_1, DAY_1 + MINUTE, ["power"])["power"] == [Rollup(DAY_1, 3, 51, 0, 50)]
+
+    sqlite.delete_document(first)
+    assert sqlite.fetch_rollups(DAY_1, DAY_1 + MINUTE, ["power"])["power"] == [Rollup(DAY_1, 1, 50, 50, 50)]
+
+    sqlite.rebuild_rollups()
+    assert sqlite.fetch_rollups(DAY_1, DAY_1 + MINUTE, ["power"])["power"] == [Rollup(DAY_1, 1, 50, 50, 50)]
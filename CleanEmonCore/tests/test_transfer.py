@@ -0,0 +1,150 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from pytest import fixture
+
+from CleanEmonCore import PACKAGE_DIR
+from CleanEmonCore.SQLiteAdapter import SQLiteAdapter
+from CleanEmonCore.models import EnergyData
+from CleanEmonCore.transfer import export_range
+from CleanEmonCore.transfer import import_file
+
+DATES = [f"2000-01-{day:02}" for day in range(1, 11)]
+
+
+def readings(day):
+    return [{"timestamp": 86400 * day + t, "power": t * 1.5, "kwh": t} for t in range(5)]
+
+
+def stored_days():
+    # The 4th day is missing, as it happens when a meter is offline
+    return [EnergyData(date, readings(day)) for day, date in enumerate(DATES) if day != 3]
+
+
+@fixture
+def source(tmp_path):
+    with SQLiteAdapter(path=str(tmp_path / "source.sqlite")) as adapter:
+        for data in stored_days():
+            adapter.create_document(initial_data=data)
+        yield adapter
+
+
+@fixture
+def target(tmp_path):
+    with SQLiteAdapter(path=str(tmp_path / "target.sqlite")) as adapter:
+        yield adapter
+
+
+@pytest.mark.parametrize("name", ["export.ndjson", "export.csv"])
+def test_round_trip(source, target, tmp_path, name):
+    path = str(tmp_path / name)
+
+    exported = export_range(source, DATES[0], DATES[-1], path, workers=3, batch_days=2)
+    assert (exported.days, exported.readings) == (9, 45)
+
+    imported = import_file(target, path, workers=3, batch_days=2)
+    assert (imported.days, imported.readings) == (9, 45)
+
+    assert list(target.fetch_energy_data_range(DATES[0], DATES[-1])) == stored_days()
+
+
+def test_csv_columns(source, tmp_path):
+    path = tmp_path / "export.csv"
+    export_range(source, DATES[0], DATES[0], str(path), fields=["kwh"])
+
+    assert path.read_text().splitlines()[:2] == ["date,timestamp,kwh", "2000-01-01,0,0"]
+
+
+@pytest.mark.usefixtures("design")
+def test_couchdb_round_trip(source, adapter, tmp_path):
+    path = str(tmp_path / "export.ndjson")
+    export_range(source, DATES[0], DATES[-1], path)
+
+    # Importing replaces the stored readings of every date
+    adapter.create_document(initial_data=EnergyData(DATES[0], readings(99)))
+    import_file(adapter, path, batch_days=4)
+    import_file(adapter, path, batch_days=4)
+
+    assert list(adapter.fetch_energy_data_range(DATES[0], DATES[-1])) == stored_days()
+
+    again = str(tmp_path / "again.ndjson")
+    export_range(adapter, DATES[0], DATES[-1], again)
+    with open(path) as expected, open(again) as actual:
+        assert expected.read() == actual.read()
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(days):
+    def progress(report):
+        if report.days >= days:
+            raise Interrupted
+
+    return progress
+
+
+def test_export_resumes_from_checkpoint(source, tmp_path):
+    expected = str(tmp_path / "expected.csv")
+    export_range(source, DATES[0], DATES[-1], expected)
+
+    path = str(tmp_path / "export.csv")
+    checkpoint = str(tmp_path / "export.checkpoint")
+    with pytest.raises(Interrupted):
+        export_range(source, DATES[0], DATES[-1], path, batch_days=2, checkpoint=checkpoint,
+                     progress=interrupt_after(2))
+    assert json.load(open(checkpoint))["last_date"] == DATES[1]
+
+    # Anything written after the checkpoint is discarded
+    with open(path, "a") as f_out:
+        f_out.write("garbage\n")
+
+    resumed = export_range(source, DATES[0], DATES[-1], path, batch_days=2, checkpoint=checkpoint)
+    assert (resumed.resumed_days, resumed.days) == (2, 7)
+    assert not os.path.exists(checkpoint)
+
+    with open(expected) as f_expected, open(path) as f_actual:
+        assert f_expected.read() == f_actual.read()
+
+
+def test_import_resumes_from_checkpoint(source, target, tmp_path):
+    path = str(tmp_path / "export.ndjson")
+    export_range(source, DATES[0], DATES[-1], path)
+
+    checkpoint = str(tmp_path / "import.checkpoint")
+    with pytest.raises(Interrupted):
+        import_file(target, path, batch_days=3, workers=1, checkpoint=checkpoint, progress=interrupt_after(3))
+
+    resumed = import_file(target, path, batch_days=3, checkpoint=checkpoint)
+    assert (resumed.resumed_days, resumed.days) == (3, 6)
+    assert list(target.fetch_energy_data_range(DATES[0], DATES[-1])) == stored_days()
+
+    # A checkpoint of another transfer is refused
+    with open(checkpoint, "w") as f_out:
+        json.dump({"transfer": {"command": "export"}, "days": 1}, f_out)
+    with pytest.raises(ValueError):
+        import_file(target, path, checkpoint=checkpoint)
+
+
+def test_cli(source, tmp_path):
+    config = tmp_path / "clean.cfg"
+    config.write_text(f"[DB]\nbackend = sqlite\nsqlite_path = {tmp_path / 'cli.sqlite'}\n")
+    path = str(tmp_path / "export.ndjson")
+    export_range(source, DATES[0], DATES[-1], path)
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(PACKAGE_DIR))
+    subprocess.run([sys.executable, "-m", "CleanEmonCore", "import", path, "--config", str(config), "--workers", "2"],
+                   env=env, capture_output=True, check=True)
+
+    again = str(tmp_path / "again.ndjson")
+    result = subprocess.run([sys.executable, "-m", "CleanEmonCore", "export", DATES[0], DATES[-1], again,
+                             "--config", str(config), "--batch-days", "3"],
+                            env=env, capture_output=True, text=True, check=True)
+    assert "Exported 9 days (45 readings)" in result.stderr
+
+    with open(path) as expected, open(again) as actual:
+        assert expected.read() == actual.read()
@@ -0,0 +1,224 @@
+import configparser
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+from pytest import fixture
+
+from CleanEmonCore.CouchDBAdapter import CouchDBAdapter
+from CleanEmonCore._fake_couchdb import FakeCouchDB
+from CleanEmonCore.models import EnergyData
+from CleanEmonCore.transport import HTTPTransport
+from CleanEmonCore.transport import LATENCY_WEIGHTED
+from CleanEmonCore.transport import pinned
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_from_config(server_url):
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({"DB": {"endpoint": server_url, "pool_maxsize": "3", "read_timeout": "5"}})
+    transport = HTTPTransport.from_config(cfg["DB"])
+    assert transport.timeout == (3.05, 5)
+    assert transport.get("/hello").text == "/hello"
+
+
+def test_connection_reuse(server_url):
+    transport = HTTPTransport(server_url)
+    for _ in range(10):
+        assert transport.get("/").ok
+
+    stats = transport.stats()
+    assert stats["requests"] == 10
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 9
+
+
+def test_no_keep_alive(server_url):
+    transport = HTTPTransport(server_url, keep_alive=False)
+    for _ in range(3):
+        assert transport.get("/").ok
+
+    assert transport.stats()["connections_opened"] == 3
+
+
+def test_shared_across_threads(server_url):
+    transport = HTTPTransport(server_url, pool_maxsize=4, pool_block=True)
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda i: transport.get(f"/{i}").text, range(40)))
+
+    assert results == [f"/{i}" for i in range(40)]
+    stats = transport.stats()
+    assert stats["requests"] == 40
+    assert stats["connections_opened"] <= 4
+
+
+class NodeHandler(BaseHTTPRequestHandler):
+    """Replies with the name of its server, after its delay and with its status."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        time.sleep(self.server.delay)
+        body = self.server.name.encode()
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+def start_node(name):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NodeHandler)
+    server.daemon_threads = True
+    server.name, server.status, server.delay = name, 200, 0
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+
+@fixture
+def nodes():
+    servers = [start_node(name) for name in ("primary", "a", "b")]
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def cluster(nodes, **kwargs):
+    primary, *replicas = nodes
+    return HTTPTransport(primary.url, replicas=[replica.url for replica in replicas], retries=0, **kwargs)
+
+
+def served_by(transport, count, method="GET"):
+    names = [transport.request(method, "/").text for _ in range(count)]
+    return {name: names.count(name) for name in set(names)}
+
+
+def test_reads_are_spread_and_writes_pinned(nodes):
+    transport = cluster(nodes)
+
+    assert served_by(transport, 30) == {"primary": 10, "a": 10, "b": 10}
+    assert served_by(transport, 5, "PUT") == {"primary": 5}
+    assert served_by(transport, 5, "POST") == {"primary": 5}
+    assert transport.post("/", read=True).text in {"primary", "a", "b"}
+
+    with pinned():
+        assert served_by(transport, 5) == {"primary": 5}
+
+    transport = cluster(nodes, read_from_primary=False)
+    assert served_by(transport, 10) == {"a": 5, "b": 5}
+
+
+def test_failed_replica_is_ejected(nodes):
+    transport = cluster(nodes, eject_after=2, eject_seconds=60)
+    nodes[1].status = 503
+
+    # Failed reads are sent again to another endpoint
+    assert all(transport.get("/").ok for _ in range(20))
+
+    stats = {endpoint["url"]: endpoint for endpoint in transport.endpoint_stats()}
+    assert stats[nodes[1].url]["ejected"]
+    assert stats[nodes[1].url]["requests"] == 2
+    assert not stats[nodes[2].url]["ejected"]
+
+    # If every reader is ejected, the one whose ejection ends first is tried
+    nodes[0].status = nodes[2].status = 503
+    assert transport.get("/").status_code == 503
+
+
+def test_dead_replica_is_ejected(nodes):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        dead = f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+    transport = HTTPTransport(nodes[0].url, replicas=[dead], retries=0, eject_after=1)
+
+    assert all(transport.get("/").text == "primary" for _ in range(5))
+    assert [endpoint["ejected"] for endpoint in transport.endpoint_stats()] == [False, True]
+
+
+def test_slow_replica_is_ejected(nodes):
+    transport = cluster(nodes, eject_after=1, eject_latency=0.2)
+    nodes[2].delay = 0.3
+
+    served_by(transport, 12)
+    assert [endpoint["ejected"] for endpoint in transport.endpoint_stats()] == [False, False, True]
+    assert "b" not in served_by(transport, 10)
+
+
+def test_latency_weighted_balancing(nodes):
+    transport = cluster(nodes, balancing=LATENCY_WEIGHTED, eject_latency=0)
+    nodes[2].delay = 0.02
+
+    served = served_by(transport, 60)
+    assert served.get("b", 0) < served["a"]
+
+    with pytest.raises(ValueError):
+        cluster(nodes, balancing="unknown")
+
+
+def test_replicas_from_config(nodes):
+    cfg = configparser.ConfigParser()
+    cfg.read_dict({"DB": {"endpoint": ", ".join(node.url for node in nodes), "balancing": "latency"}})
+    transport = HTTPTransport.from_config(cfg["DB"])
+
+    assert transport.base_url == nodes[0].url
+    assert [endpoint["url"] for endpoint in transport.endpoint_stats()] == [node.url for node in nodes]
+    assert transport.balancing == LATENCY_WEIGHTED
+
+
+def test_adapter_writes_to_primary(tmp_path):
+    with FakeCouchDB() as primary, FakeCouchDB() as replica:
+        path = primary.write_config(str(tmp_path / "clean.cfg"))
+        with open(path, encoding="utf8") as f_in:
+            config = f_in.read().replace(f"endpoint = {primary.url}", f"endpoint = {primary.url}, {replica.url}")
+        with open(path, "w", encoding="utf8") as f_out:
+            f_out.write(config + "read_from_primary = no\n")
+        replica.databases["test"] = {}
+
+        adapter = CouchDBAdapter(path)
+        assert adapter.endpoint == primary.url
+
+        document = adapter.create_document(initial_data=EnergyData("2000-01-01", [{"timestamp": 1}]))
+        assert adapter.append_energy_data(EnergyData(energy_data=[{"timestamp": 2}]), document=document)
+        assert replica.count() == 0
+
+        # Reads are served by the replica, which has not caught up yet
+        assert adapter.fetch_energy_data(document=document) == EnergyData()
+        assert replica.count("GET") == 1
+        adapter.close()
@@ -0,0 +1,320 @@
+"""Bulk export and import of energy data, as NDJSON or CSV
+
+Both directions move whole days, a batch of days at a time. A bounded pool of workers fetches (or writes) a few batches
+concurrently, while the file itself is written (or read) in order, so memory use depends on the number of workers and
+the size of the batches rather than on the length of the range. Every record of a file is a single reading along with
+its date, and the readings of a date are kept together.
+
+If a checkpoint file is given, progress is saved to it after every batch, so that an interrupted transfer resumes right
+after the last batch that completed. The checkpoint is removed once the transfer is over.
+"""
+
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dataclasses import field as dataclass_field
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from .jsonstream import dumps
+from .jsonstream import loads
+from .models import EnergyData
+from .models import TIMESTAMP_FIELD
+from .storage import StorageBackend
+
+NDJSON = "ndjson"
+CSV = "csv"
+FORMATS = (NDJSON, CSV)
+
+DATE_FIELD = "date"
+
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_DAYS = 7
+
+
+@dataclass
+class Progress:
+    """What a transfer has moved so far. Days and readings that were moved before resuming are not counted."""
+
+    days: int = 0
+    readings: int = 0
+    resumed_days: int = 0
+    started: float = dataclass_field(default_factory=time.perf_counter)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def throughput(self) -> float:
+        """Readings per second."""
+
+        elapsed = self.elapsed
+        return self.readings / elapsed if elapsed > 0 else 0.0
+
+
+def format_of(path: str) -> str:
+    """Returns the format implied by the extension of `path`: CSV for .csv files, and NDJSON for anything else."""
+
+    return CSV if path.lower().endswith(".csv") else NDJSON
+
+
+def _load_checkpoint(path: Optional[str], transfer: dict) -> Optional[dict]:
+    """Returns the saved state of `transfer`, or None if there is nothing to resume.
+
+    Throws:
+    ValueError -- If the checkpoint belongs to a different transfer.
+    """
+
+    if not path or not os.path.exists(path):
+        return None
+
+    with open(path, encoding="utf8") as f_in:
+        state = json.load(f_in)
+
+    if state.get("transfer") != transfer:
+        raise ValueError(f"Checkpoint {path} belongs to a different transfer")
+
+    return state
+
+
+def _save_checkpoint(path: Optional[str], state: dict):
+    if not path:
+        return
+
+    # Written aside and moved into place, so that an interruption never leaves a truncated checkpoint behind
+    with open(f"{path}.tmp", "w", encoding="utf8") as f_out:
+        json.dump(state, f_out)
+    os.replace(f"{path}.tmp", path)
+
+
+def _drop_checkpoint(path: Optional[str]):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _in_order(pool: ThreadPoolExecutor, fn: Callable, batches: Iterable[list], window: int) -> Iterator[tuple]:
+    """Applies `fn` to every batch on the pool, keeping at most `window` batches in flight.
+    Yields (batch, result) pairs in the order of the batches.
+    """
+
+    pending = deque()
+    for batch in batches:
+        pending.append((batch, pool.submit(fn, batch)))
+        if len(pending) >= window:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+    while pending:
+        batch, future = pending.popleft()
+        yield batch, future.result()
+
+
+def _dates(start: str, end: str) -> Iterator[str]:
+    day = datetime.date.fromisoformat(start)
+    last = datetime.date.fromisoformat(end)
+    while day <= last:
+        yield day.isoformat()
+        day += datetime.timedelta(days=1)
+
+
+def _columns_of(days: List[EnergyData]) -> List[str]:
+    fields = {name for day in days for reading in day.energy_data for name in reading}
+    fields.discard(DATE_FIELD)
+    fields.discard(TIMESTAMP_FIELD)
+    return [DATE_FIELD, TIMESTAMP_FIELD, *sorted(fields)]
+
+
+def _render(days: List[EnergyData], fmt: str, columns: List[str]) -> bytes:
+    if fmt == NDJSON:
+        return b"".join(dumps({**reading, DATE_FIELD: day.date}) + b"\n"
+                        for day in days for reading in day.energy_data)
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, columns, extrasaction="ignore", lineterminator="\n")
+    for day in days:
+        for reading in day.energy_data:
+            writer.writerow({**reading, DATE_FIELD: day.date})
+    return buffer.getvalue().encode()
+
+
+def export_range(storage: StorageBackend, start: str, end: str, path: str, *, fmt: str = None,
+                 fields: List[str] = None, workers: int = DEFAULT_WORKERS, batch_days: int = DEFAULT_BATCH_DAYS,
+                 checkpoint: str = None, progress: Callable[[Progress], None] = None) -> Progress:
+    """Writes the readings of every date between `start` and `end` (both inclusive) to `path`, in chronological order.
+    Returns the progress of the transfer once it is over.
+
+    storage -- The backend to read from
+    start -- The first date of the range, in YYYY-MM-DD format
+    end -- The last date of the range, in YYYY-MM-DD format
+    path -- The file to be written. It is overwritten, unless the transfer is resumed.
+    fmt -- Either "ndjson" or "csv". If omitted, it is implied by the extension of `path`.
+    fields -- The CSV columns after the date and the timestamp. If omitted, they are the fields found in the first
+              exported batch; fields that only appear later are left out.
+    workers -- How many batches are fetched concurrently
+    batch_days -- How many days are fetched by a single range query
+    checkpoint -- If given, progress is saved to this file, and an interrupted export is resumed from it
+    progress -- Called with the progress of the transfer after every batch
+
+    Throws:
+    ValueError -- If the format is unknown, or the checkpoint belongs to a different transfer.
+    """
+
+    fmt = fmt or format_of(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+
+    transfer = {"command": "export", "start": start, "end": end, "path": os.path.abspath(path), "format": fmt}
+    state = _load_checkpoint(checkpoint, transfer)
+
+    report = Progress()
+    columns = [DATE_FIELD, TIMESTAMP_FIELD, *fields] if fields is not None else None
+    first = start
+    offset = 0
+
+    if state:
+        if state["last_date"] >= end:
+            _drop_checkpoint(checkpoint)
+            return report
+        first = (datetime.date.fromisoformat(state["last_date"]) + datetime.timedelta(days=1)).isoformat()
+        offset = state["offset"]
+        columns = state["columns"]
+        report.resumed_days = state["days"]
+
+    def fetch(dates: List[str]) -> List[EnergyData]:
+        return list(storage.fetch_energy_data_range(dates[0], dates[-1]))
+
+    with open(path, "r+b" if state else "wb") as f_out, ThreadPoolExecutor(workers) as pool:
+        # Anything written after the last checkpoint is written again
+        f_out.seek(offset)
+        f_out.truncate()
+        header_written = offset > 0
+
+        for dates, days in _in_order(pool, fetch, _batches(_dates(first, end), batch_days), workers):
+            if fmt == CSV and not header_written and (columns is not None or days):
+                columns = columns or _columns_of(days)
+                f_out.write(",".join(columns).encode() + b"\n")
+                header_written = True
+
+            if days:
+                f_out.write(_render(days, fmt, columns))
+            f_out.flush()
+
+            report.days += len(days)
+            report.readings += sum(len(day.energy_data) for day in days)
+            _save_checkpoint(checkpoint, {"transfer": transfer,
+                                          "last_date": dates[-1],
+                                          "offset": f_out.tell(),
+                                          "columns": columns,
+                                          "days": report.resumed_days + report.days})
+            if progress:
+                progress(report)
+
+    _drop_checkpoint(checkpoint)
+    return report
+
+
+def _parse_value(text: str):
+    """Turns a CSV cell back into a number, if it holds one."""
+
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _read_records(f_in, fmt: str) -> Iterator[dict]:
+    if fmt == NDJSON:
+        for line in f_in:
+            if line.strip():
+                yield loads(line)
+        return
+
+    for row in csv.DictReader(io.TextIOWrapper(f_in, encoding="utf8", newline="")):
+        # Empty cells stand for fields the reading does not have
+        yield {name: value if name == DATE_FIELD else _parse_value(value)
+               for name, value in row.items() if value != "" and name is not None}
+
+
+def _read_days(f_in, fmt: str) -> Iterator[EnergyData]:
+    """Groups consecutive records of the same date into EnergyData objects."""
+
+    for date, records in itertools.groupby(_read_records(f_in, fmt), key=lambda record: record.get(DATE_FIELD, "")):
+        readings = []
+        for record in records:
+            record.pop(DATE_FIELD, None)
+            readings.append(record)
+        yield EnergyData(date, readings)
+
+
+def import_file(storage: StorageBackend, path: str, *, fmt: str = None, workers: int = DEFAULT_WORKERS,
+                batch_days: int = DEFAULT_BATCH_DAYS, checkpoint: str = None,
+                progress: Callable[[Progress], None] = None) -> Progress:
+    """Stores the readings of a file written by `export_range`. The readings of every date found in the file replace
+    the stored ones, so importing the same file twice is harmless. The readings of a date must be consecutive in the
+    file. Returns the progress of the transfer once it is over.
+
+    storage -- The backend to write to
+    path -- The file to be read
+    fmt -- Either "ndjson" or "csv". If omitted, it is implied by the extension of `path`.
+    workers -- How many batches are written concurrently
+    batch_days -- How many days are written by a single bulk request
+    checkpoint -- If given, progress is saved to this file, and an interrupted import is resumed from it
+    progress -- Called with the progress of the transfer after every batch
+
+    Throws:
+    ValueError -- If the format is unknown, or the checkpoint belongs to a different transfer.
+    RuntimeError -- If any date cannot be stored. Every batch before it has been stored, and checkpointed.
+    """
+
+    fmt = fmt or format_of(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+
+    transfer = {"command": "import", "path": os.path.abspath(path), "format": fmt}
+    state = _load_checkpoint(checkpoint, transfer)
+
+    report = Progress()
+    if state:
+        report.resumed_days = state["days"]
+
+    def write(days: List[EnergyData]) -> list:
+        return storage.update_energy_data_by_dates(days, chunk_size=len(days))
+
+    with open(path, "rb") as f_in, ThreadPoolExecutor(workers) as pool:
+        days = itertools.islice(_read_days(f_in, fmt), report.resumed_days, None)
+
+        for batch, results in _in_order(pool, write, _batches(days, batch_days), workers):
+            for data, result in zip(batch, results):
+                if not result.ok:
+                    raise RuntimeError(f"Could not import {data.date}: {result.error}")
+
+            report.days += len(batch)
+            report.readings += sum(len(data.energy_data) for data in batch)
+            _save_checkpoint(checkpoint, {"transfer": transfer, "days": report.resumed_days + report.days})
+            if progress:
+                progress(report)
+
+    _drop_checkpoint(checkpoint)
+    return report
@@ -0,0 +1,510 @@
+"""Pooled HTTP transport used by the database adapters"""
+
+import contextvars
+import functools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from .metrics import RequestSample
+from .metrics import current_operation
+
+if TYPE_CHECKING:
+    import requests
+
+# Statuses that are worth retrying. They indicate a transient server-side failure, as opposed to 4xx responses which
+# would fail again in exactly the same way.
+_RETRY_STATUSES = (500, 502, 503, 504)
+
+# Methods that can be safely repeated. POST is deliberately missing, as CouchDB uses it for non-idempotent operations.
+_RETRY_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+# Methods that are sent to the replicas, unless the request says otherwise
+_READ_METHODS = frozenset({"GET", "HEAD"})
+
+# Read balancing policies
+LEAST_OUTSTANDING = "least_outstanding"
+LATENCY_WEIGHTED = "latency"
+
+# Weight of the newest latency in the moving average kept per endpoint
+_LATENCY_SMOOTHING = 0.3
+
+_pinned = contextvars.ContextVar("pinned", default=False)
+
+
+@contextmanager
+def pinned():
+    """Sends every request of the block to the primary endpoint, reads included, so that they observe the writes that
+    preceded them."""
+
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def on_primary(fn):
+    """Decorates an adapter method, so that every request it sends goes to the primary endpoint of its `transport`.
+    Write methods need it, as the reads they rely on (e.g. of the current revision) must not be served by a lagging
+    replica."""
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if not self.transport.replicas:
+            return fn(self, *args, **kwargs)
+        with pinned():
+            return fn(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _counting_http_adapter(on_new_connection, **kwargs):
+    """Returns an HTTPAdapter that reports every new TCP connection to the owning transport. requests (and urllib3)
+    are only imported here, when the first request is about to be sent, as importing them takes longer than importing
+    the rest of the package."""
+
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool
+    from urllib3.connectionpool import HTTPSConnectionPool
+
+    class CountingHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **pool_kwargs):
+            super().init_poolmanager(*args, **pool_kwargs)
+
+            # Connection objects are recycled by urllib3 even after the server has closed them, so the counting takes
+            # place whenever a socket is actually (re)connected.
+            class CountingHTTPConnection(HTTPConnectionPool.ConnectionCls):
+                def connect(self):
+                    on_new_connection()
+                    return super().connect()
+
+            class CountingHTTPSConnection(HTTPSConnectionPool.ConnectionCls):
+                def connect(self):
+                    on_new_connection()
+                    return super().connect()
+
+            class CountingHTTPConnectionPool(HTTPConnectionPool):
+                ConnectionCls = CountingHTTPConnection
+
+            class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+                ConnectionCls = CountingHTTPSConnection
+
+            # The mapping is shared at module-level by urllib3, so it must be copied before being altered
+            self.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool,
+                                                       "https": CountingHTTPSConnectionPool}
+
+    return CountingHTTPAdapter(**kwargs)
+
+
+class _Endpoint:
+    """The passive health record of a single server."""
+
+    def __init__(self, url: str):
+        self.url = url.strip().rstrip("/")
+        self.outstanding = 0
+        self.latency = None  # type: Optional[float]
+        self.failures = 0  # Consecutive failed (or slow) requests
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.requests = 0
+
+    def as_dict(self, now: float) -> dict:
+        return {"url": self.url,
+                "requests": self.requests,
+                "outstanding": self.outstanding,
+                "latency": self.latency,
+                "ejected": self.ejected_until > now,
+                "ejections": self.ejections}
+
+
+class HTTPTransport:
+    """A thread-safe, pooled and keep-alive HTTP client bound to a primary base URL, and optionally to a few replicas
+    of it.
+
+    All threads share the same connection pool, while each thread gets its own lightweight `requests.Session` on top
+    of it, as sessions themselves are not guaranteed to be thread-safe.
+
+    With replicas, reads are spread among the healthy endpoints, while writes (and everything sent within `pinned`)
+    go to the primary. Every read endpoint is health-checked passively: once it fails (or is slow) too many times in a
+    row, it is ejected for a while. A read that fails on one endpoint is sent to the next one.
+    """
+
+    def __init__(self, base_url: str, *, auth=None, pool_connections: int = 4, pool_maxsize: int = 10,
+                 pool_block: bool = False, keep_alive: bool = True, connect_timeout: float = 3.05,
+                 read_timeout: float = 30, retries: int = 3, backoff_factor: float = 0.3,
+                 hooks: Iterable[Callable[[RequestSample], None]] = (), replicas: Iterable[str] = (),
+                 read_from_primary: bool = True, balancing: str = LEAST_OUTSTANDING, eject_after: int = 3,
+                 eject_seconds: float = 30, eject_latency: float = 10):
+        """base_url -- The URL every requested path is relative to, e.g. http://localhost:5984
+        auth -- A (username, password) tuple, used for every request
+        pool_connections -- The number of distinct hosts to keep pools for
+        pool_maxsize -- The maximum number of connections to keep alive per host
+        pool_block -- If set, requests wait for a free connection instead of opening a throw-away one
+        keep_alive -- If unset, every connection is closed after a single request
+        connect_timeout -- Seconds to wait for a connection to be established
+        read_timeout -- Seconds to wait for the server to send a response
+        retries -- How many times a failed request should be retried before giving up
+        backoff_factor -- Exponential backoff factor (in seconds) applied between retries
+        hooks -- Called with a RequestSample after every request (see `add_hook`)
+        replicas -- The URLs of replicas of the primary, which serve reads
+        read_from_primary -- If unset, the primary serves reads only while every replica is ejected
+        balancing -- How reads are spread: "least_outstanding" picks the endpoint with the fewest requests in flight
+                     (in turn, among equals), while "latency" picks at random, weighted by the inverse of the recent
+                     latency of each endpoint
+        eject_after -- How many failed or slow requests in a row eject an endpoint
+        eject_seconds -- For how long an ejected endpoint is left out
+        eject_latency -- Requests that take longer than this (in seconds) count as failed. 0 disables it.
+
+        Throws:
+        ValueError -- If the balancing policy is unknown.
+        """
+
+        if balancing not in (LEAST_OUTSTANDING, LATENCY_WEIGHTED):
+            raise ValueError(f"Unknown balancing policy: {balancing}")
+
+        self.base_url = base_url.rstrip("/")
+        self.auth = auth
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._requests = 0
+        self._connections_opened = 0
+
+        # The connection pool is set up along with the first session
+        self._pool_options = {"pool_connections": pool_connections,
+                              "pool_maxsize": pool_maxsize,
+                              "pool_block": pool_block}
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._adapter = None
+
+        self.hooks = list(hooks)  # type: List[Callable[[RequestSample], None]]
+
+        self._primary = _Endpoint(self.base_url)
+        self.replicas = [_Endpoint(url) for url in replicas]
+        self._readers = self.replicas + [self._primary] if read_from_primary else list(self.replicas)
+        self.balancing = balancing
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.eject_latency = eject_latency
+        self._turn = 0
+
+        # Every endpoint gets a pool of its own
+        self._pool_options["pool_connections"] = max(pool_connections, len(self.replicas) + 1)
+
+    @classmethod
+    def from_config(cls, section, *, auth=None) -> "HTTPTransport":
+        """Creates a new transport out of a configparser section. Only the `endpoint` option is mandatory; every other
+        option falls back to a sensible default. `endpoint` may list several comma-separated URLs, in which case the
+        first one is the primary and the rest are its replicas.
+
+        section -- The configparser section to be used, usually `[DB]`
+        auth -- A (username, password) tuple, used for every request
+        """
+
+        primary, *replicas = [url for url in section["endpoint"].split(",") if url.strip()]
+
+        return cls(primary.strip(),
+                   auth=auth,
+                   pool_connections=section.getint("pool_connections", fallback=4),
+                   pool_maxsize=section.getint("pool_maxsize", fallback=10),
+                   pool_block=section.getboolean("pool_block", fallback=False),
+                   keep_alive=section.getboolean("keep_alive", fallback=True),
+                   connect_timeout=section.getfloat("connect_timeout", fallback=3.05),
+                   read_timeout=section.getfloat("read_timeout", fallback=30),
+                   retries=section.getint("retries", fallback=3),
+                   backoff_factor=section.getfloat("backoff_factor", fallback=0.3),
+                   replicas=replicas,
+                   read_from_primary=section.getboolean("read_from_primary", fallback=True),
+                   balancing=section.get("balancing", fallback=LEAST_OUTSTANDING),
+                   eject_after=section.getint("eject_after", fallback=3),
+                   eject_seconds=section.getfloat("eject_seconds", fallback=30),
+                   eject_latency=section.getfloat("eject_latency", fallback=10))
+
+    def _count_connection(self):
+        with self._lock:
+            self._connections_opened += 1
+
+    def _http_adapter(self):
+        """Returns the HTTPAdapter shared by every session, creating it on first use."""
+
+        with self._lock:
+            if self._adapter is None:
+                from urllib3.util.retry import Retry
+
+                retry = Retry(total=self._retries,
+                              backoff_factor=self._backoff_factor,
+                              status_forcelist=_RETRY_STATUSES,
+                              allowed_methods=_RETRY_METHODS,
+                              raise_on_status=False)
+
+                self._adapter = _counting_http_adapter(self._count_connection, max_retries=retry,
+                                                       **self._pool_options)
+
+            return self._adapter
+
+    @property
+    def session(self) -> "requests.Session":
+        """The session of the calling thread. It is created on first use."""
+
+        session = getattr(self._local, "session", None)
+        if session is None:
+            import requests
+
+            adapter = self._http_adapter()
+            session = requests.Session()
+            session.auth = self.auth
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if not self.keep_alive:
+                session.headers["Connection"] = "close"
+            self._local.session = session
+
+        return session
+
+    def add_hook(self, hook: Callable[[RequestSample], None]):
+        """Registers `hook` to be called with a RequestSample after every request, in the thread that sent it. Hooks
+        should return quickly, as they delay the caller. While there are no hooks, requests are not measured at all.
+        """
+
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[RequestSample], None]):
+        self.hooks.remove(hook)
+
+    def request(self, method: str, path: str, *, read: bool = None, **kwargs) -> "requests.Response":
+        """Sends a request to `path`, relative to the base URL of the transport.
+
+        method -- The HTTP method to be used
+        path -- The requested path. It should start with a slash
+        read -- Whether the request may be served by a replica. If omitted, only GET and HEAD requests are.
+        kwargs -- Any extra keyword argument accepted by `requests.Session.request`
+        """
+
+        kwargs.setdefault("timeout", self.timeout)
+
+        with self._lock:
+            self._requests += 1
+
+        if not self.replicas:
+            return self._send(method, f"{self.base_url}{path}", kwargs)
+
+        if read is None:
+            read = method in _READ_METHODS
+        if not read or _pinned.get():
+            return self._send_to(self._primary, method, path, kwargs)
+
+        # A body that is streamed out of an iterator cannot be sent twice
+        data = kwargs.get("data")
+        replayable = data is None or isinstance(data, (bytes, bytearray, str, dict))
+
+        tried = []
+        while True:
+            endpoint = self._pick(tried)
+            tried.append(endpoint)
+            last = not replayable or len(tried) > len(self.replicas)
+
+            try:
+                res = self._send_to(endpoint, method, path, kwargs)
+            except OSError:
+                if last:
+                    raise
+                continue
+
+            if res.status_code >= 500 and not last:
+                res.close()
+                continue
+
+            return res
+
+    def _pick(self, excluded: List[_Endpoint]) -> Optional[_Endpoint]:
+        """Returns the endpoint the next read should be sent to, out of those not `excluded`, or None if there is none
+        left. Healthy readers come first, then the primary, and last the endpoint whose ejection ends soonest."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            readers = [endpoint for endpoint in self._readers
+                       if endpoint not in excluded and endpoint.ejected_until <= now]
+            if not readers:
+                remaining = [endpoint for endpoint in [*self.replicas, self._primary] if endpoint not in excluded]
+                if not remaining:
+                    return None
+                if self._primary in remaining and self._primary.ejected_until <= now:
+                    return self._primary
+                return min(remaining, key=lambda endpoint: endpoint.ejected_until)
+
+            if self.balancing == LATENCY_WEIGHTED:
+                known = [endpoint.latency for endpoint in readers if endpoint.latency]
+                # Endpoints of unknown latency are assumed to be as fast as the fastest one, so that they get probed
+                default = min(known, default=1.0)
+                weights = [1 / ((endpoint.latency or default) * (1 + endpoint.outstanding)) for endpoint in readers]
+                return random.choices(readers, weights)[0]
+
+            # Among endpoints with as few outstanding requests, each one gets its turn
+            self._turn = (self._turn + 1) % len(readers)
+            rotated = readers[self._turn:] + readers[:self._turn]
+            return min(rotated, key=lambda endpoint: endpoint.outstanding)
+
+    def _send_to(self, endpoint: _Endpoint, method: str, path: str, kwargs: dict) -> "requests.Response":
+        """Sends a request to the given endpoint, keeping track of its health."""
+
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+
+        started = time.perf_counter()
+        try:
+            res = self._send(method, f"{endpoint.url}{path}", kwargs)
+        except OSError:
+            self._record(endpoint, time.perf_counter() - started, failed=True)
+            raise
+        finally:
+            with self._lock:
+                endpoint.outstanding -= 1
+
+        self._record(endpoint, time.perf_counter() - started, failed=res.status_code >= 500)
+        return res
+
+    def _record(self, endpoint: _Endpoint, duration: float, *, failed: bool):
+        with self._lock:
+            if endpoint.latency is None:
+                endpoint.latency = duration
+            else:
+                endpoint.latency += _LATENCY_SMOOTHING * (duration - endpoint.latency)
+
+            if failed or (self.eject_latency and duration > self.eject_latency):
+                endpoint.failures += 1
+                if endpoint.failures >= self.eject_after:
+                    endpoint.ejected_until = time.monotonic() + self.eject_seconds
+                    endpoint.ejections += 1
+                    endpoint.failures = 0
+                    # Its latency is measured anew once it is back
+                    endpoint.latency = None
+            else:
+                endpoint.failures = 0
+
+    def _send(self, method: str, url: str, kwargs: dict) -> "requests.Response":
+        if not self.hooks:
+            return self.session.request(method, url, **kwargs)
+
+        return self._measured_request(method, url, kwargs)
+
+    def _measured_request(self, method: str, url: str, kwargs: dict) -> "requests.Response":
+        """Sends a request and reports it to every hook. Streamed responses are reported once they are closed, so that
+        their latency and size cover the whole body."""
+
+        sample = RequestSample(current_operation(), method, 0, 0.0, 0, 0)
+
+        data = kwargs.get("data")
+        if isinstance(data, (bytes, bytearray)):
+            sample.bytes_sent = len(data)
+        elif isinstance(data, str):
+            sample.bytes_sent = len(data.encode())
+        elif data is not None and not isinstance(data, dict):
+            kwargs["data"] = _counting(data, sample)
+
+        started = time.perf_counter()
+        try:
+            res = self.session.request(method, url, **kwargs)
+        except Exception:
+            sample.duration = time.perf_counter() - started
+            self._report(sample)
+            raise
+
+        sample.status = res.status_code
+        retries = getattr(res.raw, "retries", None)
+        sample.retries = len(retries.history) if retries is not None else 0
+        if data is None and res.request.body is not None:
+            # e.g. bodies passed as `json`
+            sample.bytes_sent = len(res.request.body)
+
+        if not kwargs.get("stream"):
+            sample.bytes_received = len(res.content)
+            sample.duration = time.perf_counter() - started
+            self._report(sample)
+            return res
+
+        iter_content = res.iter_content
+        close = res.close
+
+        def counted_iter_content(*args, **kw):
+            for chunk in iter_content(*args, **kw):
+                sample.bytes_received += len(chunk)
+                yield chunk
+
+        def reporting_close():
+            if res.close is reporting_close:
+                res.close = close
+                sample.duration = time.perf_counter() - started
+                self._report(sample)
+            close()
+
+        res.iter_content = counted_iter_content
+        res.close = reporting_close
+        return res
+
+    def _report(self, sample: RequestSample):
+        for hook in list(self.hooks):
+            hook(sample)
+
+    def get(self, path: str, **kwargs) -> "requests.Response":
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> "requests.Response":
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> "requests.Response":
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> "requests.Response":
+        return self.request("DELETE", path, **kwargs)
+
+    def endpoint_stats(self) -> List[dict]:
+        """Returns the health of every endpoint, the primary first: how many requests it was sent, how many of them are
+        still in flight, its recent latency (in seconds), whether it is currently ejected and how many times it was."""
+
+        now = time.monotonic()
+        with self._lock:
+            return [endpoint.as_dict(now) for endpoint in [self._primary, *self.replicas]]
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of requests sent so far, along with how many of them had to open a new connection and
+        how many reused an already established one."""
+
+        with self._lock:
+            requests_sent = self._requests
+            opened = self._connections_opened
+
+        return {"requests": requests_sent,
+                "connections_opened": opened,
+                "connections_reused": max(requests_sent - opened, 0)}
+
+    def close(self):
+        """Closes every pooled connection. The transport can still be used afterwards, but it will have to reconnect.
+        """
+
+        if self._adapter is not None:
+            self._adapter.close()
+        session = getattr(self._local, "session", None)
+        if session is not None:
+            session.close()
+            self._local.session = None
+
+
+def _counting(chunks, sample: RequestSample):
+    """Re-yields the chunks of a streamed request body, adding their size to the sample."""
+
+    for chunk in chunks:
+        sample.bytes_sent += len(chunk.encode() if isinstance(chunk, str) else chunk)
+        yield chunk